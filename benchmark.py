@@ -0,0 +1,212 @@
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import tensorflow as tf
+
+import run
+import utils_runtime
+from models import CELL_TYPES
+
+# Calls timed at the start and at the end of a run when checking that latency stays flat
+LATENCY_WINDOW = 100
+WARMUP_CALLS = 10
+# Models trained on batches packed by utils_runtime.batch_feed_values
+FEED_MODELS = ['char', 'seq2seq', 'cbow']
+
+
+def build_sample_model(args, vocabulary):
+    start_encode = vocabulary["<go>"] if args.model == 'seq2seq' else vocabulary["<start>"]
+    return run.build_model(args.model, 1, 1, 1, len(vocabulary), args.cell_type, args.set_config,
+                           start_encode, vocabulary["<end>"], is_train=False)
+
+
+def sample_once(args, curModel, session, vocabulary):
+    warm_chars = list(np.random.randint(len(run.music_map), size=args.warm_len))
+    meta = utils_runtime.encode_meta_batch(run.meta_map, utils_runtime.create_noise_meta_batch(run.meta_map, 1))
+
+    if args.model == 'seq2seq':
+        initial_state_sample = utils_runtime.zero_state_batch(curModel, 1)
+        feed_values = utils_runtime.pack_feed_values(args, [warm_chars],
+                                    [[vocabulary["<go>"]]], np.zeros_like(meta),
+                                    initial_state_sample, True,
+                                    [len(warm_chars)], [args.max_length])
+        return curModel.sample(session, feed_values)
+    else:
+        return run.sample_CharRNN(args, curModel, session, [warm_chars], meta, [run.TEMPERATURE], max_length=args.max_length)
+
+
+def benchmark_sample(args):
+    """
+    Samples @args.num_tunes tunes from a finalized graph, one call per tune, and
+    checks that neither the graph nor the per-call latency grows along the way.
+    """
+    vocabulary = run.build_vocabulary(run.music_map, args.model)
+    curModel = build_sample_model(args, vocabulary)
+    saver = tf.train.Saver()
+
+    with tf.Session(config=run.GPU_CONFIG) as session:
+        if args.ckpt_dir:
+            saver.restore(session, tf.train.latest_checkpoint(args.ckpt_dir))
+        else:
+            tf.global_variables_initializer().run()
+
+        graph_size = len(session.graph.get_operations())
+        session.graph.finalize()
+
+        latencies = []
+        for i in xrange(WARMUP_CALLS + args.num_tunes):
+            start = time.time()
+            sample_once(args, curModel, session, vocabulary)
+            if i >= WARMUP_CALLS:
+                latencies.append(time.time() - start)
+
+        final_graph_size = len(session.graph.get_operations())
+
+    window = min(LATENCY_WINDOW, len(latencies))
+    first = np.median(latencies[:window])
+    last = np.median(latencies[-window:])
+    print "Sampled {0} tunes with the {1} model".format(args.num_tunes, args.model)
+    print "Graph size: {0} ops before, {1} ops after".format(graph_size, final_graph_size)
+    print "Median latency per call: {0:.2f} ms (first {2}), {1:.2f} ms (last {2})".format(first*1000, last*1000, window)
+
+    assert final_graph_size == graph_size, "Sampling added {0} ops to the graph".format(final_graph_size - graph_size)
+    assert last <= first*args.tolerance, "Latency per call grew from {0:.2f} ms to {1:.2f} ms".format(first*1000, last*1000)
+
+
+def time_training(args, vocabulary, cell_type, window_sz):
+    """
+    Builds the CharRNN training graph with @cell_type and windows of @window_sz characters.
+    Returns its size, the time to build it and the median time of @args.num_steps training steps
+    """
+    with tf.Graph().as_default() as graph:
+        start = time.time()
+        curModel = run.build_model('char', window_sz, window_sz, run.BATCH_SIZE, len(vocabulary), cell_type,
+                                   args.set_config, vocabulary["<start>"], vocabulary["<end>"], is_train=True)
+        build_time = time.time() - start
+        graph_size = len(graph.get_operations())
+
+        batch_size = curModel.config.batch_size
+        inputs = np.random.randint(len(run.music_map), size=(batch_size, window_sz))
+        labels = np.random.randint(len(run.music_map), size=(batch_size, window_sz))
+        meta = utils_runtime.encode_meta_batch(run.meta_map, utils_runtime.create_noise_meta_batch(run.meta_map, batch_size))
+        initial_state = utils_runtime.zero_state_batch(curModel, batch_size)
+        feed_dict = curModel._feed_dict(utils_runtime.pack_feed_values(args, inputs, labels, meta,
+                                                                       initial_state, True, None, None))
+
+        with tf.Session(graph=graph, config=run.GPU_CONFIG) as session:
+            tf.global_variables_initializer().run()
+            latencies = []
+            for i in xrange(WARMUP_CALLS + args.num_steps):
+                start = time.time()
+                session.run(curModel.train_op, feed_dict=feed_dict)
+                if i >= WARMUP_CALLS:
+                    latencies.append(time.time() - start)
+
+    return graph_size, build_time, np.median(latencies)
+
+
+def benchmark_decode(args):
+    """
+    Builds the CharRNN training graph at every window size of @args.windows, and reports
+    its size, the time to build it and the median time of a training step.
+    """
+    vocabulary = run.build_vocabulary(run.music_map, 'char')
+    args.model = 'char'
+
+    results = [(window_sz,) + time_training(args, vocabulary, args.cell_type, window_sz) for window_sz in args.windows]
+
+    print "{0:>8} {1:>10} {2:>12} {3:>14}".format('Window', 'Graph ops', 'Build (s)', 'Step (ms)')
+    for window_sz, graph_size, build_time, step_time in results:
+        print "{0:>8} {1:>10} {2:>12.2f} {3:>14.2f}".format(window_sz, graph_size, build_time, step_time*1000)
+
+
+def benchmark_cells(args):
+    """
+    Times the CharRNN training step with every cell backend of @args.cells, at the
+    hidden_size of the hyperparameters and windows of window_sz characters.
+    """
+    vocabulary = run.build_vocabulary(run.music_map, 'char')
+    args.model = 'char'
+    config = run.Config(args.set_config)
+
+    results = [(cell_type,) + time_training(args, vocabulary, cell_type, config.window_sz) for cell_type in args.cells]
+    baseline = dict((cell_type, step_time) for cell_type, _, _, step_time in results).get('lstm')
+
+    print "Hidden size {0}, {1} layers, windows of {2} characters".format(config.hidden_size, config.num_layers, config.window_sz)
+    print "{0:>12} {1:>10} {2:>12} {3:>14} {4:>10}".format('Cell', 'Graph ops', 'Build (s)', 'Step (ms)', 'vs lstm')
+    for cell_type, graph_size, build_time, step_time in results:
+        speedup = '{0:.2f}x'.format(baseline/step_time) if baseline else '-'
+        print "{0:>12} {1:>10} {2:>12.2f} {3:>14.2f} {4:>10}".format(cell_type, graph_size, build_time, step_time*1000, speedup)
+
+
+def benchmark_feeds(args):
+    """
+    Runs a training step of every model of FEED_MODELS on a random batch packed by
+    utils_runtime.batch_feed_values, so a feed helper that breaks one of the models fails here.
+    """
+    config = run.Config(args.set_config)
+    for model in FEED_MODELS:
+        args.model = model
+        vocabulary = run.build_vocabulary(run.music_map, model)
+        start_encode = vocabulary["<go>"] if model == 'seq2seq' else vocabulary["<start>"]
+
+        with tf.Graph().as_default() as graph:
+            curModel = run.build_model(model, config.window_sz, config.window_sz, run.BATCH_SIZE, len(vocabulary),
+                                       args.cell_type, args.set_config, start_encode, vocabulary["<end>"], is_train=True)
+            batch_size = curModel.config.batch_size
+            data_batch = (utils_runtime.create_noise_meta_batch(run.meta_map, batch_size),
+                          np.random.randint(len(run.music_map), size=(batch_size, config.window_sz)),
+                          np.random.randint(len(run.music_map), size=(batch_size, config.window_sz)))
+            feed_values = utils_runtime.batch_feed_values(args, curModel, run.meta_map, data_batch)
+
+            with tf.Session(graph=graph, config=run.GPU_CONFIG) as session:
+                tf.global_variables_initializer().run()
+                _, loss = session.run([curModel.train_op, curModel.loss_op], feed_dict=curModel._feed_dict(feed_values))
+
+        print "{0:>8} {1:>12} loss {2:.4f}".format(model, args.cell_type if model != 'cbow' else '-', loss)
+        assert np.isfinite(loss), "The {0} model trained to a loss of {1}".format(model, loss)
+
+
+def parseCommandLineBenchmark():
+    desc = u'{0} [Args] [Options]\nDetailed options -h or --help'.format(__file__)
+    parser = ArgumentParser(description=desc)
+
+    print("Parsing Command Line Arguments...")
+    parser.add_argument('-b', choices = ["sample", "decode", "cells", "feeds"], type = str, dest = 'benchmark',
+                        default = 'sample', help = 'Benchmark to run')
+    parser.add_argument('-m', choices = ["seq2seq", "char"], type = str,
+                        dest = 'model', default = 'seq2seq', help = 'Type of model to run')
+    parser.add_argument('-c', type = str, dest = 'set_config', default='',
+                        help = 'Set hyperparameters')
+    parser.add_argument('-ckpt', dest='ckpt_dir', default='', type=str,
+                        help='Checkpoint directory to sample from (random weights if not set)')
+    parser.add_argument('-n', dest='num_tunes', default=1000, type=int, help='Number of tunes to sample')
+    parser.add_argument('-w', dest='warm_len', default=10, type=int, help='Warm start length')
+    parser.add_argument('-l', dest='max_length', default=100, type=int, help='Maximum length of every tune')
+    parser.add_argument('-t', dest='tolerance', default=1.5, type=float,
+                        help='Allowed ratio between the latest and the earliest latency per call')
+    parser.add_argument('-windows', dest='windows', default=[10, 25, 50, 100], type=int, nargs='+',
+                        help='Window sizes the char model is built with (decode benchmark)')
+    parser.add_argument('-steps', dest='num_steps', default=50, type=int,
+                        help='Training steps timed at every window size or cell (decode and cells benchmarks)')
+    parser.add_argument('-cell', dest='cell_type', default='lstm', choices=CELL_TYPES,
+                        help='Cell backend of the sample, decode and feeds benchmarks')
+    parser.add_argument('-cells', dest='cells', default=CELL_TYPES, choices=CELL_TYPES, nargs='+',
+                        help='Cell backends compared by the cells benchmark')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = parseCommandLineBenchmark()
+
+    if args.benchmark == 'sample':
+        benchmark_sample(args)
+    elif args.benchmark == 'decode':
+        benchmark_decode(args)
+    elif args.benchmark == 'cells':
+        benchmark_cells(args)
+    elif args.benchmark == 'feeds':
+        benchmark_feeds(args)
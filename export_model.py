@@ -0,0 +1,347 @@
+import os
+import json
+import time
+import shutil
+from argparse import ArgumentParser
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.framework import ops
+from tensorflow.python.framework import op_def_registry
+from tensorflow.python.framework import tensor_shape
+
+import run
+import reader
+from models import Config, CharRNN, Seq2SeqRNN, CELL_TYPES
+
+EXPORT_GRAPH = 'frozen_graph.pb'
+EXPORT_SIGNATURE = 'signature.json'
+EXPORT_HYPERPARAMETERS = 'hyperparameters.p'
+EXPORT_SCOPE = 'export/'
+QUANTIZE_MODES = ['none', 'float16', 'int8']
+
+# Attributes of the model kept in the exported graph, fetched by name once it is frozen
+EXPORT_TENSORS = {
+    'char': ['input_placeholder', 'label_placeholder', 'meta_placeholder', 'initial_state_placeholder',
+             'use_meta_placeholder', 'initial_hidden_placeholder', 'sequence_length_placeholder',
+             'reset_placeholder', 'warm_placeholder', 'warm_length_placeholder', 'temperature_placeholder',
+             'max_length_placeholder', 'logits_op', 'token_loss_op', 'prediction_op', 'sample_op',
+             'sample_length_op'],
+    'seq2seq': ['input_placeholder', 'label_placeholder', 'meta_placeholder', 'initial_state_placeholder',
+                'use_meta_placeholder', 'num_encode', 'num_decode', 'temperature_placeholder', 'token_loss_op', 'eval_prediction_op',
+                'sample_prediction_op', 'sample_length_op']
+}
+# Outputs the graph is pruned to, everything else (summaries, confusion matrix) is dropped
+EXPORT_OUTPUTS = {
+    'char': ['logits_op', 'token_loss_op', 'prediction_op', 'sample_op', 'sample_length_op'],
+    'seq2seq': ['token_loss_op', 'eval_prediction_op', 'sample_prediction_op', 'sample_length_op']
+}
+# (variable, axis of its rows or columns) of the embeddings and decode projections that get
+# quantized, int8 keeps one scale per row of the embeddings and per vocabulary column of the projections
+QUANTIZED_WEIGHTS = {
+    'char': [('char_embeddings', 0), ('char_embeddings_meta', 0), ('char_decode', 1)],
+    'seq2seq': [('Seq2Seq/embedding_matrix', 0), ('Seq2Seq/char_embeddings_meta', 0), ('Seq2Seq/weights', 1)]
+}
+# -weights all also quantizes every other weight matrix (cells, attention), one scale per output column
+QUANTIZED_SCOPES = ['projections', 'all']
+
+
+def const_node(name, value):
+    node = tf.NodeDef()
+    node.op = 'Const'
+    node.name = name
+    node.attr['dtype'].type = tf.as_dtype(value.dtype).as_datatype_enum
+    node.attr['value'].tensor.CopyFrom(tf.contrib.util.make_tensor_proto(value))
+    return node
+
+
+def op_node(op, name, inputs, attrs):
+    node = tf.NodeDef()
+    node.op = op
+    node.name = name
+    node.input.extend(inputs)
+    for key, dtype in attrs.iteritems():
+        node.attr[key].type = dtype.as_datatype_enum
+    return node
+
+
+def quantize_weights(graph_def, weights, mode):
+    """
+    Replaces the frozen float32 constants of @weights with float16 or int8 ones (@mode), and
+    the ops turning them back into float32 under the original name, so the rest of the graph is unchanged.
+    Returns the new graph and the largest absolute rounding error of every weight
+    """
+    if mode == 'none':
+        return graph_def, {}
+
+    channel_axis = dict(weights)
+    errors = {}
+    quantized = tf.GraphDef()
+    quantized.library.CopyFrom(graph_def.library)
+    quantized.versions.CopyFrom(graph_def.versions)
+    for node in graph_def.node:
+        if node.name not in channel_axis:
+            quantized.node.extend([node])
+            continue
+
+        value = tf.contrib.util.make_ndarray(node.attr['value'].tensor)
+        if mode == 'float16':
+            stored = value.astype(np.float16)
+            restored = stored.astype(np.float32)
+            quantized.node.extend([const_node(node.name + '/float16', stored),
+                                   op_node('Cast', node.name, [node.name + '/float16'],
+                                           {'SrcT': tf.float16, 'DstT': tf.float32})])
+        else:
+            # symmetric, one scale per row (embeddings) or column (projections)
+            reduce_axis = 1 - channel_axis[node.name]
+            scale = np.max(np.abs(value), axis=reduce_axis, keepdims=True) / 127.0
+            scale[scale == 0] = 1.0
+            stored = np.clip(np.round(value / scale), -127, 127).astype(np.int8)
+            scale = scale.astype(np.float32)
+            restored = stored.astype(np.float32) * scale
+            quantized.node.extend([const_node(node.name + '/int8', stored),
+                                   const_node(node.name + '/scale', scale),
+                                   op_node('Cast', node.name + '/dequantize', [node.name + '/int8'],
+                                           {'SrcT': tf.int8, 'DstT': tf.float32}),
+                                   op_node('Mul', node.name, [node.name + '/dequantize', node.name + '/scale'],
+                                           {'T': tf.float32})])
+        errors[node.name] = float(np.max(np.abs(restored - value)))
+
+    missing = set(channel_axis) - set(errors)
+    if missing:
+        raise ValueError('Weights to quantize not found in the graph: %s' % ', '.join(sorted(missing)))
+    return quantized, errors
+
+
+def export_model(args, quantize):
+    """
+    Restores the latest checkpoint of @args.ckpt_dir into the inference graph of @args.model,
+    freezes its variables and prunes it to the outputs of EXPORT_OUTPUTS, optionally quantizing
+    the weights of QUANTIZED_WEIGHTS (@quantize in QUANTIZE_MODES). Writes the graph, the
+    tensor names and the hyperparameters to @args.output_dir/@quantize
+    """
+    export_dir = os.path.join(args.output_dir, quantize)
+    vocabulary = run.build_vocabulary(run.music_map, args.model)
+    start_encode = vocabulary["<go>"] if args.model == 'seq2seq' else vocabulary["<start>"]
+    cell_type = args.cell_type or Config(args.set_config).cell_type
+
+    with tf.Graph().as_default() as graph:
+        # variable length windows, fixed batch (the LSTM states and the seq2seq <go> tokens are built with it)
+        curModel = run.build_model(args.model, None, None, args.batch_size, len(vocabulary), cell_type,
+                                   args.set_config, start_encode, vocabulary["<end>"], is_train=False)
+        # the outputs get a fixed name, the placeholders keep theirs
+        tensors = dict((attr, getattr(curModel, attr)) for attr in EXPORT_TENSORS[args.model] if hasattr(curModel, attr))
+        for attr in EXPORT_OUTPUTS[args.model]:
+            tensors[attr] = tf.identity(tensors[attr], name=EXPORT_SCOPE + attr)
+        outputs = [EXPORT_SCOPE + attr for attr in EXPORT_OUTPUTS[args.model]]
+        matrices = [var.op.name for var in tf.global_variables() if len(var.get_shape()) == 2]
+
+        with tf.Session(graph=graph, config=run.GPU_CONFIG) as session:
+            ckpt_path = tf.train.latest_checkpoint(args.ckpt_dir)
+            if ckpt_path is None:
+                raise IOError('No checkpoint found in %s' % args.ckpt_dir)
+            tf.train.Saver().restore(session, ckpt_path)
+            graph_def = tf.graph_util.convert_variables_to_constants(session, graph.as_graph_def(), outputs)
+            # functions of the graph (the seq2seq attention) and versions, dropped by convert_variables_to_constants
+            graph_def.library.CopyFrom(graph.as_graph_def().library)
+            graph_def.versions.CopyFrom(graph.as_graph_def().versions)
+
+    weights = QUANTIZED_WEIGHTS[args.model]
+    if args.weights == 'all':
+        weights = weights + [(name, 1) for name in matrices if name not in dict(weights)]
+    graph_def, errors = quantize_weights(graph_def, weights, quantize)
+    kept_nodes = set(node.name for node in graph_def.node)
+    signature = {'model': args.model, 'cell_type': cell_type, 'batch_size': args.batch_size,
+                 'vocab_size': len(vocabulary), 'quantize': quantize, 'checkpoint': ckpt_path,
+                 'quantized_weights': sorted(errors),
+                 'tensors': dict((attr, tensor.name) for attr, tensor in tensors.iteritems()
+                                 if tensor.op.name in kept_nodes)}
+
+    if not os.path.exists(export_dir):
+        os.makedirs(export_dir)
+    with open(os.path.join(export_dir, EXPORT_GRAPH), 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    with open(os.path.join(export_dir, EXPORT_SIGNATURE), 'w') as f:
+        json.dump(signature, f, indent=1, sort_keys=True)
+    if args.set_config:
+        shutil.copyfile(args.set_config, os.path.join(export_dir, EXPORT_HYPERPARAMETERS))
+
+    print "Exported {0} ({1} ops, {2} weights) to {3}".format(ckpt_path, len(graph_def.node), quantize, export_dir)
+    for name, error in sorted(errors.iteritems()):
+        print "  {0}: max rounding error {1:.2e}".format(name, error)
+    return export_dir
+
+
+class LibraryFunction(object):
+    """
+    A function of a saved graph library, with the fields a graph reads from its functions
+    """
+    def __init__(self, definition):
+        self.definition = definition
+        self.name = definition.signature.name
+        self.grad_func_name = None
+        self.python_grad_func = None
+
+
+def import_frozen_graph(graph_def):
+    """
+    Imports @graph_def into a new graph, with the functions of its library (the seq2seq
+    attention), which tf.import_graph_def leaves out in tensorflow 1.0
+    """
+    graph = tf.Graph()
+    op_dict = dict(op_def_registry.get_registered_ops())
+    with graph.as_default():
+        for function_def in graph_def.library.function:
+            name = function_def.signature.name
+            graph._add_function(LibraryFunction(function_def))
+            op_dict[name] = function_def.signature
+            # the calls to a function have no shape function, their outputs are left unknown
+            try:
+                ops.RegisterShape(name)(lambda op: [tensor_shape.unknown_shape()] * len(op.outputs))
+            except KeyError:
+                pass # registered by an earlier import
+        tf.import_graph_def(graph_def, name='', op_dict=op_dict)
+    return graph
+
+
+class FrozenModel(object):
+    """
+    An exported graph in its own session, with the tensors of the model it was exported from,
+    so that the feed helpers of utils_runtime and the evaluate/generate/sample code of the model run on it.
+    """
+    def __init__(self, export_dir):
+        with open(os.path.join(export_dir, EXPORT_SIGNATURE), 'r') as f:
+            signature = json.load(f)
+        hyperparam_path = os.path.join(export_dir, EXPORT_HYPERPARAMETERS)
+
+        self.model = signature['model']
+        self.model_class = Seq2SeqRNN if self.model == 'seq2seq' else CharRNN
+        self.cell_type = signature['cell_type']
+        self.config = Config(hyperparam_path if os.path.exists(hyperparam_path) else '')
+        self.config.batch_size = signature['batch_size']
+        self.config.vocab_size = signature['vocab_size']
+
+        graph_def = tf.GraphDef()
+        with open(os.path.join(export_dir, EXPORT_GRAPH), 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        self.graph = import_frozen_graph(graph_def)
+        self.graph.finalize()
+        for attr, name in signature['tensors'].iteritems():
+            setattr(self, attr, self.graph.get_tensor_by_name(name))
+        self.session = tf.Session(graph=self.graph, config=run.GPU_CONFIG)
+
+    def _feed_dict(self, feed_values):
+        return self.model_class._feed_dict.im_func(self, feed_values)
+
+    def evaluate(self, session, feed_values):
+        return self.model_class.evaluate.im_func(self, session, feed_values)
+
+    def generate(self, session, *args, **kwargs):
+        return CharRNN.generate.im_func(self, session, *args, **kwargs)
+
+    def sample(self, session, feed_values, temperatures=None):
+        return Seq2SeqRNN.sample.im_func(self, session, feed_values, temperatures)
+
+    def sample_sequences(self, session, feed_values, temperatures=None):
+        return Seq2SeqRNN.sample_sequences.im_func(self, session, feed_values, temperatures)
+
+
+def graph_size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)) if os.path.isdir(path) else 0
+
+
+def timed_evaluation(args, curModel, session, window_spec):
+    """
+    Scores -data twice, returns the accuracy, loss and perplexity, and the time of the second pass
+    (the first one warms up the session)
+    """
+    for rep in xrange(2):
+        start = time.time()
+        accuracy, loss, perplexity, _ = run.evaluate_split(args, curModel, session, args.data_dir, args.batch_size,
+                                                           window_spec, curModel.config.vocab_size)
+    return accuracy, loss, perplexity, time.time() - start
+
+
+def compare_exports(args):
+    """
+    Scores the -data split with the checkpoint and with every export of @args.quantize,
+    and prints the accuracy, loss and windows per second of each, and their size on disk.
+    """
+    if args.data_dir == '':
+        raise ValueError('-p compare scores the split given with -data')
+    config = Config(args.set_config)
+    window_spec = (config.stride_sz, config.window_sz, run.NN_TYPES[args.model], config.output_sz)
+    num_windows = reader.open_windows(args.data_dir, window_spec)['header']['num_windows'] \
+                    if (reader.is_song_store(args.data_dir) or reader.is_window_store(args.data_dir)) else None
+    vocabulary = run.build_vocabulary(run.music_map, args.model)
+    start_encode = vocabulary["<go>"] if args.model == 'seq2seq' else vocabulary["<start>"]
+    cell_type = args.cell_type or config.cell_type
+
+    results = []
+    with tf.Graph().as_default() as graph:
+        curModel = run.build_model(args.model, None, None, args.batch_size, len(vocabulary), cell_type,
+                                   args.set_config, start_encode, vocabulary["<end>"], is_train=False)
+        with tf.Session(graph=graph, config=run.GPU_CONFIG) as session:
+            ckpt_path = tf.train.latest_checkpoint(args.ckpt_dir)
+            tf.train.Saver().restore(session, ckpt_path)
+            ckpt_size = sum(os.path.getsize(os.path.join(args.ckpt_dir, f)) for f in os.listdir(args.ckpt_dir)
+                            if f.startswith(os.path.basename(ckpt_path) + '.'))
+            results.append(('checkpoint', ckpt_size) + timed_evaluation(args, curModel, session, window_spec))
+
+    for quantize in args.quantize:
+        export_dir = os.path.join(args.output_dir, quantize)
+        if not os.path.exists(os.path.join(export_dir, EXPORT_SIGNATURE)):
+            export_model(args, quantize)
+        frozen = FrozenModel(export_dir)
+        results.append((quantize, graph_size(export_dir)) + timed_evaluation(args, frozen, frozen.session, window_spec))
+        frozen.session.close()
+
+    base_accuracy = results[0][2]
+    print "{0:>12} {1:>10} {2:>10} {3:>10} {4:>10} {5:>12}".format('Graph', 'Size (kB)', 'Accuracy', 'Delta', 'Loss', 'Windows/s')
+    for name, size, accuracy, loss, perplexity, seconds in results:
+        throughput = '{0:.1f}'.format(num_windows / seconds) if num_windows else '-'
+        print "{0:>12} {1:>10.1f} {2:>10.5f} {3:>+10.5f} {4:>10.5f} {5:>12}".format(name, size / 1024.0, accuracy,
+                                                                                  accuracy - base_accuracy, loss, throughput)
+    return results
+
+
+def parseCommandLineExport():
+    desc = u'{0} [Args] [Options]\nDetailed options -h or --help'.format(__file__)
+    parser = ArgumentParser(description=desc)
+
+    print("Parsing Command Line Arguments...")
+    parser.add_argument('-p', choices = ["export", "compare"], type = str, dest = 'mode', default = 'export',
+                        help = 'export: freeze the checkpoint once per -q, compare: score -data with the checkpoint and the exports')
+    parser.add_argument('-m', choices = ["seq2seq", "char"], type = str,
+                        dest = 'model', default = 'char', help = 'Type of model to export')
+    parser.add_argument('-c', type = str, dest = 'set_config', default='',
+                        help = 'Hyperparameters the checkpoint was trained with')
+    parser.add_argument('-ckpt', dest='ckpt_dir', required=True, type=str, help='Checkpoint directory to export')
+    parser.add_argument('-o', dest='output_dir', required=True, type=str,
+                        help='Export directory, every quantization is written to a folder of its name')
+    parser.add_argument('-q', dest='quantize', default=['none'], choices=QUANTIZE_MODES, nargs='+',
+                        help='Storage of the embeddings and decode projection')
+    parser.add_argument('-weights', dest='weights', default='projections', choices=QUANTIZED_SCOPES,
+                        help='Weights quantized by -q: the embeddings and decode projection, or all the weight matrices')
+    parser.add_argument('-cell', dest='cell_type', default=None, choices=CELL_TYPES,
+                        help='Cell backend of the exported graph, the cell_type of the hyperparameters if not set')
+    parser.add_argument('-batch', dest='batch_size', default=run.EVAL_BATCH_SIZE, type=int,
+                        help='Batch size of the exported graph')
+    parser.add_argument('-data', dest='data_dir', default='', type=str, help='Split scored by -p compare')
+    parser.add_argument('-prefetch', dest='prefetch', default=2, type=int, help='Batches packed ahead by -p compare')
+    parser.add_argument('-prefetch_threads', dest='prefetch_threads', default=1, type=int,
+                        help='Threads packing the batches of -p compare')
+
+    args = parser.parse_args()
+    args.train = 'dev'
+    return args
+
+
+if __name__ == "__main__":
+    args = parseCommandLineExport()
+
+    if args.mode == 'export':
+        for quantize in args.quantize:
+            export_model(args, quantize)
+    elif args.mode == 'compare':
+        compare_exports(args)
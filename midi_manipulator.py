@@ -1,5 +1,6 @@
 import pretty_midi
 import os
+import subprocess
 from shutil import copy
 import numpy as np
 
@@ -236,17 +237,26 @@ def convertMidiAbcWorker(mapList):
 	fromFile = os.path.join(fromDir,filename)
 	toFile = os.path.join(toDir,filename.replace(fromStr,'')+toStr)
 
-	os.system('abcmidi_win32\\%s.exe "%s" -o "%s" -silent' %(binName,fromFile,toFile))
+	# am I being ran on a Windows machine ('nt'), or a linux machine('posix')?
+	if os.name=='nt':
+		binName = 'abcmidi_win32\\%s.exe' %binName
 
-def convertMidiAbc(fileDir, abc2midi):
+	# no shell, so file names with quotes or spaces are passed as they are
+	with open(os.devnull, 'w') as devnull:
+		subprocess.call([binName, fromFile, '-o', toFile, '-silent'], stdout=devnull, stderr=devnull)
+
+def convertMidiAbc(fileDir, abc2midi, numWorkers=8):
 	outputFolder = fileDir + ('_midi' if abc2midi else '_abc')
 	if not os.path.exists(outputFolder):
 		os.makedirs(outputFolder)
 
-	p = Pool(8)
+	p = Pool(numWorkers)
 	mapList = [(fname,fileDir,outputFolder,abc2midi) for fname in os.listdir(fileDir)]
 
-	p.map(convertMidiAbcWorker, mapList)
+	for _ in p.imap_unordered(convertMidiAbcWorker, mapList, chunksize=16):
+		pass
+	p.close()
+	p.join()
 	
 if __name__ == "__main__":
 	convertMidiAbc('the_session', abc2midi=True)
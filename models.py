@@ -9,6 +9,7 @@ if SHERLOCK:
 	from tensorflow.contrib.metrics import confusion_matrix as tf_confusion_matrix
 else:
 	from tensorflow.contrib import rnn
+	from tensorflow.contrib.rnn.python.ops import lstm_ops
 
 
 from tensorflow.contrib import seq2seq
@@ -22,6 +23,106 @@ import math
 import utils_hyperparam
 
 
+def project_sequence(outputs, weights, bias):
+	"""
+	Applies the dense layer (@weights, @bias) to every timestep of @outputs [batch, time, hidden],
+	as a single [batch*time, hidden] x [hidden, vocab] matmul whatever the number of timesteps
+	"""
+	hidden_size = outputs.get_shape()[-1].value
+	vocab_size = weights.get_shape()[-1].value
+	outputs_shape = tf.shape(outputs)
+
+	logits = tf.matmul(tf.reshape(outputs, [-1, hidden_size]), weights) + bias
+	logits = tf.reshape(logits, tf.stack([outputs_shape[0], outputs_shape[1], vocab_size]))
+	logits.set_shape(outputs.get_shape()[:2].concatenate([vocab_size]))
+	return logits
+
+
+# Recurrent cell backends. The LSTM ones all create the variables of BasicLSTMCell, under its
+# scope, so a checkpoint trained with any of them can be restored with any other
+CELL_TYPES = ['rnn', 'gru', 'lstm', 'lstm_block', 'lstm_fused']
+LSTM_CELL_TYPES = ['lstm', 'lstm_block', 'lstm_fused']
+LSTM_SCOPE = 'basic_lstm_cell'
+# Turns off the cell state clipping of the block kernels
+NO_CELL_CLIP = -1.0
+# Sampling temperature of the Seq2Seq decoder when none is fed
+SEQ2SEQ_TEMPERATURE = 0.5
+
+
+class BlockLSTMCell(rnn.RNNCell):
+	"""
+	One LSTMBlockCell kernel per step, with the state tuple and the variables of BasicLSTMCell.
+	LSTMBlockCell itself clips the cell state to [-3, 3], which BasicLSTMCell does not.
+	"""
+	def __init__(self, num_units, forget_bias=1.0):
+		self._num_units = num_units
+		self._forget_bias = forget_bias
+
+	@property
+	def state_size(self):
+		return rnn.LSTMStateTuple(self._num_units, self._num_units)
+
+	@property
+	def output_size(self):
+		return self._num_units
+
+	def __call__(self, inputs, state, scope=None):
+		with tf.variable_scope(LSTM_SCOPE):
+			input_size = inputs.get_shape()[-1].value
+			weights = tf.get_variable('weights', [input_size + self._num_units, 4*self._num_units])
+			biases = tf.get_variable('biases', [4*self._num_units], initializer=tf.constant_initializer(0.0))
+			no_peephole = tf.zeros([self._num_units])
+			_, state_c, _, _, _, _, state_h = lstm_ops._lstm_block_cell(inputs, state[0], state[1], weights, biases,
+										wci=no_peephole, wco=no_peephole, wcf=no_peephole, forget_bias=self._forget_bias,
+										cell_clip=NO_CELL_CLIP, use_peephole=False)
+		return state_h, rnn.LSTMStateTuple(state_c, state_h)
+
+
+def create_cell(cell_type, num_units):
+	"""
+	Returns a single step cell of @cell_type (one of CELL_TYPES). 'lstm_fused' runs
+	whole sequences with dynamic_layers, its cell is only used to step (sampling, decoders).
+	"""
+	if cell_type == 'rnn':
+		return rnn.BasicRNNCell(num_units)
+	elif cell_type == 'gru':
+		return rnn.GRUCell(num_units)
+	elif cell_type == 'lstm':
+		return rnn.BasicLSTMCell(num_units)
+	elif cell_type in ('lstm_block', 'lstm_fused'):
+		if SHERLOCK:
+			raise ValueError('The %s cell needs tensorflow 1.0 or later' % cell_type)
+		return BlockLSTMCell(num_units)
+	raise ValueError('Unknown cell type %s, expected one of %s' % (cell_type, ', '.join(CELL_TYPES)))
+
+
+def dynamic_layers(cell_type, rnn_model, inputs, sequence_length, initial_state, keep_prob=1.0, time_major=False):
+	"""
+	Same as tf.nn.dynamic_rnn over the layers of @rnn_model. With 'lstm_fused' every layer is
+	instead run over the whole sequence by one LSTMBlockFusedCell op, under the variables of the
+	MultiRNNCell, with @keep_prob dropout between the layers (the DropoutWrapper of @rnn_model)
+	"""
+	if cell_type != 'lstm_fused':
+		return tf.nn.dynamic_rnn(rnn_model, inputs, sequence_length=sequence_length, dtype=tf.float32,
+								 initial_state=initial_state, time_major=time_major)
+
+	outputs = inputs if time_major else tf.transpose(inputs, [1, 0, 2])
+	final_state = []
+	with tf.variable_scope('rnn'):
+		for idx, layer_state in enumerate(initial_state):
+			num_units = layer_state[0].get_shape()[-1].value
+			with tf.variable_scope('multi_rnn_cell/cell_%d' % idx):
+				outputs, (state_c, state_h) = rnn.LSTMBlockFusedCell(num_units, cell_clip=NO_CELL_CLIP)(outputs, initial_state=tuple(layer_state),
+											dtype=tf.float32, sequence_length=sequence_length, scope=LSTM_SCOPE)
+			if keep_prob < 1.0:
+				outputs = tf.nn.dropout(outputs, keep_prob)
+			final_state.append(rnn.LSTMStateTuple(state_c, state_h))
+
+	if not time_major:
+		outputs = tf.transpose(outputs, [1, 0, 2])
+	return outputs, tuple(final_state)
+
+
 class Config(object):
 
 	def setIfNotSet(self, attrStr, val):
@@ -54,10 +155,17 @@ class Config(object):
 		self.setIfNotSet('num_meta', 7)
 		self.setIfNotSet('num_layers', 2)
 		self.setIfNotSet('keep_prob', 0.6)
+		# One of CELL_TYPES, the -cell flag of run.py overrides it
+		self.setIfNotSet('cell_type', 'lstm')
 
 		# Only for CBOW model
 		self.setIfNotSet('embed_size', 32)
 
+		# Only for datasets read from a song store (see reader.song_window_index)
+		self.setIfNotSet('stride_sz', 25)
+		self.setIfNotSet('window_sz', 25)
+		self.setIfNotSet('output_sz', 25)
+
 		# Only for Seq2Seq Attention Models
 		self.setIfNotSet('num_encode', 8)
 		self.setIfNotSet('num_decode', 4)
@@ -111,6 +219,7 @@ class CBOW(object):
 	def metrics(self):
 		last_axis = len(self.probabilities_op.get_shape().as_list())
 		self.prediction_op = tf.to_int32(tf.argmax(self.probabilities_op, axis=last_axis-1))
+		self.token_loss_op = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=self.logits_op, labels=self.label_placeholder)
 		difference = self.label_placeholder - self.prediction_op
 		zero = tf.constant(0, dtype=tf.int32)
 		boolean_difference = tf.cast(tf.equal(difference, zero), tf.float64)
@@ -156,6 +265,16 @@ class CBOW(object):
 		return logits, np.zeros((1, 1)) # dummy value
 
 
+	def evaluate(self, session, feed_values):
+		"""
+		Forward pass only, returns the per character losses, predictions and labels, batch major
+		"""
+		feed_dict = self._feed_dict(feed_values)
+
+		token_loss, prediction = session.run([self.token_loss_op, self.prediction_op], feed_dict=feed_dict)
+		return token_loss, prediction, np.asarray(feed_values[1])
+
+
 
 class CharRNN(object):
 
@@ -180,15 +299,14 @@ class CharRNN(object):
 		self.meta_placeholder = tf.placeholder(tf.int32, shape=[None, self.config.num_meta], name='Meta')
 		self.use_meta_placeholder = tf.placeholder(tf.bool, name='State_Initialization_Bool')
 
-		if cell_type == 'rnn':
-			self.cell = rnn.BasicRNNCell(self.config.hidden_size)
-			self.initial_state_placeholder = tf.placeholder(tf.float32, shape=[None, self.config.hidden_size], name="Initial_State")
-		elif cell_type == 'gru':
-			self.cell = rnn.GRUCell(self.config.hidden_size)
+		self.cell = create_cell(cell_type, self.config.hidden_size)
+		if cell_type not in LSTM_CELL_TYPES:
 			self.initial_state_placeholder = tf.placeholder(tf.float32, shape=[None, self.config.hidden_size], name="Initial_State")
-		elif cell_type == 'lstm':
-			self.cell = rnn.BasicLSTMCell(self.config.hidden_size)
+		else:
 			self.initial_state_placeholder = tf.placeholder(tf.float32, shape=[self.config.num_layers, None, self.config.hidden_size], name="Initial_State")
+			# Hidden half of the LSTM state, only fed when carrying the state between sampling steps
+			self.initial_hidden_placeholder = tf.placeholder_with_default(np.zeros((self.config.num_layers, batch_size, self.config.hidden_size), dtype=np.float32),
+											shape=[self.config.num_layers, None, self.config.hidden_size], name="Initial_Hidden")
 
 		print "Completed Initializing the Char RNN Model using a {0} cell".format(cell_type.upper())
 
@@ -204,6 +322,9 @@ class CharRNN(object):
 										 0, 10, dtype=tf.float32, seed=3), name='char_embeddings')
 		true_inputs = self.input_placeholder if (self.gan_inputs == None) else self.gan_inputs
 		self.embeddings_var = embeddings_var
+		# Number of real characters of every row, the rest is padding (whole windows when not fed)
+		self.sequence_length_placeholder = tf.placeholder_with_default(tf.fill(tf.shape(true_inputs)[:1], tf.shape(true_inputs)[1]),
+											shape=[None], name='Sequence_Length')
 		embeddings = tf.nn.embedding_lookup(embeddings_var, true_inputs)
 
 		# Embedding lookup for Metadata
@@ -215,40 +336,130 @@ class CharRNN(object):
 
 		# Putting all the word embeddings together and then appending the numerical constants at the end of the word embeddings
 		embeddings_meta = tf.concat([embeddings_meta_flat, tf.to_float(self.meta_placeholder[:, 5:])], axis=-1)
+		self.embeddings_meta = embeddings_meta
+
+		# Rows starting a new song when carrying the state, they start from the metadata again
+		self.reset_placeholder = tf.placeholder_with_default(tf.fill(tf.shape(self.meta_placeholder)[:1], False),
+											shape=[None], name='Reset_State')
 
 		print embeddings_meta.get_shape().as_list()
-		if self.cell_type == 'lstm':
+		if self.cell_type in LSTM_CELL_TYPES:
 			initial_added = tf.cond(self.use_meta_placeholder,
 									lambda: [embeddings_meta for layer in xrange(self.config.num_layers)],
 									lambda: tf.unstack(self.initial_state_placeholder, axis=0)) # [self.initial_state_placeholder[layer] for layer in xrange(self.config.num_layers)])
 			[initial_added[idx].set_shape([self.config.batch_size, self.config.hidden_size]) for idx in xrange(self.config.num_layers)]
-			initial_tuple = tuple([rnn.LSTMStateTuple(initial_added[idx], np.zeros((self.config.batch_size, self.config.hidden_size), dtype=np.float32)) for idx in xrange(self.config.num_layers)])
+			initial_hidden = tf.unstack(self.initial_hidden_placeholder, axis=0)
+			[initial_hidden[idx].set_shape([self.config.batch_size, self.config.hidden_size]) for idx in xrange(self.config.num_layers)]
+			initial_added = [tf.where(self.reset_placeholder, embeddings_meta, added) for added in initial_added]
+			initial_hidden = [tf.where(self.reset_placeholder, tf.zeros_like(hidden), hidden) for hidden in initial_hidden]
+			initial_tuple = tuple([rnn.LSTMStateTuple(initial_added[idx], initial_hidden[idx]) for idx in xrange(self.config.num_layers)])
 		else:
 			initial_added = tf.cond(self.use_meta_placeholder,
 									lambda: embeddings_meta,
 									lambda: self.initial_state_placeholder)
+			initial_added = tf.where(self.reset_placeholder, embeddings_meta, initial_added)
 			initial_tuple = (initial_added, np.zeros((self.config.batch_size, self.config.hidden_size), dtype=np.float32))
 
-		rnn_output, self.state_op = tf.nn.dynamic_rnn(rnn_model, embeddings, dtype=tf.float32, initial_state=initial_tuple)
+		rnn_output, self.state_op = dynamic_layers(self.cell_type, rnn_model, embeddings, self.sequence_length_placeholder,
+													initial_tuple, keep_prob=(self.config.keep_prob if is_train else 1.0))
 
 		decode_var = tf.Variable(tf.random_uniform([self.config.hidden_size, self.config.vocab_size],
 										 0, 10, dtype=tf.float32, seed=3), name='char_decode')
 		decode_bias = tf.Variable(tf.random_uniform([self.config.vocab_size],
 										 0, 10, dtype=tf.float32, seed=3), name='char_decode_bias')
-		decode_list = []
-		for i in xrange(self.input_size):
-			decode_list.append(tf.matmul(rnn_output[:, i, :], decode_var) + decode_bias)
-
-		self.logits_op = tf.stack(decode_list, axis=1)
+		self.logits_op = project_sequence(rnn_output, decode_var, decode_bias)
+		self.mask_op = tf.sequence_mask(self.sequence_length_placeholder, tf.shape(self.label_placeholder)[1], dtype=tf.float32)
 		self.rnn_output = rnn_output
 		self.probabilities_op = tf.nn.softmax(self.logits_op)
+		self.rnn_model = rnn_model
+		self.decode_var = decode_var
+		self.decode_bias = decode_bias
+
+		if not is_train:
+			self.create_sampler()
 
 		print("Built the Char RNN Model...")
 
 
+	def create_sampler(self, end_encode=None):
+		"""
+		Builds the in-graph sampling loop, sharing the weights of the trained cell.
+		Every row is fed its own (padded) warm start, then its own samples, until it emits <end>.
+		@end_encode - <end> encoding, the last character of the vocabulary by default
+		"""
+		if end_encode is None:
+			end_encode = self.config.vocab_size - 1
+
+		self.warm_placeholder = tf.placeholder(tf.int32, shape=[None, None], name='Sample_Warm')
+		self.warm_length_placeholder = tf.placeholder(tf.int32, shape=[None], name='Sample_Warm_Length')
+		self.temperature_placeholder = tf.placeholder(tf.float32, shape=[None], name='Sample_Temperature')
+		self.max_length_placeholder = tf.placeholder_with_default(100, shape=[], name='Sample_Max_Length')
+
+		# Same initial state as create_model with use_meta set, without the fixed batch size
+		zero_state = tf.zeros_like(self.embeddings_meta)
+		if self.cell_type in LSTM_CELL_TYPES:
+			initial_state = tuple([rnn.LSTMStateTuple(self.embeddings_meta, zero_state) for layer in xrange(self.config.num_layers)])
+		else:
+			initial_state = (self.embeddings_meta, zero_state)
+
+		batch = tf.shape(self.warm_placeholder)[0]
+		last_warm = tf.shape(self.warm_placeholder)[1] - 1
+		# Rows at temperature <= 0 take the arg max
+		greedy = tf.less_equal(self.temperature_placeholder, 0)
+		temperature = tf.where(greedy, tf.ones_like(self.temperature_placeholder), self.temperature_placeholder)
+
+		def condition(time, inputs, state, finished, lengths, generated):
+			return tf.logical_and(time < self.max_length_placeholder, tf.logical_not(tf.reduce_all(finished)))
+
+		def body(time, inputs, state, finished, lengths, generated):
+			in_warm = time < self.warm_length_placeholder
+			inputs = tf.where(in_warm, self.warm_placeholder[:, tf.minimum(time, last_warm)], inputs)
+			inputs = tf.where(finished, tf.fill([batch], end_encode), inputs)
+			generated = generated.write(time, inputs)
+			lengths = tf.where(finished, lengths, tf.fill([batch], time + 1))
+			finished = tf.logical_or(finished, tf.logical_and(tf.logical_not(in_warm), tf.equal(inputs, end_encode)))
+
+			# Same variable scope as dynamic_rnn in create_model
+			with tf.variable_scope('RNN' if SHERLOCK else 'rnn', reuse=True):
+				output, state = self.rnn_model(tf.nn.embedding_lookup(self.embeddings_var, inputs), state)
+			logits = tf.matmul(output, self.decode_var) + self.decode_bias
+
+			sampled = tf.to_int32(tf.reshape(tf.multinomial(logits / tf.expand_dims(temperature, 1), 1), [-1]))
+			inputs = tf.where(greedy, tf.to_int32(tf.argmax(logits, axis=-1)), sampled)
+			return time + 1, inputs, state, finished, lengths, generated
+
+		loop_vars = [tf.constant(0), tf.fill([batch], end_encode), initial_state,
+					 tf.zeros([batch], dtype=tf.bool), tf.zeros([batch], dtype=tf.int32),
+					 tf.TensorArray(tf.int32, size=0, dynamic_size=True)]
+		_, _, _, _, lengths, generated = tf.while_loop(condition, body, loop_vars)
+
+		self.sample_op = tf.transpose(generated.stack(), [1, 0], name='sampled_sequences')
+		self.sample_length_op = lengths
+
+
+	def generate(self, session, warm_batch, warm_lengths, meta_batch, temperatures, max_length=100):
+		"""
+		Samples every row in a single session.run (see create_sampler)
+		@warm_batch - [batch, max warm length] warm start encodings, padded at the end
+		Returns the generated sequences of every row, warm start included
+		"""
+		feed_dict = {
+			self.warm_placeholder: warm_batch,
+			self.warm_length_placeholder: warm_lengths,
+			self.meta_placeholder: meta_batch,
+			self.temperature_placeholder: temperatures,
+			self.max_length_placeholder: max_length
+		}
+
+		sequences, lengths = session.run([self.sample_op, self.sample_length_op], feed_dict=feed_dict)
+		return [list(sequence[:length]) for sequence, length in zip(sequences, lengths)]
+
+
 	def train(self, max_norm=5, op='adam'):
 		# with tf.variable_scope("CharRNN") as scope:
-		self.loss_op = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(logits=self.logits_op, labels=self.label_placeholder))
+		# Mean over the real characters only
+		token_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=self.logits_op, labels=self.label_placeholder)
+		self.loss_op = tf.reduce_sum(token_loss*self.mask_op) / tf.reduce_sum(self.mask_op)
 		tf.summary.scalar('Loss', self.loss_op)
 		tvars = tf.trainable_variables()
 
@@ -264,18 +475,23 @@ class CharRNN(object):
 		# Same function, did not make a general one b/c need to store _ops within class
 		last_axis = len(self.probabilities_op.get_shape().as_list())
 		self.prediction_op = tf.to_int32(tf.argmax(self.probabilities_op, axis=last_axis-1))
+		self.token_loss_op = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=self.logits_op, labels=self.label_placeholder)
 		difference = self.label_placeholder - self.prediction_op
 		zero = tf.constant(0, dtype=tf.int32)
 		boolean_difference = tf.cast(tf.equal(difference, zero), tf.float64)
-		self.accuracy_op = tf.reduce_mean(boolean_difference)
+		mask = tf.cast(self.mask_op, tf.float64)
+		self.accuracy_op = tf.reduce_sum(boolean_difference*mask) / tf.reduce_sum(mask)
 		tf.summary.scalar('Accuracy', self.accuracy_op)
 
 		self.summary_op = tf.summary.merge_all()
 
+		# Padding is left out of the confusion matrix
+		real_labels = tf.boolean_mask(tf.reshape(self.label_placeholder, [-1]), tf.reshape(self.mask_op > 0, [-1]))
+		real_predictions = tf.boolean_mask(tf.reshape(self.prediction_op, [-1]), tf.reshape(self.mask_op > 0, [-1]))
 		if SHERLOCK:
-			self.confusion_matrix = tf_confusion_matrix(tf.reshape(self.label_placeholder, [-1]), tf.reshape(self.prediction_op, [-1]), num_classes=self.config.vocab_size, dtype=tf.int32)
+			self.confusion_matrix = tf_confusion_matrix(real_labels, real_predictions, num_classes=self.config.vocab_size, dtype=tf.int32)
 		else:
-			self.confusion_matrix = tf.confusion_matrix(tf.reshape(self.label_placeholder, [-1]), tf.reshape(self.prediction_op, [-1]), num_classes=self.config.vocab_size, dtype=tf.int32)
+			self.confusion_matrix = tf.confusion_matrix(real_labels, real_predictions, num_classes=self.config.vocab_size, dtype=tf.int32)
 
 
 	def _feed_dict(self, feed_values):
@@ -293,6 +509,16 @@ class CharRNN(object):
 			self.use_meta_placeholder: use_meta_batch
 		}
 
+		# Optional hidden state (LSTM only), defaults to zeros when not fed
+		if len(feed_values) > 5 and feed_values[5] is not None:
+			feed_dict[self.initial_hidden_placeholder] = feed_values[5]
+		# Optional length of every row, whole rows when not fed
+		if len(feed_values) > 6 and feed_values[6] is not None:
+			feed_dict[self.sequence_length_placeholder] = feed_values[6]
+		# Optional rows restarting from the metadata, none when not fed
+		if len(feed_values) > 7 and feed_values[7] is not None:
+			feed_dict[self.reset_placeholder] = feed_values[7]
+
 		return feed_dict
 
 
@@ -300,9 +526,12 @@ class CharRNN(object):
 		feed_dict = self._feed_dict(feed_values)
 
 		if args.train == "train":
-			_, summary, loss, probabilities, prediction, accuracy, confusion_matrix = session.run([self.train_op, self.summary_op, self.loss_op, self.probabilities_op, self.prediction_op, self.accuracy_op, self.confusion_matrix], feed_dict=feed_dict)
+			_, summary, loss, probabilities, prediction, accuracy, confusion_matrix, state = session.run([self.train_op, self.summary_op, self.loss_op, self.probabilities_op, self.prediction_op, self.accuracy_op, self.confusion_matrix, self.state_op], feed_dict=feed_dict)
 		else: # Sample case not necessary b/c function will only be called during normal runs
-			summary, loss, probabilities, prediction, accuracy, confusion_matrix = session.run([self.summary_op, self.loss_op, self.probabilities_op, self.prediction_op, self.accuracy_op, self.confusion_matrix], feed_dict=feed_dict)
+			summary, loss, probabilities, prediction, accuracy, confusion_matrix, state = session.run([self.summary_op, self.loss_op, self.probabilities_op, self.prediction_op, self.accuracy_op, self.confusion_matrix, self.state_op], feed_dict=feed_dict)
+
+		# Final state of every row, fed back as the initial state of the next batch by stateful training
+		self.final_state = state
 
 		print "Average accuracy per batch {0}".format(accuracy)
 		print "Batch Loss: {0}".format(loss)
@@ -319,6 +548,16 @@ class CharRNN(object):
 		return logits, state
 
 
+	def evaluate(self, session, feed_values):
+		"""
+		Forward pass only, returns the per character losses, predictions and labels, batch major
+		"""
+		feed_dict = self._feed_dict(feed_values)
+
+		token_loss, prediction = session.run([self.token_loss_op, self.prediction_op], feed_dict=feed_dict)
+		return token_loss, prediction, np.asarray(feed_values[1])
+
+
 class CharRNNScope(object):
 
 	def __init__(self, input_size, label_size, batch_size, vocab_size, cell_type, hyperparam_path, gan_inputs=None):
@@ -342,14 +581,10 @@ class CharRNNScope(object):
 			self.meta_placeholder = tf.placeholder(tf.int32, shape=[None, self.config.num_meta], name='Meta')
 			self.use_meta_placeholder = tf.placeholder(tf.bool, name='State_Initialization_Bool')
 
-			if cell_type == 'rnn':
-				self.cell = rnn.BasicRNNCell(self.config.hidden_size)
-				self.initial_state_placeholder = tf.placeholder(tf.float32, shape=[None, self.config.hidden_size], name="Initial_State")
-			elif cell_type == 'gru':
-				self.cell = rnn.GRUCell(self.config.hidden_size)
+			self.cell = create_cell(cell_type, self.config.hidden_size)
+			if cell_type not in LSTM_CELL_TYPES:
 				self.initial_state_placeholder = tf.placeholder(tf.float32, shape=[None, self.config.hidden_size], name="Initial_State")
-			elif cell_type == 'lstm':
-				self.cell = rnn.BasicLSTMCell(self.config.hidden_size)
+			else:
 				self.initial_state_placeholder = tf.placeholder(tf.float32, shape=[self.config.num_layers, None, self.config.hidden_size], name="Initial_State")
 
 			print "Completed Initializing the Char RNN Model using a {0} cell".format(cell_type.upper())
@@ -379,7 +614,7 @@ class CharRNNScope(object):
 			embeddings_meta = tf.concat([embeddings_meta_flat, tf.to_float(self.meta_placeholder[:, 5:])], axis=-1)
 
 			print embeddings_meta.get_shape().as_list()
-			if self.cell_type == 'lstm':
+			if self.cell_type in LSTM_CELL_TYPES:
 				initial_added = tf.cond(self.use_meta_placeholder,
 										lambda: [embeddings_meta for layer in xrange(self.config.num_layers)],
 										lambda: tf.unstack(self.initial_state_placeholder, axis=0)) # [self.initial_state_placeholder[layer] for layer in xrange(self.config.num_layers)])
@@ -397,11 +632,7 @@ class CharRNNScope(object):
 											 0, 10, dtype=tf.float32, seed=3), name='char_decode')
 			decode_bias = tf.Variable(tf.random_uniform([self.config.vocab_size],
 											 0, 10, dtype=tf.float32, seed=3), name='char_decode_bias')
-			decode_list = []
-			for i in xrange(self.input_size):
-				decode_list.append(tf.matmul(rnn_output[:, i, :], decode_var) + decode_bias)
-
-			self.logits_op = tf.stack(decode_list, axis=1)
+			self.logits_op = project_sequence(rnn_output, decode_var, decode_bias)
 			self.rnn_output = rnn_output
 			self.probabilities_op = tf.nn.softmax(self.logits_op)
 
@@ -506,18 +737,19 @@ class Seq2SeqRNN(object):
 		self.use_meta_placeholder = tf.placeholder(tf.bool, name='State_Initialization_Bool')
 		self.num_encode = tf.placeholder(tf.int32, shape=(None,), name='Num_encode')
 		self.num_decode = tf.placeholder(tf.int32, shape=(None,),  name='Num_decode')
-
-		if cell_type == 'rnn':
-			self.encoder_cell = rnn.BasicRNNCell(self.config.hidden_size)
-			self.decoder_cell = rnn.BasicRNNCell(2*self.config.hidden_size)
+		# Sampling temperature of every row, rows at temperature <= 0 take the arg max
+		self.temperature_placeholder = tf.placeholder_with_default(tf.constant(SEQ2SEQ_TEMPERATURE, shape=[self.config.batch_size]),
+																   shape=[self.config.batch_size], name='Sample_Temperature')
+
+		if cell_type not in LSTM_CELL_TYPES:
+			# the decoder starts from the encoder state, so it has the same size
+			self.encoder_cell = create_cell(cell_type, self.config.hidden_size)
+			self.decoder_cell = create_cell(cell_type, self.config.hidden_size)
 			self.initial_state_placeholder = tf.placeholder(tf.float32, shape=[None, self.config.hidden_size], name="Initial_State")
-		elif cell_type == 'gru':
-			self.encoder_cell = rnn.GRUCell(self.config.hidden_size)
-			self.decoder_cell = rnn.GRUCell(2*self.config.hidden_size)
-			self.initial_state_placeholder = tf.placeholder(tf.float32, shape=[None, self.config.hidden_size], name="Initial_State")
-		elif cell_type == 'lstm':
-			self.encoder_cell = rnn.BasicLSTMCell(self.config.hidden_size)
-			self.decoder_cell = rnn.BasicLSTMCell(self.config.hidden_size)
+		else:
+			# 'lstm_fused' only fuses the encoder, the decoder steps with the same kernel
+			self.encoder_cell = create_cell(cell_type, self.config.hidden_size)
+			self.decoder_cell = create_cell(cell_type, self.config.hidden_size)
 			self.initial_state_placeholder = tf.placeholder(tf.float32, shape=[self.config.num_layers, None, self.config.hidden_size], name="Initial_State")
 
 		print "Completed Initializing the Seq2Seq RNN Model using a {0} cell".format(cell_type.upper())
@@ -546,11 +778,12 @@ class Seq2SeqRNN(object):
 
 			# self.decoder_train_inputs = self.label_placeholder[:,:self.input_size-1]
 			self.go_token = tf.constant(self.config.vocab_size-1, dtype=tf.int32, shape=[1, self.config.batch_size])
-			self.decoder_train_inputs = tf.concat([self.go_token, self.label_placeholder[:self.input_size-1, :]], axis=0)
+			self.decoder_train_inputs = tf.concat([self.go_token, self.label_placeholder[:-1, :]], axis=0)
 
 			self.decoder_train_targets = self.label_placeholder
 
-			self.loss_weights = tf.ones([self.config.batch_size, self.input_size], dtype=tf.float32, name="loss_weights")
+			# Only the first num_decode characters of every row are decoded, the rest is padding
+			self.loss_weights = tf.sequence_mask(self.num_decode, tf.shape(self.label_placeholder)[0], dtype=tf.float32, name="loss_weights")
 			sqrt3 = math.sqrt(3)
 			initializer = tf.random_uniform_initializer(-sqrt3, sqrt3)
 
@@ -574,7 +807,7 @@ class Seq2SeqRNN(object):
 			embeddings_meta = tf.concat([embeddings_meta_flat, tf.to_float(self.meta_placeholder[:, 5:])], axis=-1)
 
 			# Create initial_state
-			if self.cell_type == 'lstm':
+			if self.cell_type in LSTM_CELL_TYPES:
 				initial_added = tf.cond(self.use_meta_placeholder,
 										lambda: [embeddings_meta for layer in xrange(self.config.num_layers)],
 										lambda: tf.unstack(self.initial_state_placeholder, axis=0)) # [self.initial_state_placeholder[layer] for layer in xrange(self.config.num_layers)])
@@ -587,8 +820,8 @@ class Seq2SeqRNN(object):
 				initial_tuple = (initial_added, np.zeros((self.config.batch_size, self.config.hidden_size), dtype=np.float32))
 
 			if not self.config.bidirectional:
-				self.encoder_outputs, self.encoder_state = tf.nn.dynamic_rnn(cell=self.encoder_cell, inputs=self.encoder_embedded,
-									  sequence_length=self.num_encode,time_major=True, dtype=tf.float32, initial_state=initial_tuple)
+				self.encoder_outputs, self.encoder_state = dynamic_layers(self.cell_type, self.encoder_cell, self.encoder_embedded,
+									  self.num_encode, initial_tuple, keep_prob=(self.config.keep_prob if is_train else 1.0), time_major=True)
 			else:
 				((encoder_fw_outputs,encoder_bw_outputs),\
 				(encoder_fw_state, encoder_bw_state)) = tf.nn.bidirectional_dynamic_rnn(cell_fw=self.encoder_cell,
@@ -613,9 +846,11 @@ class Seq2SeqRNN(object):
 			# print type(self.encoder_state)
 			attention_states = tf.transpose(self.encoder_outputs, [1, 0, 2])
 
+			# Padded encoder steps (rows shorter than num_encode's max) are masked out of the attention
 			attention_keys, attention_values, attention_score_fn, \
-					attention_construct_fn = seq2seq.prepare_attention( attention_states=attention_states,
-										attention_option=self.attention_option, num_units=self.config.hidden_size)
+					attention_construct_fn = utils_models.prepare_masked_attention( attention_states=attention_states,
+										attention_option=self.attention_option, num_units=self.config.hidden_size,
+										attention_length=self.num_encode)
 
 			decoder_fn_train = seq2seq.attention_decoder_fn_train( encoder_state=self.encoder_state,
 						attention_keys=attention_keys, attention_values=attention_values,
@@ -632,7 +867,7 @@ class Seq2SeqRNN(object):
 						attention_keys=attention_keys, attention_values=attention_values, attention_score_fn=attention_score_fn,
 						attention_construct_fn=attention_construct_fn, embeddings=self.embedding_matrix,
 						start_of_sequence_id=self.start_encode, end_of_sequence_id=self.end_encode,
-						maximum_length=tf.reduce_max(self.num_decode) + 3, num_decoder_symbols=self.config.vocab_size, temperature=0.5)
+						maximum_length=tf.reduce_max(self.num_decode) + 3, num_decoder_symbols=self.config.vocab_size, temperature=self.temperature_placeholder)
 
 			self.decoder_outputs_train, self.decoder_state_train, \
 			self.decoder_context_state_train =  seq2seq.dynamic_rnn_decoder( cell=self.decoder_cell,
@@ -651,7 +886,13 @@ class Seq2SeqRNN(object):
 					decoder_fn=decoder_fn_inference, time_major=True, scope=scope)
 
 
-			self.decoder_prediction_inference = tf.argmax(self.decoder_logits_inference, axis=-1, name='decoder_prediction_inference')
+			# The sampled characters, not the arg max of the logits
+			self.decoder_prediction_inference = tf.identity(self.decoder_context_state_inference.stack(), name='decoder_prediction_inference')
+			# Batch major predictions for sampling, built once so sample() never adds to the graph
+			self.sample_prediction_op = tf.transpose(self.decoder_prediction_inference, [1, 0], name='sample_prediction')
+			# Rows that are done only emit zero logits until the whole batch is
+			self.sample_length_op = tf.reduce_sum(tf.to_int32(tf.reduce_any(tf.not_equal(self.decoder_logits_inference, 0), axis=-1)),
+												  axis=0, name='sample_length')
 
 			print("Built the Seq2Seq RNN Model...")
 
@@ -673,18 +914,27 @@ class Seq2SeqRNN(object):
 
 	def metrics(self):
 		# Same function, did not make a general one b/c need to store _ops within class
+		# Batch major losses and predictions of every decoded character, for evaluate()
+		self.token_loss_op = tf.transpose(tf.nn.sparse_softmax_cross_entropy_with_logits(logits=self.decoder_logits_train,
+											labels=self.decoder_train_targets), [1, 0])
+		self.eval_prediction_op = tf.transpose(tf.to_int32(self.decoder_prediction_train), [1, 0])
 		difference = self.decoder_train_targets - tf.cast(self.decoder_prediction_train, tf.int32)
 		zero = tf.constant(0, dtype=tf.int32)
 		boolean_difference = tf.cast(tf.equal(difference, zero), tf.float64)
-		self.accuracy_op = tf.reduce_mean(boolean_difference)
+		# Time major, as the targets
+		mask = tf.transpose(self.loss_weights, [1, 0])
+		self.accuracy_op = tf.reduce_sum(boolean_difference*tf.cast(mask, tf.float64)) / tf.cast(tf.reduce_sum(mask), tf.float64)
 		tf.summary.scalar('Accuracy', self.accuracy_op)
 
 		self.summary_op = tf.summary.merge_all()
 
+		# Padding is left out of the confusion matrix
+		real_labels = tf.boolean_mask(tf.reshape(self.label_placeholder, [-1]), tf.reshape(mask > 0, [-1]))
+		real_predictions = tf.boolean_mask(tf.reshape(self.decoder_prediction_train, [-1]), tf.reshape(mask > 0, [-1]))
 		if SHERLOCK:
-			self.confusion_matrix = tf_confusion_matrix(tf.reshape(self.label_placeholder, [-1]), tf.reshape(self.decoder_prediction_train, [-1]), num_classes=self.config.vocab_size, dtype=tf.int32)
+			self.confusion_matrix = tf_confusion_matrix(real_labels, real_predictions, num_classes=self.config.vocab_size, dtype=tf.int32)
 		else:
-			self.confusion_matrix = tf.confusion_matrix(tf.reshape(self.label_placeholder, [-1]), tf.reshape(self.decoder_prediction_train, [-1]), num_classes=self.config.vocab_size, dtype=tf.int32)
+			self.confusion_matrix = tf.confusion_matrix(real_labels, real_predictions, num_classes=self.config.vocab_size, dtype=tf.int32)
 
 
 	def _feed_dict(self, feed_values):
@@ -725,16 +975,38 @@ class Seq2SeqRNN(object):
 		return summary, confusion_matrix, accuracy
 
 
-	def sample(self, session, feed_values):
+	def sample(self, session, feed_values, temperatures=None):
 		feed_dict = self._feed_dict(feed_values)
+		if temperatures is not None:
+			feed_dict[self.temperature_placeholder] = temperatures
 
-		logits = tf.transpose(self.decoder_logits_inference, [1, 0, 2])
-		probabilities = tf.nn.softmax(logits)
-		predictions = tf.argmax(probabilities, axis=-1)
-		pred = session.run(predictions, feed_dict=feed_dict)
+		pred = session.run(self.sample_prediction_op, feed_dict=feed_dict)
 		return pred
 
 
+	def sample_sequences(self, session, feed_values, temperatures=None):
+		"""
+		Same as sample, but returns the predictions of every row up to where it stopped
+		@temperatures - sampling temperature of every row, SEQ2SEQ_TEMPERATURE if not set
+		"""
+		feed_dict = self._feed_dict(feed_values)
+		if temperatures is not None:
+			feed_dict[self.temperature_placeholder] = temperatures
+
+		pred, lengths = session.run([self.sample_prediction_op, self.sample_length_op], feed_dict=feed_dict)
+		return [list(row[:length]) for row, length in zip(pred, lengths)]
+
+
+	def evaluate(self, session, feed_values):
+		"""
+		Forward pass only, returns the per character losses, predictions and labels, batch major
+		"""
+		feed_dict = self._feed_dict(feed_values)
+
+		token_loss, prediction = session.run([self.token_loss_op, self.eval_prediction_op], feed_dict=feed_dict)
+		return token_loss, prediction, np.asarray(feed_values[1]).T
+
+
 
 
 
@@ -4,12 +4,28 @@ import os
 import re
 import json
 import pickle
+import random
+import heapq
 
 # Metadata + ~50 characters, then sliding window of (t+1)
 # Feed dict should pass in an intial state (previous final state)
 # Train on entire song & Batching for different songs?
 # Train on individual window examples
 
+# Columnar window store: three contiguous int arrays plus a small json header
+WINDOW_STORE_HEADER = 'header.json'
+WINDOW_STORE_META = 'meta.dat'
+WINDOW_STORE_INPUTS = 'inputs.dat'
+WINDOW_STORE_LABELS = 'labels.dat'
+WINDOW_STORE_DTYPE = np.int32
+NUM_META = 7
+
+# Song store: every song of a split concatenated once, windows are sliced lazily
+SONG_STORE_HEADER = 'song_header.json'
+SONG_STORE_TOKENS = 'tokens.dat'
+SONG_STORE_OFFSETS = 'offsets.dat'
+SONG_STORE_META = 'song_meta.dat'
+
 
 def abc_filenames(datapath):
     return [os.path.join(datapath, f) for f in os.listdir(datapath) if os.path.isfile(os.path.join(datapath, f))]
@@ -29,6 +45,340 @@ def read_abc_pickle(train_file):
         return pickle.load(fd)
 
 
+def is_window_store(datapath):
+    return os.path.isfile(os.path.join(datapath, WINDOW_STORE_HEADER))
+
+
+def read_window_store(datapath):
+    """
+    Opens the window store under @datapath without reading it into memory.
+
+    Returns a dict with the parsed header and read-only np.memmap views
+    'meta' [N,7], 'inputs' [N,window_sz] and 'labels' [N,output_sz].
+    """
+    with open(os.path.join(datapath, WINDOW_STORE_HEADER), 'r') as f:
+        header = json.load(f)
+
+    num_windows = header['num_windows']
+    dtype = np.dtype(header['dtype'])
+    store = {'header': header}
+    for key, filename, width in [('meta', WINDOW_STORE_META, header['num_meta']),
+                                 ('inputs', WINDOW_STORE_INPUTS, header['window_sz']),
+                                 ('labels', WINDOW_STORE_LABELS, header['output_sz'])]:
+        if num_windows == 0:
+            store[key] = np.zeros((0, width), dtype=dtype)
+        else:
+            store[key] = np.memmap(os.path.join(datapath, filename), dtype=dtype,
+                                   mode='r', shape=(num_windows, width))
+    return store
+
+
+def is_song_store(datapath):
+    return os.path.isfile(os.path.join(datapath, SONG_STORE_HEADER))
+
+
+def read_song_store(datapath):
+    """
+    Opens the song store under @datapath without reading it into memory.
+
+    Returns a dict with the parsed header, the concatenated 'tokens' of every
+    song, the per-song 'offsets' into it (num_songs+1 entries) and 'meta' [S,7].
+    """
+    with open(os.path.join(datapath, SONG_STORE_HEADER), 'r') as f:
+        header = json.load(f)
+
+    dtype = np.dtype(header['dtype'])
+    store = {'header': header}
+    store['offsets'] = np.fromfile(os.path.join(datapath, SONG_STORE_OFFSETS), dtype=np.int64)
+    if header['num_tokens'] == 0:
+        store['tokens'] = np.zeros(0, dtype=dtype)
+        store['meta'] = np.zeros((0, header['num_meta']), dtype=dtype)
+    else:
+        store['tokens'] = np.memmap(os.path.join(datapath, SONG_STORE_TOKENS), dtype=dtype,
+                                    mode='r', shape=(header['num_tokens'],))
+        store['meta'] = np.memmap(os.path.join(datapath, SONG_STORE_META), dtype=dtype,
+                                  mode='r', shape=(header['num_songs'], header['num_meta']))
+    return store
+
+
+def song_window_index(song_store, stride_sz, window_sz, nnType, output_sz=0):
+    """
+    Computes the sliding windows over a song store without copying any tokens.
+    Follows the windowing of utils_preprocess.npy2nnInputWorkerWorker: windows
+    every @stride_sz tokens plus one last window that ends on the last token.
+
+    @nnType - string / 'char_rnn', 'seq2seq' or 'BOW'
+
+    Returns a dict with the same 'header' fields as a window store, the song
+    of every window in 'song_ids' and its global start token in 'starts'.
+    """
+    if nnType == 'char_rnn':
+        label_offset, label_sz = 1, window_sz
+    elif nnType == 'seq2seq':
+        label_offset, label_sz = window_sz, output_sz
+    elif nnType == 'BOW':
+        label_offset, label_sz = window_sz + 1, 1
+    else:
+        raise ValueError('Unknown nnType %s' % nnType)
+
+    offsets = np.asarray(song_store['offsets'], dtype=np.int64)
+    lengths = np.diff(offsets)
+    span = label_offset + label_sz
+    last_start = lengths - span
+
+    # strided windows
+    num_strided = np.where(last_start >= 0, last_start // stride_sz + 1, 0)
+    song_ids = np.repeat(np.arange(len(lengths)), num_strided)
+    first_window = np.repeat(np.cumsum(num_strided) - num_strided, num_strided)
+    local_starts = (np.arange(len(song_ids)) - first_window) * stride_sz
+
+    # the last window of every song, unless the stride already ended there
+    has_last = (last_start >= 0) & (last_start > (num_strided - 1) * stride_sz)
+    song_ids = np.concatenate([song_ids, np.nonzero(has_last)[0]])
+    local_starts = np.concatenate([local_starts, last_start[has_last]])
+
+    starts = offsets[song_ids] + local_starts
+    order = np.argsort(starts, kind='mergesort')
+
+    header = {'num_windows': len(starts), 'window_sz': window_sz, 'output_sz': label_sz,
+              'num_meta': song_store['header']['num_meta']}
+    return {'header': header, 'song_ids': song_ids[order], 'starts': starts[order],
+            'label_offset': label_offset, 'song_store': song_store}
+
+
+def read_windows(windows, rows):
+    """
+    Returns the (meta, inputs, labels) arrays of @rows from either a window
+    store or a song window index.
+    """
+    if 'song_store' not in windows:
+        return windows['meta'][rows], windows['inputs'][rows], windows['labels'][rows]
+
+    header = windows['header']
+    tokens = windows['song_store']['tokens']
+    starts = windows['starts'][rows][:, np.newaxis]
+    label_starts = starts + windows['label_offset']
+    meta = windows['song_store']['meta'][windows['song_ids'][rows]]
+    inputs = tokens[starts + np.arange(header['window_sz'])]
+    labels = tokens[label_starts + np.arange(header['output_sz'])]
+    return meta, inputs, labels
+
+
+def window_batches(windows, batch_size, shuffle=True, keep_last=False):
+    """
+    Yields (meta, inputs, labels) arrays of exactly @batch_size windows.
+    The last incomplete batch is dropped, same as abc_batch, unless @keep_last.
+    """
+    num_windows = windows['header']['num_windows']
+    order = np.random.permutation(num_windows) if shuffle else np.arange(num_windows)
+    last_start = num_windows if keep_last else num_windows - batch_size + 1
+    for ndx in range(0, last_start, batch_size):
+        # sorted indices keep the reads from the memmap sequential
+        rows = np.sort(order[ndx:(ndx + batch_size)])
+        yield read_windows(windows, rows)
+
+
+def song_segment_index(song_store, segment_sz, nnType):
+    """
+    Cuts every song of a song store into consecutive segments of at most
+    @segment_sz tokens, without copying any tokens. The last segment of a song
+    is shorter, so whole songs are trained on without malformed windows.
+
+    @nnType - string / 'char_rnn' (labels are the inputs shifted by one) or
+              'seq2seq' (labels are the segment that follows the inputs)
+
+    Returns a dict with the song of every segment in 'song_ids', its global
+    start token in 'starts' and its 'input_lengths' and 'label_lengths'.
+    """
+    if nnType not in ('char_rnn', 'seq2seq'):
+        raise ValueError('Segments are only defined for char_rnn and seq2seq, not %s' % nnType)
+
+    offsets = np.asarray(song_store['offsets'], dtype=np.int64)
+    lengths = np.diff(offsets)
+
+    # a segment every @segment_sz tokens, as long as at least one token follows its start
+    num_segments = (np.maximum(lengths - 1, 0) + segment_sz - 1) // segment_sz
+    song_ids = np.repeat(np.arange(len(lengths)), num_segments)
+    first_segment = np.repeat(np.cumsum(num_segments) - num_segments, num_segments)
+    local_starts = (np.arange(len(song_ids)) - first_segment) * segment_sz
+    remaining = lengths[song_ids] - local_starts
+
+    if nnType == 'char_rnn':
+        input_lengths = np.minimum(segment_sz, remaining - 1)
+        label_lengths = input_lengths
+        label_offsets = np.ones_like(input_lengths)
+    else:
+        input_lengths = np.minimum(segment_sz, remaining - 1)
+        label_lengths = np.minimum(segment_sz, remaining - input_lengths)
+        label_offsets = input_lengths
+
+    header = {'num_windows': len(song_ids), 'window_sz': segment_sz, 'output_sz': segment_sz,
+              'num_meta': song_store['header']['num_meta']}
+    return {'header': header, 'song_ids': song_ids, 'starts': offsets[song_ids] + local_starts,
+            'input_lengths': input_lengths, 'label_lengths': label_lengths,
+            'label_offsets': label_offsets, 'song_store': song_store}
+
+
+def read_segments(segments, rows):
+    """
+    Returns the (meta, inputs, labels, input_lengths, label_lengths) of @rows of
+    a song segment index, the inputs and labels padded with zeros to the longest
+    of the rows only.
+    """
+    tokens = segments['song_store']['tokens']
+    meta = segments['song_store']['meta'][segments['song_ids'][rows]]
+    starts = segments['starts'][rows]
+    input_lengths = segments['input_lengths'][rows]
+    label_lengths = segments['label_lengths'][rows]
+
+    def padded(first, lengths):
+        positions = np.arange(lengths.max())
+        is_real = positions < lengths[:, np.newaxis]
+        return np.where(is_real, tokens[np.where(is_real, first[:, np.newaxis] + positions, 0)], 0)
+
+    inputs = padded(starts, input_lengths)
+    labels = padded(starts + segments['label_offsets'][rows], label_lengths)
+    return meta, inputs, labels, input_lengths, label_lengths
+
+
+def segment_batches(segments, batch_size, shuffle=True, keep_last=False):
+    """
+    Yields (meta, inputs, labels, input_lengths, label_lengths) batches of
+    exactly @batch_size segments of similar length: the segments are sorted by
+    length (ties in random order) and cut into batches, which come in random
+    order. The last incomplete batch is dropped, same as window_batches, unless @keep_last.
+    """
+    num_segments = segments['header']['num_windows']
+    order = np.random.permutation(num_segments) if shuffle else np.arange(num_segments)
+    order = order[np.argsort(segments['input_lengths'][order], kind='mergesort')]
+
+    last_start = num_segments if keep_last else num_segments - batch_size + 1
+    batch_starts = np.arange(0, max(last_start, 0), batch_size)
+    if shuffle:
+        np.random.shuffle(batch_starts)
+    for ndx in batch_starts:
+        yield read_segments(segments, np.sort(order[ndx:(ndx + batch_size)]))
+
+
+def dataset_segment_batches(datapath, batch_size, segment_sz, nnType, shuffle=True, keep_last=False):
+    """
+    Yields the segment_batches of the song store under @datapath
+    """
+    if not is_song_store(datapath):
+        raise ValueError('Training on song segments needs a song store, not %s' % datapath)
+    return segment_batches(song_segment_index(read_song_store(datapath), segment_sz, nnType),
+                           batch_size, shuffle, keep_last)
+
+
+def lane_batches(segments, batch_size, shuffle=True):
+    """
+    Yields (meta, inputs, labels, input_lengths, label_lengths, reset) batches
+    for stateful training: row k of every batch is lane k, which walks its songs
+    one consecutive segment per batch, so the state a lane ends a batch with is
+    the initial state of its next batch. @reset is set on the rows starting a new
+    song. The songs are dealt, in random order, to the lane with the fewest
+    segments so far; lanes with no segment left are fed empty rows (length 0).
+    """
+    song_ids = segments['song_ids']
+    num_songs = len(segments['song_store']['offsets']) - 1
+    num_segments = np.bincount(song_ids, minlength=num_songs)
+    first_segment = np.cumsum(num_segments) - num_segments
+
+    songs = np.random.permutation(num_songs) if shuffle else np.arange(num_songs)
+    lanes = [[] for lane in xrange(batch_size)]
+    lane_heap = [(0, lane) for lane in xrange(batch_size)]
+    for song in songs[num_segments[songs] > 0]:
+        size, lane = heapq.heappop(lane_heap)
+        lanes[lane].extend(xrange(first_segment[song], first_segment[song] + num_segments[song]))
+        heapq.heappush(lane_heap, (size + num_segments[song], lane))
+
+    # [step, lane] segment rows, -1 once a lane has run out
+    num_steps = max(len(lane) for lane in lanes)
+    schedule = np.full((num_steps, batch_size), -1, dtype=np.int64)
+    for lane, rows in enumerate(lanes):
+        schedule[:len(rows), lane] = rows
+
+    for rows in schedule:
+        real = rows >= 0
+        meta, inputs, labels, input_lengths, label_lengths = read_segments(segments, rows[real])
+
+        full_meta = np.zeros((batch_size,) + meta.shape[1:], dtype=meta.dtype)
+        full_inputs = np.zeros((batch_size, inputs.shape[1]), dtype=inputs.dtype)
+        full_labels = np.zeros((batch_size, labels.shape[1]), dtype=labels.dtype)
+        full_input_lengths = np.zeros(batch_size, dtype=input_lengths.dtype)
+        full_label_lengths = np.zeros(batch_size, dtype=label_lengths.dtype)
+        full_meta[real], full_inputs[real], full_labels[real] = meta, inputs, labels
+        full_input_lengths[real], full_label_lengths[real] = input_lengths, label_lengths
+
+        reset = np.ones(batch_size, dtype=bool)
+        reset[real] = (rows[real] == first_segment[song_ids[rows[real]]])
+        yield full_meta, full_inputs, full_labels, full_input_lengths, full_label_lengths, reset
+
+
+def dataset_lane_batches(datapath, batch_size, window_sz, shuffle=True):
+    """
+    Yields the lane_batches of the song store under @datapath, walking every
+    song in consecutive char_rnn windows of at most @window_sz characters
+    """
+    if not is_song_store(datapath):
+        raise ValueError('Stateful training needs a song store, not %s' % datapath)
+    return lane_batches(song_segment_index(read_song_store(datapath), window_sz, 'char_rnn'),
+                        batch_size, shuffle)
+
+
+def open_windows(datapath, window_spec=None):
+    """
+    Opens the windows of a window store, or of a song store sliced according
+    to @window_spec = (stride_sz, window_sz, nnType, output_sz).
+    """
+    if is_song_store(datapath):
+        return song_window_index(read_song_store(datapath), *window_spec)
+    return read_window_store(datapath)
+
+
+def dataset_dims(datapath, window_spec=None):
+    """
+    Returns the (window_sz, output_sz) of the dataset under @datapath, read
+    from the store header or parsed from the folder name for pickled buckets.
+    """
+    if is_song_store(datapath) or is_window_store(datapath):
+        header = open_windows(datapath, window_spec)['header']
+        return header['window_sz'], header['output_sz']
+
+    window_sz = int(re.findall('[0-9]+', re.findall('window_[0-9]+', datapath)[0])[0])
+    if 'output_sz' in datapath:
+        output_sz = int(re.findall('[0-9]+', re.findall('output_sz_[0-9]+', datapath)[0])[0])
+    else:
+        output_sz = window_sz
+    return window_sz, output_sz
+
+
+def dataset_batches(datapath, batch_size, shuffle=True, window_spec=None, keep_last=False):
+    """
+    Yields (meta, inputs, labels) batches from a window store, a song store
+    windowed with @window_spec, or a folder of pickled
+    (meta, input_window, output_window) buckets.
+    Incomplete batches are dropped unless @keep_last.
+    """
+    if is_song_store(datapath) or is_window_store(datapath):
+        for batch in window_batches(open_windows(datapath, window_spec), batch_size, shuffle, keep_last):
+            yield batch
+        return
+
+    filenames = abc_filenames(datapath)
+    if shuffle:
+        random.shuffle(filenames)
+    for data_file in filenames:
+        data = read_abc_pickle(data_file)
+        if shuffle:
+            random.shuffle(data)
+        data_batches = [data[ndx:(ndx + batch_size)] for ndx in range(0, len(data), batch_size)] \
+                            if keep_last else abc_batch(data, n=batch_size)
+        for data_batch in data_batches:
+            meta_batch, input_window_batch, output_window_batch = zip(*data_batch)
+            yield np.stack(meta_batch), np.stack(input_window_batch), np.stack(output_window_batch)
+
+
 def compute_save_vocabulary(datapath):
     # Iterate through whole dataset directory
     filenames = abc_filenames(datapath)
@@ -6,7 +6,7 @@ import tensorflow as tf
 import numpy as np
 import os
 import sys
-from models import CharRNN, Config, Seq2SeqRNN, CBOW, GenAdversarialNet
+from models import CharRNN, Config, Seq2SeqRNN, CBOW, GenAdversarialNet, LSTM_CELL_TYPES
 import pickle
 import reader
 import random
@@ -40,7 +40,11 @@ GAN_DEVELOPMENT_DATA = DIR_MODIFIER + '/full_dataset/gan_dataset/nn_input_dev_st
 
 SUMMARY_DIR = DIR_MODIFIER + '/dev_summary2'
 
+# nnType of the windows each model is trained on (see utils_preprocess.npy2nnInput)
+NN_TYPES = {'char': 'char_rnn', 'seq2seq': 'seq2seq', 'cbow': 'BOW'}
+
 BATCH_SIZE = 100 # should be dynamically passed into Config
+EVAL_BATCH_SIZE = 500 # forward pass only, see -eval_batch
 NUM_EPOCHS = 50
 GPU_CONFIG = tf.ConfigProto()
 GPU_CONFIG.gpu_options.per_process_gpu_memory_fraction = 0.3
@@ -49,6 +53,12 @@ GPU_CONFIG.gpu_options.per_process_gpu_memory_fraction = 0.3
 # For T --> 0, p "concentrates" on arg max. Hard to sample from!
 TEMPERATURE = 1.0
 
+# Metadata variants generated for every warm start when sampling
+NUM_SAMPLE_VARIANTS = 10
+
+# Tokens added at the end of the music vocabulary, <go> only for seq2seq
+SPECIAL_TOKENS = ("<start>", "<end>", "<go>")
+
 meta_map = pickle.load(open(os.path.join(DIR_MODIFIER, 'full_dataset/global_map_meta.p'),'rb'))
 music_map = pickle.load(open(os.path.join(DIR_MODIFIER, 'full_dataset/global_map_music.p'),'rb'))
 
@@ -98,7 +108,7 @@ def sample_Seq2Seq(args, curModel, cell_type, session, warm_chars, vocabulary, m
     num_encode = [len(warm_chars)]
     num_decode = [1000]
 
-    if cell_type == 'lstm':
+    if cell_type in LSTM_CELL_TYPES:
         initial_state_sample = [[np.zeros(curModel.config.hidden_size) for entry in xrange(batch_size)] for layer in xrange(curModel.config.num_layers)]
     else:
         initial_state_sample = [np.zeros(curModel.config.hidden_size) for entry in xrange(batch_size)]
@@ -113,6 +123,92 @@ def sample_Seq2Seq(args, curModel, cell_type, session, warm_chars, vocabulary, m
     return prediction
 
 
+def sample_Seq2Seq_batch(args, curModel, cell_type, session, warm_chars_batch, meta_batch, temperatures, vocabulary, max_length=1000):
+    """
+    Samples one continuation per warm start, curModel.config.batch_size rows per session.run
+    (the last batch is padded with copies of its first row).
+    @meta_batch - [rows, NUM_META] encoded metadata, the initial state of every row
+    @temperatures - sampling temperature of every row, <= 0 for the most likely characters
+    Returns the predicted characters of every row, up to where it stopped
+    """
+    batch_size = curModel.config.batch_size
+    if cell_type in LSTM_CELL_TYPES:
+        initial_state_sample = np.zeros((curModel.config.num_layers, batch_size, curModel.config.hidden_size))
+    else:
+        initial_state_sample = np.zeros((batch_size, curModel.config.hidden_size))
+
+    predictions = []
+    for first in xrange(0, len(warm_chars_batch), batch_size):
+        rows = warm_chars_batch[first:first+batch_size]
+        padding = batch_size - len(rows)
+        rows = rows + [rows[0]]*padding
+        row_meta = list(meta_batch[first:first+batch_size])
+        row_meta = row_meta + [row_meta[0]]*padding
+        row_temperatures = list(temperatures[first:first+batch_size])
+        row_temperatures = row_temperatures + [row_temperatures[0]]*padding
+        num_encode = [len(warm_chars) for warm_chars in rows]
+        warm_batch = np.zeros((batch_size, max(num_encode)), dtype=np.int32)
+        for row, warm_chars in enumerate(rows):
+            warm_batch[row, :len(warm_chars)] = warm_chars
+
+        # The state of every row is initialized from its own metadata
+        feed_values = utils_runtime.pack_feed_values(args, warm_batch,
+                                    [[vocabulary["<go>"]]]*batch_size, np.stack(row_meta),
+                                    initial_state_sample, True,
+                                    num_encode, [max_length]*batch_size)
+        predictions.extend(curModel.sample_sequences(session, feed_values, row_temperatures))
+
+    return predictions[:len(warm_chars_batch)]
+
+
+def sample_CharRNN(args, curModel, session, warm_chars_batch, meta_batch, temperatures, max_length=100):
+    """
+    Samples one tune per row with the in-graph sampling loop of the CharRNN, in a single session.run.
+    Rows are teacher forced through their own warm start, then sample at their own temperature until <end> or @max_length.
+    @warm_chars_batch - encoded warm start characters of every row (may differ in length)
+    @meta_batch - [batch, 7] encoded metadata of every row
+    @temperatures - sampling temperature of every row
+    Returns the generated characters of every row, warm start included
+    """
+    warm_lengths = [len(warm_chars) for warm_chars in warm_chars_batch]
+    warm_batch = np.zeros((len(warm_chars_batch), max(warm_lengths)), dtype=np.int32)
+    for row, warm_chars in enumerate(warm_chars_batch):
+        warm_batch[row, :len(warm_chars)] = warm_chars
+
+    return curModel.generate(session, warm_batch, warm_lengths, meta_batch, temperatures, max_length=max_length)
+
+
+def sample_CBOW(args, curModel, session, warm_chars, temperature, max_length=200):
+    """
+    Samples one tune by sliding the CBOW context window over its own samples
+    @warm_chars - encoded warm start characters, as many as the context window
+    Returns the generated characters, warm start included
+    """
+    generated = warm_chars[:]
+    context_window = warm_chars[:]
+
+    # Warm Start (get the first prediction)
+    feed_values = utils_runtime.pack_feed_values(args, [context_window], [[0]*len(context_window)],
+                                   None, None, None, None, None)
+    logits,_ = curModel.sample(session, feed_values)
+
+    # Sample
+    sampled_character = utils_runtime.sample_with_temperature(logits, temperature)
+    #while sampled_character!=END_TOKEN_ID and len(generated) < 200:
+    while len(generated) < max_length:
+        # update the context input for the model
+        context_window = context_window[1:] + [sampled_character]
+
+        feed_values = utils_runtime.pack_feed_values(args, [context_window], [[0]*len(context_window)],
+                                       None, None, None, None, None)
+        logits,_ = curModel.sample(session, feed_values)
+
+        sampled_character = utils_runtime.sample_with_temperature(logits, temperature)
+        generated.append(sampled_character)
+
+    return generated
+
+
 def sampleCBOW(session, args, curModel, vocabulary_decode):
     # Sample Model
     warm_length = curModel.input_size
@@ -126,27 +222,7 @@ def sampleCBOW(session, args, curModel, vocabulary_decode):
     print "Sampling from single RNN cell using warm start of ({0})".format(warm_length)
     for meta in warm_meta_array:
         print "Current Metadata: {0}".format(meta)
-        generated = warm_chars[:]
-        context_window = warm_chars[:]
-
-        # Warm Start (get the first prediction)
-        feed_values = utils_runtime.pack_feed_values(args, [context_window], [[0]*len(context_window)],
-                                       None, None, None, None, None)
-        logits,_ = curModel.sample(session, feed_values)
-
-        # Sample
-        sampled_character = utils_runtime.sample_with_temperature(logits, TEMPERATURE)
-        #while sampled_character!=END_TOKEN_ID and len(generated) < 200:
-        while len(generated) < 200:
-            # update the context input for the model
-            context_window = context_window[1:] + [sampled_character]
-
-            feed_values = utils_runtime.pack_feed_values(args, [context_window], [[0]*len(context_window)],
-                                           None, None, None, None, None)
-            logits,_ = curModel.sample(session, feed_values)
-
-            sampled_character = utils_runtime.sample_with_temperature(logits, TEMPERATURE)
-            generated.append(sampled_character)
+        generated = sample_CBOW(args, curModel, session, warm_chars, TEMPERATURE)
 
         decoded_characters = [vocabulary_decode[char] for char in generated]
 
@@ -156,7 +232,101 @@ def sampleCBOW(session, args, curModel, vocabulary_decode):
     return encoding
 
 
+def build_vocabulary(music_vocabulary, model):
+    """
+    Returns a copy of @music_vocabulary with the special tokens used by @model
+    appended at the end (any special tokens already in it are replaced)
+    """
+    vocabulary = dict((c, i) for c, i in music_vocabulary.iteritems() if c not in SPECIAL_TOKENS)
+    vocab_sz = len(vocabulary)
+    vocabulary["<start>"] = vocab_sz
+    vocabulary["<end>"] = vocab_sz+1
+    if model == 'seq2seq':
+        vocabulary["<go>"] = vocab_sz+2
+    return vocabulary
+
+
+def build_model(model, input_size, label_size, batch_size, vocabulary_size, cell_type,
+                hyperparam_path, start_encode, end_encode, is_train):
+    """
+    Builds the graph of @model ('seq2seq', 'char' or 'cbow') in the default graph
+    """
+    if model == 'seq2seq':
+        curModel = Seq2SeqRNN(input_size, label_size, batch_size, vocabulary_size, cell_type, hyperparam_path, start_encode, end_encode)
+        curModel.create_model(is_train = is_train)
+
+    elif model == 'char':
+        curModel = CharRNN(input_size, label_size, batch_size, vocabulary_size, cell_type, hyperparam_path)
+        curModel.create_model(is_train = is_train)
+
+    elif model == 'cbow':
+        curModel = CBOW(input_size, batch_size, vocabulary_size, hyperparam_path)
+        curModel.create_model()
+
+    # Gradients and optimizer slots only when training
+    if is_train:
+        curModel.train()
+    curModel.metrics()
+
+    return curModel
+
+
+def default_dataset(model, split):
+    """
+    Returns the default dataset of @split ('train', 'dev' or 'test') for @model
+    """
+    use_seq2seq_data = (model == 'seq2seq')
+    if split == 'train':
+        return GAN_TRAIN_DATA if use_seq2seq_data else TRAIN_DATA
+    elif split == 'test':
+        return GAN_TEST_DATA if use_seq2seq_data else TEST_DATA
+    else:
+        return GAN_DEVELOPMENT_DATA if use_seq2seq_data else DEVELOPMENT_DATA
+
+
+def split_dataset(dataset_dir, split):
+    """
+    Returns the path of the @split of the dataset under @dataset_dir, which only
+    differs by the split named in its last component
+    """
+    head, tail = os.path.split(dataset_dir.rstrip('/'))
+    return os.path.join(head, re.sub('train|dev|test', split, tail, count=1))
+
+
+def evaluate_split(args, curModel, session, dataset_dir, batch_size, window_spec, vocabulary_size):
+    """
+    Scores every window of @dataset_dir once, with the forward pass only.
+    Returns the accuracy, mean loss and perplexity over all the predicted
+    characters, and their confusion matrix.
+    """
+    confusion_matrix = np.zeros((vocabulary_size, vocabulary_size), dtype=np.int64)
+    total_loss = 0.0
+
+    # The last batch is padded to the batch size of the graph, only its real rows count
+    def feed_batch(data_batch):
+        padded_batch, num_rows = utils_runtime.pad_batch(data_batch, batch_size)
+        return num_rows, utils_runtime.batch_feed_values(args, curModel, meta_map, padded_batch)
+
+    data_batches = reader.dataset_batches(dataset_dir, batch_size, shuffle=False, window_spec=window_spec, keep_last=True)
+    for num_rows, feed_values in utils_runtime.prefetch(data_batches, feed_batch, depth=args.prefetch,
+                                                        num_threads=args.prefetch_threads):
+        token_loss, prediction, labels = curModel.evaluate(session, feed_values)
+        total_loss += np.sum(token_loss[:num_rows])
+        confusion_matrix += np.bincount(labels[:num_rows].ravel()*vocabulary_size + prediction[:num_rows].ravel(),
+                                        minlength=vocabulary_size*vocabulary_size).reshape(vocabulary_size, vocabulary_size)
+
+    num_predicted = confusion_matrix.sum()
+    if num_predicted == 0:
+        raise ValueError('No windows to evaluate in {0}'.format(dataset_dir))
+
+    accuracy = np.trace(confusion_matrix) / float(num_predicted)
+    loss = total_loss / num_predicted
+    return accuracy, loss, np.exp(loss), confusion_matrix
+
+
 def run_model(args):
+    global meta_map, music_map
+
     # used by song_generator.py
     if hasattr(args, 'temperature'):
         global TEMPERATURE
@@ -168,43 +338,53 @@ def run_model(args):
         warm_length = 15
 
     if hasattr(args, 'meta_map'):
-        global meta_map,music_map
         meta_map = pickle.load(open(os.path.join(DIR_MODIFIER, args.meta_map),'rb'))
         music_map = pickle.load(open(os.path.join(DIR_MODIFIER, args.music_map),'rb'))
 
     use_seq2seq_data = (args.model == 'seq2seq')
     if args.data_dir != '':
         dataset_dir = args.data_dir
-    elif args.train == 'train':
-        dataset_dir = GAN_TRAIN_DATA if use_seq2seq_data else TRAIN_DATA
-    elif args.train == 'test':
-        dataset_dir = GAN_TEST_DATA if use_seq2seq_data else TEST_DATA
-    else: # args.train == 'dev' or 'sample' (which has no dataset, but we just read anyway)
-        dataset_dir = GAN_DEVELOPMENT_DATA if use_seq2seq_data else DEVELOPMENT_DATA
+    else: # 'sample' has no dataset, but we just read the dev set anyway
+        dataset_dir = default_dataset(args.model, args.train)
 
     print 'Using dataset %s' %dataset_dir
-    dateset_filenames = reader.abc_filenames(dataset_dir)
 
-    # figure out the input data size
-    window_sz = int(re.findall('[0-9]+', re.findall('window_[0-9]+', dataset_dir)[0])[0])
-    if 'output_sz' in dataset_dir:
-        label_sz = int(re.findall('[0-9]+', re.findall('output_sz_[0-9]+', dataset_dir)[0])[0])
+    # -p eval scores several splits with the same graph
+    if args.train == 'eval':
+        eval_datasets = [(split, split_dataset(args.data_dir, split) if args.data_dir != '' else default_dataset(args.model, split))
+                         for split in args.splits]
     else:
-        label_sz = window_sz
+        eval_datasets = [(args.train, dataset_dir)]
+
+    # figure out the input data size, song stores are windowed as set in the hyperparameters
+    config = Config(args.set_config)
+    window_spec = (config.stride_sz, config.window_sz, NN_TYPES[args.model], config.output_sz)
+    window_sz, label_sz = reader.dataset_dims(dataset_dir, window_spec)
 
     input_size = 1 if (args.train == "sample" and args.model!='cbow') else window_sz
     initial_size = 7
     label_size = 1 if args.train == "sample" else label_sz
-    batch_size = 1 if args.train == "sample" else BATCH_SIZE
+
+    # -segment trains on variable length segments of whole songs, padded to the longest of their batch
+    use_segments = (args.train == "train" and getattr(args, 'segment', 0) > 0)
+    # -stateful walks whole songs in consecutive windows, carrying the state from one window to the next
+    use_lanes = (args.train == "train" and getattr(args, 'stateful', False))
+    if use_lanes and args.model != 'char':
+        raise ValueError('Stateful training is only implemented for the char model, not %s' % args.model)
+    if use_segments or use_lanes:
+        input_size = label_size = None
+    if args.train == "sample":
+        # CharRNN samples all the metadata variants together, song_generator.py only needs one
+        batch_size = NUM_SAMPLE_VARIANTS if (args.model == 'char' and not hasattr(args, 'ran_from_script')) else 1
+    elif args.train == "train":
+        batch_size = BATCH_SIZE
+    else:
+        batch_size = getattr(args, 'eval_batch', EVAL_BATCH_SIZE)
     NUM_EPOCHS = args.num_epochs
     print "Using checkpoint directory: {0}".format(args.ckpt_dir)
 
     # Getting vocabulary mapping:
-    vocab_sz = len(music_map)
-    music_map["<start>"] = vocab_sz
-    music_map["<end>"] = vocab_sz+1
-    if use_seq2seq_data:
-        music_map["<go>"] = vocab_sz+2
+    music_map = build_vocabulary(music_map, args.model)
 
     vocabulary_size = len(music_map)
     vocabulary_decode = dict(zip(music_map.values(), music_map.keys()))
@@ -212,27 +392,13 @@ def run_model(args):
     start_encode = music_map["<go>"] if (args.train == "sample" and use_seq2seq_data) else music_map["<start>"]
     end_encode = music_map["<end>"]
 
-    cell_type = 'lstm'
-    # cell_type = 'gru'
-    # cell_type = 'rnn'
+    # the cell backend of the hyperparameters, unless set with -cell
+    cell_type = getattr(args, 'cell_type', None) or config.cell_type
+    if use_lanes and cell_type not in LSTM_CELL_TYPES:
+        raise ValueError('Stateful training carries an LSTM state, not a %s one' % cell_type)
 
-    if args.model == 'seq2seq':
-        curModel = Seq2SeqRNN(input_size, label_size, batch_size, vocabulary_size, cell_type, args.set_config, start_encode, end_encode)
-        curModel.create_model(is_train = (args.train=='train'))
-        curModel.train()
-        curModel.metrics()
-
-    elif args.model == 'char':
-        curModel = CharRNN(input_size, label_size, batch_size, vocabulary_size, cell_type, args.set_config)
-        curModel.create_model(is_train = (args.train=='train'))
-        curModel.train()
-        curModel.metrics()
-
-    elif args.model == 'cbow':
-        curModel = CBOW(input_size, batch_size, vocabulary_size, args.set_config)
-        curModel.create_model()
-        curModel.train()
-        curModel.metrics()
+    curModel = build_model(args.model, input_size, label_size, batch_size, vocabulary_size, cell_type,
+                           args.set_config, start_encode, end_encode, is_train=(args.train=='train'))
 
     print "Running {0} model for {1} epochs.".format(args.model, NUM_EPOCHS)
 
@@ -242,20 +408,24 @@ def run_model(args):
     saver = tf.train.Saver(max_to_keep=NUM_EPOCHS)
     step = 0
 
+    # used by utils_hyperparam.py to share the cores between trials running side by side
+    if getattr(args, 'threads', 0) > 0:
+        GPU_CONFIG.intra_op_parallelism_threads = args.threads
+        GPU_CONFIG.inter_op_parallelism_threads = args.threads
+
     with tf.Session(config=GPU_CONFIG) as session:
         print "Inititialized TF Session!"
 
         # Checkpoint
         i_stopped, found_ckpt = utils_runtime.get_checkpoint(args, session, saver)
 
-        # file_writer = tf.summary.FileWriter(SUMMARY_DIR, graph=session.graph, max_queue=10, flush_secs=30)
-        file_writer = tf.summary.FileWriter(args.ckpt_dir, graph=session.graph, max_queue=10, flush_secs=30)
-        confusion_matrix = np.zeros((vocabulary_size, vocabulary_size))
-        batch_accuracies = []
-
         if args.train == "train":
-            init_op = tf.global_variables_initializer() # tf.group(tf.initialize_all_variables(), tf.initialize_local_variables())
-            init_op.run()
+            if found_ckpt:
+                # Resume after the restored epoch, keeping its weights
+                i_stopped += 1
+            else:
+                init_op = tf.global_variables_initializer() # tf.group(tf.initialize_all_variables(), tf.initialize_local_variables())
+                init_op.run()
         else:
             # Exit if no checkpoint to test
             if not found_ckpt:
@@ -264,6 +434,9 @@ def run_model(args):
 
         # Sample Model
         if args.train == "sample":
+            # Sampling only runs existing ops, anything adding to the graph from here on is a bug
+            session.graph.finalize()
+
             if args.model=='cbow':
                 encoding = sampleCBOW(session, args, curModel, vocabulary_decode)
                 return encoding
@@ -276,7 +449,7 @@ def run_model(args):
                 warm_meta, warm_chars = utils_runtime.genWarmStartDataset(warm_length, meta_map, music_map)
 
             # warm_meta_array = [warm_meta[:] for idx in xrange(5)]
-            warm_meta_array = [warm_meta[:] for idx in xrange(10)]
+            warm_meta_array = [warm_meta[:] for idx in xrange(NUM_SAMPLE_VARIANTS)]
 
             # Change Key
             warm_meta_array[1][4] = 1 - warm_meta_array[1][4]
@@ -290,116 +463,97 @@ def run_model(args):
             warm_meta_array[5][5] = 30
 
             new_warm_meta = utils_runtime.encode_meta_batch(meta_map, warm_meta_array)
-            new_warm_meta_array = zip(warm_meta_array, new_warm_meta)
 
             print "Sampling from single RNN cell using warm start of ({0})".format(warm_length)
-            for old_meta, meta in new_warm_meta_array:
-                print "Current Metadata: {0}".format(meta)
-                generated = warm_chars[:]
-
-                if args.model == 'char':
-                    # Warm Start
-                    for j, c in enumerate(warm_chars):
-                        if cell_type == 'lstm':
-                            if j == 0:
-                                initial_state_sample = [[np.zeros(curModel.config.hidden_size) for entry in xrange(batch_size)] for layer in xrange(curModel.config.num_layers)]
-                            else:
-                                initial_state_sample = []
-                                for lstm_tuple in state:
-                                    initial_state_sample.append(lstm_tuple[0])
-                        else:
-                            initial_state_sample = [np.zeros(curModel.config.hidden_size) for entry in xrange(batch_size)] if (j == 0) else state[0]
-
-                        feed_values = utils_runtime.pack_feed_values(args, [[c]],
-                                                    [[0]], [meta],
-                                                    initial_state_sample, (j == 0),
-                                                    None, None)
-                        logits, state = curModel.sample(session, feed_values)
-
-                    # Sample
-                    sampled_character = utils_runtime.sample_with_temperature(logits, TEMPERATURE)
-                    while sampled_character != music_map["<end>"] and len(generated) < 100:
-                        if cell_type == 'lstm':
-                            initial_state_sample = []
-                            for lstm_tuple in state:
-                                initial_state_sample.append(lstm_tuple[0])
-                        else:
-                            initial_state_sample = state[0]
-
-                        feed_values = utils_runtime.pack_feed_values(args, [[sampled_character]],
-                                                    [[0]], [np.zeros_like(meta)],
-                                                    initial_state_sample, False,
-                                                    None, None)
-                        logits, state = curModel.sample(session, feed_values)
-
-                        sampled_character = utils_runtime.sample_with_temperature(logits, TEMPERATURE)
-                        generated.append(sampled_character)
-
-                elif args.model == 'seq2seq':
+            if args.model == 'char':
+                # Every metadata variant is sampled as one row of the same batch
+                generated_batch = sample_CharRNN(args, curModel, session,
+                                            [warm_chars]*batch_size, new_warm_meta[:batch_size],
+                                            [TEMPERATURE]*batch_size)
+                for old_meta, meta, generated in zip(warm_meta_array, new_warm_meta, generated_batch):
+                    print "Current Metadata: {0}".format(meta)
+                    encoding = utils.encoding2ABC(old_meta, generated, meta_map, music_map)
+
+                    if hasattr(args, 'ran_from_script'):
+                        return encoding
+
+            elif args.model == 'seq2seq':
+                for old_meta, meta in zip(warm_meta_array, new_warm_meta):
+                    print "Current Metadata: {0}".format(meta)
+                    generated = warm_chars[:]
+
                     prediction = sample_Seq2Seq(args, curModel, cell_type, session, warm_chars, music_map, meta, batch_size)
                     generated.extend(prediction.flatten())
 
-                decoded_characters = [vocabulary_decode[char] for char in generated]
+                    encoding = utils.encoding2ABC(old_meta, generated, meta_map, music_map)
 
-                encoding = utils.encoding2ABC(old_meta, generated, meta_map, music_map)
+                    if hasattr(args, 'ran_from_script'):
+                        return encoding
 
-                if hasattr(args, 'ran_from_script'):
-                    return encoding
+        # Train model
+        elif args.train == "train":
+            # file_writer = tf.summary.FileWriter(SUMMARY_DIR, graph=session.graph, max_queue=10, flush_secs=30)
+            file_writer = tf.summary.FileWriter(args.ckpt_dir, graph=session.graph, max_queue=10, flush_secs=30)
+            confusion_matrix = np.zeros((vocabulary_size, vocabulary_size))
 
-        # Train, dev, test model
-        else:
             for i in xrange(i_stopped, NUM_EPOCHS):
                 print "Running epoch ({0})...".format(i)
-                random.shuffle(dateset_filenames)
-                for j, data_file in enumerate(dateset_filenames):
-                    # Get train data - into feed_dict
-                    data = reader.read_abc_pickle(data_file)
-                    random.shuffle(data)
-                    data_batches = reader.abc_batch(data, n=batch_size)
-                    for k, data_batch in enumerate(data_batches):
-                        meta_batch, input_window_batch, output_window_batch = tuple([list(tup) for tup in zip(*data_batch)])
-                        new_meta_batch = utils_runtime.encode_meta_batch(meta_map, meta_batch)
-
-                        initial_state_batch = [[np.zeros(curModel.config.hidden_size) for entry in xrange(batch_size)] for layer in xrange(curModel.config.num_layers)]
-                        num_encode = [window_sz] * batch_size
-                        num_decode = num_encode[:]
-
-                        feed_values = utils_runtime.pack_feed_values(args, input_window_batch,
-                                                    output_window_batch, new_meta_batch,
-                                                    initial_state_batch, True,
-                                                    num_encode, num_decode)
-
-                        summary, conf, accuracy = curModel.run(args, session, feed_values)
-
-                        file_writer.add_summary(summary, step)
-
-                        # Update confusion matrix
-                        confusion_matrix += conf
-
-                        # Record batch accuracies for test code
-                        if args.train == "test" or args.train == 'dev':
-                            batch_accuracies.append(accuracy)
-
-                        # Processed another batch
-                        step += 1
-
-                if args.train == "train":
-                    # Checkpoint model - every epoch
-                    utils_runtime.save_checkpoint(args, session, saver, i)
-                    confusion_suffix = str(i)
-                else: # dev or test (NOT sample)
-                    test_accuracy = np.mean(batch_accuracies)
-                    print "Model {0} accuracy: {1}".format(args.train, test_accuracy)
-                    confusion_suffix = "_{0}-set".format(args.train)
-
-                    if args.train == 'dev':
-                        # Update the file for choosing best hyperparameters
-                        curFile = open(curModel.config.dev_filename, 'a')
-                        curFile.write("Dev set accuracy: {0}".format(test_accuracy))
-                        curFile.write('\n')
-                        curFile.close()
+                # Get train data - into feed_dict
+                if use_lanes:
+                    data_batches = reader.dataset_lane_batches(dataset_dir, batch_size, config.window_sz)
+                    feed_values_fn = lambda data_batch: utils_runtime.lane_feed_values(args, curModel, meta_map, data_batch)
+                elif use_segments:
+                    data_batches = reader.dataset_segment_batches(dataset_dir, batch_size, args.segment, NN_TYPES[args.model])
+                    feed_values_fn = lambda data_batch: utils_runtime.segment_feed_values(args, curModel, meta_map, data_batch)
+                else:
+                    data_batches = reader.dataset_batches(dataset_dir, batch_size, window_spec=window_spec)
+                    feed_values_fn = lambda data_batch: utils_runtime.batch_feed_values(args, curModel, meta_map, data_batch)
+                # the next batches are packed in the background while the current one runs,
+                # by a single thread for the lanes, whose state is carried over in batch order
+                feed_batches = utils_runtime.prefetch(data_batches, feed_values_fn,
+                                    depth=args.prefetch, num_threads=(1 if use_lanes else args.prefetch_threads))
+                lane_state = None
+                for k, feed_values in enumerate(feed_batches):
+                    if use_lanes:
+                        # truncated backpropagation, the state is carried over but not its gradients
+                        feed_values = utils_runtime.carry_state(feed_values, lane_state)
+                    summary, conf, accuracy = curModel.run(args, session, feed_values)
+                    lane_state = getattr(curModel, 'final_state', None)
+
+                    file_writer.add_summary(summary, step)
+
+                    # Update confusion matrix
+                    confusion_matrix += conf
+
+                    # Processed another batch
+                    step += 1
+
+                # Checkpoint model - every epoch
+                utils_runtime.save_checkpoint(args, session, saver, i)
+                confusion_suffix = str(i)
+
+                # Plot Confusion Matrix
+                plot_confusion(confusion_matrix, music_map, confusion_suffix+"_all")
+                plot_confusion(confusion_matrix, music_map, confusion_suffix+"_removed", characters_remove=['|', '2', '<end>'])
+
+        # Dev, test or several splits, every window scored once without gradients or summaries
+        else:
+            for split, split_dir in eval_datasets:
+                print "Evaluating the {0} set {1}...".format(split, split_dir)
+                test_accuracy, test_loss, perplexity, confusion_matrix = evaluate_split(args, curModel, session, split_dir,
+                                                                    batch_size, window_spec, vocabulary_size)
+                print "Model {0} accuracy: {1}".format(split, test_accuracy)
+                print "Model {0} loss: {1}, perplexity: {2}".format(split, test_loss, perplexity)
+
+                if split == 'dev':
+                    # Update the file for choosing best hyperparameters
+                    curFile = open(curModel.config.dev_filename, 'a')
+                    curFile.write("Dev set accuracy: {0}".format(test_accuracy))
+                    curFile.write('\n')
+                    curFile.close()
 
                 # Plot Confusion Matrix
+                confusion_suffix = "_{0}-set".format(split)
                 plot_confusion(confusion_matrix, music_map, confusion_suffix+"_all")
                 plot_confusion(confusion_matrix, music_map, confusion_suffix+"_removed", characters_remove=['|', '2', '<end>'])
 
@@ -51,6 +51,33 @@ TEMPERATURE = 1.0
 
 
 
+def build_gan_batch(curModel, meta_vocabulary, vocabulary_size, data_batch, num_generator_steps=10):
+    """
+    Builds the noise batches of the generator-only steps, and the noise + real
+    batch of the discriminator step, for one (meta, inputs, labels) data batch.
+    """
+    meta_batch, input_window_batch, output_window_batch = data_batch
+    half_batch, window_sz = input_window_batch.shape
+    initial_state_batch = utils_runtime.zero_state_batch(curModel, half_batch)
+
+    def noise_batch():
+        noise_meta_batch = utils_runtime.create_noise_meta_batch(meta_vocabulary, half_batch)
+        new_noise_meta_batch = utils_runtime.encode_meta_batch(meta_vocabulary, noise_meta_batch)
+        noise_input_window_batch = np.random.randint(vocabulary_size, size=(half_batch, window_sz))
+        return noise_input_window_batch, new_noise_meta_batch
+
+    generator_batches = []
+    for it in range(0, num_generator_steps):
+        noise_input_window_batch, new_noise_meta_batch = noise_batch()
+        generator_batches.append((noise_input_window_batch, new_noise_meta_batch, initial_state_batch))
+
+    noise_input_window_batch, new_noise_meta_batch = noise_batch()
+    noise_input_window_batch = np.concatenate([noise_input_window_batch, input_window_batch])
+    gan_labels = np.asarray([int(m[0]) for m in meta_batch])
+
+    return generator_batches, (noise_input_window_batch, gan_labels, new_noise_meta_batch, initial_state_batch)
+
+
 def run_gan(args):
     use_seq2seq_data = (args.model == 'seq2seq')
     if args.data_dir != '':
@@ -64,14 +91,11 @@ def run_gan(args):
 
 
     print 'Using dataset %s' %dataset_dir
-    dateset_filenames = reader.abc_filenames(dataset_dir)
 
-    # figure out the input data size
-    window_sz = int(re.findall('[0-9]+', re.findall('window_[0-9]+', dataset_dir)[0])[0])
-    if 'output_sz' in dataset_dir:
-        label_sz = int(re.findall('[0-9]+', re.findall('output_sz_[0-9]+', dataset_dir)[0])[0])
-    else:
-        label_sz = window_sz
+    # figure out the input data size, song stores are windowed as set in the hyperparameters
+    config = Config(args.set_config)
+    window_spec = (config.stride_sz, config.window_sz, 'seq2seq', config.output_sz)
+    window_sz, label_sz = reader.dataset_dims(dataset_dir, window_spec)
 
     input_size = 1 if (args.train == "sample" and args.model!='cbow') else window_sz
     initial_size = 7
@@ -101,9 +125,8 @@ def run_gan(args):
     # Getting meta mapping:
     meta_map = pickle.load(open(META_DATA, 'rb'))
 
-    cell_type = 'lstm'
-    # cell_type = 'gru'
-    # cell_type = 'rnn'
+    # the cell backend of the hyperparameters, unless set with -cell
+    cell_type = getattr(args, 'cell_type', None) or config.cell_type
 
     curModel = GenAdversarialNet(input_size, gan_label_size, num_classes, cell_type,
                                 args.train=='train', batch_size, vocabulary_size,
@@ -220,77 +243,61 @@ def run_gan(args):
         else:
             for i in xrange(i_stopped, NUM_EPOCHS):
                 print "Running epoch ({0})...".format(i)
-                random.shuffle(dateset_filenames)
-                for j, data_file in enumerate(dateset_filenames):
-                    # Get train data - into feed_dict
-                    data = reader.read_abc_pickle(data_file)
-                    random.shuffle(data)
-                    data_batches = reader.abc_batch(data, n=batch_size/2)
-                    for k, data_batch in enumerate(data_batches):
-                        meta_batch, input_window_batch, output_window_batch = tuple([list(tup) for tup in zip(*data_batch)])
-                        new_meta_batch = utils_runtime.encode_meta_batch(meta_vocabulary, meta_batch)
-                        
-                        for it in range(0, 10):
-                            noise_meta_batch = [utils_runtime.create_noise_meta(meta_vocabulary) for l in xrange(batch_size/2)]
-                            new_noise_meta_batch = utils_runtime.encode_meta_batch(meta_vocabulary, noise_meta_batch)
-                            noise_input_window_batch = [np.random.randint(vocabulary_size, size=window_sz) for l in xrange(batch_size/2)]
-                            initial_state_batch = [[np.zeros(curModel.config.hidden_size) for entry in xrange(batch_size/2)] for layer in xrange(curModel.config.num_layers)]
-                            gan_labels = np.asarray([int(m[0]) for m in meta_batch])
-
-                            feed_dict = {
-                                input_placeholder: noise_input_window_batch,
-                                rnn_meta_placeholder: new_noise_meta_batch,
-                                rnn_initial_state_placeholder: initial_state_batch,
-                                rnn_use_meta_placeholder: True
-                            }
-
-                            if args.train == "train":
-                                _, gen_accuracy = session.run([ train_op_gan, gen_accuracy_op], feed_dict=feed_dict)
-
-                            print "Only Generator training loss: {0}".format(gen_accuracy)
-
-
-                        noise_meta_batch = [utils_runtime.create_noise_meta(meta_vocabulary) for l in xrange(batch_size/2)]
-                        new_noise_meta_batch = utils_runtime.encode_meta_batch(meta_vocabulary, noise_meta_batch)
-
-                        noise_input_window_batch = [np.random.randint(vocabulary_size, size=window_sz) for l in xrange(batch_size/2)]
-                        noise_input_window_batch += input_window_batch
-
-                        initial_state_batch = [[np.zeros(curModel.config.hidden_size) for entry in xrange(batch_size/2)] for layer in xrange(curModel.config.num_layers)]
-                        gan_labels = np.asarray([int(m[0]) for m in meta_batch])
-
+                # Get train data - into feed_dict
+                data_batches = reader.dataset_batches(dataset_dir, batch_size/2, window_spec=window_spec)
+                # the noise batches are generated in the background while the current steps run
+                gan_batches = utils_runtime.prefetch(data_batches,
+                                    lambda data_batch: build_gan_batch(curModel, meta_vocabulary, vocabulary_size, data_batch),
+                                    depth=args.prefetch, num_threads=args.prefetch_threads)
+                for k, (generator_batches, discriminator_batch) in enumerate(gan_batches):
+                    for noise_input_window_batch, new_noise_meta_batch, initial_state_batch in generator_batches:
                         feed_dict = {
                             input_placeholder: noise_input_window_batch,
-                            label_placeholder: gan_labels,
                             rnn_meta_placeholder: new_noise_meta_batch,
                             rnn_initial_state_placeholder: initial_state_batch,
                             rnn_use_meta_placeholder: True
                         }
 
-                        # summary, conf, accuracy = curModel.run(args, session, feed_values)
-
                         if args.train == "train":
-                    		_, _ , curLoss, classLoss, accuracy, gen_accuracy = session.run([train_op_d, train_op_gan, loss_op,
-                                                                             class_loss, accuracy_op, gen_accuracy_op], feed_dict=feed_dict)
-                    	else: # Sample case not necessary b/c function will only be called during normal runs
-                            pass
-                            # summary, loss, probabilities, prediction, accuracy, confusion_matrix = session.run([self.summary_op, self.loss_op, self.probabilities_op, self.prediction_op, self.accuracy_op, self.confusion_matrix], feed_dict=feed_dict)
-
-                        print "The current total Discriminator loss is {0} in epoch {1}".format(curLoss, i)
-                        print "The current Class loss for real data is {0} in epoch {1}".format(classLoss, i)
-                        print "The current accuracy for real data is {0} in epoch {1}".format(accuracy, i)
-                        print "The current accuracy for generator is {0} in epoch {1} \n".format(gen_accuracy, i)
-                        # file_writer.add_summary(summary, step)
-                        #
-                        # # Update confusion matrix
-                        # confusion_matrix += conf
-                        #
-                        # # Record batch accuracies for test code
-                        # if args.train == "test" or args.train == 'dev':
-                        #     batch_accuracies.append(accuracy)
-                        #
-                        # # Processed another batch
-                        # step += 1
+                            _, gen_accuracy = session.run([ train_op_gan, gen_accuracy_op], feed_dict=feed_dict)
+
+                        print "Only Generator training loss: {0}".format(gen_accuracy)
+
+
+                    noise_input_window_batch, gan_labels, new_noise_meta_batch, initial_state_batch = discriminator_batch
+
+                    feed_dict = {
+                        input_placeholder: noise_input_window_batch,
+                        label_placeholder: gan_labels,
+                        rnn_meta_placeholder: new_noise_meta_batch,
+                        rnn_initial_state_placeholder: initial_state_batch,
+                        rnn_use_meta_placeholder: True
+                    }
+
+                    # summary, conf, accuracy = curModel.run(args, session, feed_values)
+
+                    if args.train == "train":
+                            _, _ , curLoss, classLoss, accuracy, gen_accuracy = session.run([train_op_d, train_op_gan, loss_op,
+                                                                         class_loss, accuracy_op, gen_accuracy_op], feed_dict=feed_dict)
+                    else: # Sample case not necessary b/c function will only be called during normal runs
+                        pass
+                        # summary, loss, probabilities, prediction, accuracy, confusion_matrix = session.run([self.summary_op, self.loss_op, self.probabilities_op, self.prediction_op, self.accuracy_op, self.confusion_matrix], feed_dict=feed_dict)
+
+                    print "The current total Discriminator loss is {0} in epoch {1}".format(curLoss, i)
+                    print "The current Class loss for real data is {0} in epoch {1}".format(classLoss, i)
+                    print "The current accuracy for real data is {0} in epoch {1}".format(accuracy, i)
+                    print "The current accuracy for generator is {0} in epoch {1} \n".format(gen_accuracy, i)
+                    # file_writer.add_summary(summary, step)
+                    #
+                    # # Update confusion matrix
+                    # confusion_matrix += conf
+                    #
+                    # # Record batch accuracies for test code
+                    # if args.train == "test" or args.train == 'dev':
+                    #     batch_accuracies.append(accuracy)
+                    #
+                    # # Processed another batch
+                    # step += 1
 
                 if args.train == "train":
                     # Checkpoint model - every epoch
@@ -1,92 +1,450 @@
 import sys
 import os
 import re
+import json
+import time
 import pickle
+import threading
+import Queue
+import BaseHTTPServer
+import SocketServer
 
 from argparse import ArgumentParser
 
-from run import run_model
+import tensorflow as tf
+
+import run
+import reader
+import utils
+import utils_runtime
+from models import Config
+
+# Checkpoint, hyperparameters and data of every model that can be served
+MODELS = {
+	'seq2seq': {'model': 'seq2seq', 'ckpt_dir': '/data/another/seq2seq_25_2/',
+				'hyperparameters': {'meta_embed':160, 'embedding_dims':100, 'keep_prob':0.8,
+									'attention_option':'bahnadau', 'bidirectional':False}},
+	'char': {'model': 'char', 'ckpt_dir': '/data/another/char_50_2/',
+			 'hyperparameters': {'meta_embed':160, 'embedding_dims':20, 'keep_prob':0.8}},
+	'cbow': {'model': 'cbow', 'ckpt_dir': '/data/another/cbow_ckpt/model.ckpt-8',
+			 'hyperparameters': {'meta_embed':100, 'embedding_dims':60, 'keep_prob':0.8}},
+	'duet': {'model': 'seq2seq', 'ckpt_dir': '/data/another/seq2seq_duet/',
+			 'meta_map': 'full_dataset/duet_processed/vocab_map_meta.p',
+			 'music_map': 'full_dataset/duet_processed/vocab_map_music.p',
+			 'warmupData': '/data/full_dataset/duet_processed/checked',
+			 'hyperparameters': {'meta_embed':160, 'embedding_dims':100, 'keep_prob':0.8,
+								 'attention_option':'bahnadau', 'bidirectional':False}},
+}
+
+HANDMADE_DIR = '/data/full_dataset/handmade/'
+WARMUP_DIR = os.path.join(run.DIR_MODIFIER, 'full_dataset/warmup_dataset/checked')
+
+# Metadata fields that can be overridden by a request, besides utils_runtime.META_FIELDS
+NUMERIC_META_FIELDS = ('len', 'complexity')
+# Most tunes a single request can ask for
+MAX_REQUEST_COUNT = 100
+# Seconds a request waits for its tunes before giving up
+REQUEST_TIMEOUT = 300
 
 class ArgumentParserWannabe(object):
     pass
 
-def generateSong(args):
-	args_fake = ArgumentParserWannabe()
-	args_fake.train = 'sample'
-	args_fake.data_dir = ''
-	args_fake.num_epochs = 1
-	args_fake.ckpt_dir = ''
-	args_fake.set_config = 'song_generator.p'
-	args_fake.override = False
-	args_fake.ran_from_script = True
-	args_fake.warm_len = args.warm_len
-
-	if args.temperature==0 and (args.model=='seq2seq' or args.model=='duet'):
-		args_fake.temperature = None
-	else:
-		args_fake.temperature = args.temperature
 
+class SongGenerator(object):
+	"""
+	Keeps one model restored in its own graph and session, so that every
+	generation request is answered from the warm session.
+	"""
+
+	def __init__(self, name, ckpt_num=-1, cell_type=None, batch_size=1):
+		"""
+		@cell_type - cell backend, the one of the model hyperparameters if None
+		@batch_size - rows per decode of the seq2seq models, whose graph has a fixed batch size
+		"""
+		spec = MODELS[name]
+		self.name = name
+		self.model = spec['model']
+		self.warmup_dir = spec.get('warmupData')
+
+		if 'meta_map' in spec:
+			self.meta_map = pickle.load(open(os.path.join(run.DIR_MODIFIER, spec['meta_map']),'rb'))
+			music_map = pickle.load(open(os.path.join(run.DIR_MODIFIER, spec['music_map']),'rb'))
+		else:
+			self.meta_map = run.meta_map
+			music_map = run.music_map
+		self.music_map = run.build_vocabulary(music_map, self.model)
+
+		# The hyperparameter file is only written once, when the model is loaded
+		hyperparam_path = 'song_generator_{0}.p'.format(name)
+		with open(hyperparam_path,'wb') as f:
+			pickle.dump(spec['hyperparameters'], f)
+		self.cell_type = cell_type or Config(hyperparam_path).cell_type
+
+		ckpt_dir = spec['ckpt_dir']
+		if ckpt_num != -1 and len(re.findall('model.ckpt-[0-9]+', ckpt_dir)) == 0:
+			ckpt_dir = os.path.join(ckpt_dir, 'model.ckpt-'+str(ckpt_num))
+
+		self.args = ArgumentParserWannabe()
+		self.args.model = self.model
+		self.args.ckpt_dir = ckpt_dir
+		self.args.override = False
+
+		if self.model == 'cbow':
+			# CBOW samples from a context window as wide as its training windows
+			config = Config(hyperparam_path)
+			window_spec = (config.stride_sz, config.window_sz, run.NN_TYPES[self.model], config.output_sz)
+			input_size, _ = reader.dataset_dims(run.DEVELOPMENT_DATA, window_spec)
+		else:
+			input_size = 1
+		# The CharRNN sampler and the CBOW take any number of rows
+		batch_size = batch_size if self.model == 'seq2seq' else 1
+		start_encode = self.music_map["<go>"] if self.model == 'seq2seq' else self.music_map["<start>"]
+
+		self.graph = tf.Graph()
+		with self.graph.as_default():
+			self.curModel = run.build_model(self.model, input_size, 1, batch_size, len(self.music_map), self.cell_type,
+											hyperparam_path, start_encode, self.music_map["<end>"], is_train=False)
+			saver = tf.train.Saver()
+			self.session = tf.Session(config=run.GPU_CONFIG, graph=self.graph)
+			_, found_ckpt = utils_runtime.get_checkpoint(self.args, self.session, saver)
+		if not found_ckpt:
+			raise IOError("No checkpoint found for the {0} model in {1}".format(name, ckpt_dir))
+
+		# Generating never adds to the graph
+		self.graph.finalize()
+
+		# Parse and encode the warm start songs now rather than on the first request
+		utils_runtime.getWarmStartIndex(self.meta_map, self.music_map, self.warmup_folder())
+
+
+	def encode_meta_overrides(self, warm_meta, meta_overrides):
+		"""
+		Returns a copy of the per-field @warm_meta with @meta_overrides applied
+		@meta_overrides - {field: value}, e.g. {'R': 'reel', 'K_key': '2', 'len': 30}
+		"""
+		meta = list(warm_meta)
+		for field, value in meta_overrides.iteritems():
+			if field in utils_runtime.META_FIELDS:
+				if str(value) not in self.meta_map[field]:
+					raise ValueError("Unknown {0} value: {1}".format(field, value))
+				meta[utils_runtime.META_FIELDS.index(field)] = self.meta_map[field][str(value)]
+			elif field in NUMERIC_META_FIELDS:
+				meta[len(utils_runtime.META_FIELDS) + NUMERIC_META_FIELDS.index(field)] = int(value)
+			else:
+				raise ValueError("Unknown metadata field: {0}".format(field))
+		return meta
+
+
+	def warmup_folder(self, real_song=''):
+		if self.warmup_dir is not None:
+			return self.warmup_dir
+		elif len(real_song) != 0:
+			return HANDMADE_DIR + real_song
+		else:
+			return WARMUP_DIR
+
+
+	def check_request(self, meta_overrides, real_song='', warm_len=10, count=1):
+		"""
+		Raises a ValueError for a request that cannot be generated
+		"""
+		if not 1 <= count <= MAX_REQUEST_COUNT:
+			raise ValueError("count must be between 1 and {0}".format(MAX_REQUEST_COUNT))
+		if warm_len < -1:
+			raise ValueError("warm_len must be at least 0, or -1 for whole songs")
+		self.encode_meta_overrides([0]*reader.NUM_META, meta_overrides)
+		dataFolder = self.warmup_folder(real_song)
+		if not os.path.exists(dataFolder):
+			raise ValueError("No warm start data for {0}".format(real_song))
+
+		# warm_start falls back to songs of any metadata, so only the length has to be satisfiable
+		if self.model == 'cbow':
+			warm_len = self.curModel.input_size
+		_, songs = utils_runtime.warmStartSongs(warm_len, self.meta_map, self.music_map, dataFolder)
+		if len(songs) == 0:
+			raise ValueError("No song can warm-start {0} characters".format(warm_len))
+
+
+	def warm_start(self, warm_len, real_song='', meta_overrides=None):
+		"""
+		Samples a warm start, from a song with the one-hot metadata of @meta_overrides if there is one
+		"""
+		dataFolder = self.warmup_folder(real_song)
+		meta_filter = dict((field, value) for field, value in (meta_overrides or {}).iteritems()
+						   if field in utils_runtime.META_FIELDS)
+
+		if self.model == 'cbow':
+			warm_len = self.curModel.input_size
+		try:
+			return utils_runtime.genWarmStartDataset(warm_len, self.meta_map, self.music_map,
+													 dataFolder=dataFolder, meta_filter=meta_filter)
+		except ValueError:
+			if not meta_filter:
+				raise
+			return utils_runtime.genWarmStartDataset(warm_len, self.meta_map, self.music_map, dataFolder=dataFolder)
+
+
+	def generate(self, temperature=1.0, warm_len=10, meta_overrides=None, count=1, real_song=''):
+		"""
+		Generates @count tunes, each from its own warm start of @warm_len characters
+		@temperature - sampling temperature, 0 for the most likely characters
+		Returns the tunes in .abc format
+		"""
+		return self.generate_rows([(temperature, warm_len, meta_overrides or {}, real_song)]*count)
+
+
+	def generate_rows(self, rows):
+		"""
+		Generates one tune per row, sampling all the rows together
+		@rows - list of (temperature, warm_len, meta_overrides, real_song) requests
+		Returns the tunes in .abc format
+		"""
+		warm_starts = [self.warm_start(warm_len, real_song, meta_overrides) for _, warm_len, meta_overrides, real_song in rows]
+		meta_batch = [self.encode_meta_overrides(warm_meta, row[2]) for (warm_meta, _), row in zip(warm_starts, rows)]
+		encoded_meta_batch = utils_runtime.encode_meta_batch(self.meta_map, meta_batch)
+		warm_chars_batch = [warm_chars for _, warm_chars in warm_starts]
+
+		if self.model == 'char':
+			generated_batch = run.sample_CharRNN(self.args, self.curModel, self.session, warm_chars_batch,
+												 encoded_meta_batch, [row[0] for row in rows])
+		elif self.model == 'seq2seq':
+			predictions = run.sample_Seq2Seq_batch(self.args, self.curModel, self.cell_type, self.session, warm_chars_batch,
+												   encoded_meta_batch, [row[0] for row in rows], self.music_map)
+			generated_batch = [warm_chars + prediction for warm_chars, prediction in zip(warm_chars_batch, predictions)]
+		else:
+			# Currently chopping off the first and last char regardless if its <end> or not
+			generated_batch = [run.sample_CBOW(self.args, self.curModel, self.session, warm_chars, row[0])[1:-1]
+							   for warm_chars, row in zip(warm_chars_batch, rows)]
+
+		return [self.clean_tune(utils.encoding2ABC(meta, generated, self.meta_map, self.music_map))
+				for meta, generated in zip(meta_batch, generated_batch)]
+
+
+	def clean_tune(self, generated):
+		if self.name == 'duet':
+			generated = generated.replace('%','\n')
+		generated = generated.replace('<start>','').replace('<end>','')
+
+		long_num = re.findall('[0-9][0-9]+', generated)
+		for longint in long_num:
+			generated = generated.replace(longint, longint[0])
+		return generated
+
+
+	def close(self):
+		self.session.close()
+
+
+class GenerationTimeout(Exception):
+	pass
+
+
+class GenerationRequest(object):
+	"""
+	Tunes of one request to a GenerationScheduler, filled in as its rows are sampled
+	"""
+
+	def __init__(self, count):
+		self.tunes = [None]*count
+		self.remaining = count
+		self.error = None
+		self.lock = threading.Lock()
+		self.done = threading.Event()
+		if count == 0:
+			self.done.set()
+
+	def set_tune(self, index, tune):
+		with self.lock:
+			self.tunes[index] = tune
+			self.remaining -= 1
+			if self.remaining == 0:
+				self.done.set()
+
+	def fail(self, error):
+		self.error = error
+		self.done.set()
+
+	def result(self, timeout=REQUEST_TIMEOUT):
+		"""
+		Waits for all the tunes of the request, re-raising the error of a failed batch
+		@timeout - seconds to wait before raising a GenerationTimeout
+		"""
+		if not self.done.wait(timeout):
+			raise GenerationTimeout("Generation timed out after {0} seconds".format(timeout))
+		if self.error is not None:
+			raise self.error
+		return self.tunes
+
+
+class GenerationScheduler(object):
+	"""
+	Micro-batches the requests to one SongGenerator. A worker thread waits for
+	a first row, collects the rows queued in the next @max_wait seconds up to
+	@max_batch rows, and samples them as one batch (SongGenerator.generate_rows),
+	each row with its own temperature and metadata. Every request gets its tunes
+	as soon as the batch holding its last row is done.
+	"""
+
+	def __init__(self, generator, max_batch=32, max_wait=0.01):
+		self.generator = generator
+		self.max_batch = max_batch
+		self.max_wait = max_wait
+		self.queue = Queue.Queue()
+
+		self.worker = threading.Thread(target=self._run)
+		self.worker.daemon = True
+		self.worker.start()
+
+	def submit(self, temperature=1.0, warm_len=10, meta_overrides=None, count=1, real_song=''):
+		"""
+		Queues @count rows, see SongGenerator.generate. Returns a GenerationRequest.
+		"""
+		meta_overrides = meta_overrides or {}
+		# Bad requests are refused here rather than failing a whole batch
+		self.generator.check_request(meta_overrides, real_song, warm_len, count)
+
+		request = GenerationRequest(count)
+		for index in xrange(count):
+			self.queue.put((request, index, (temperature, warm_len, meta_overrides, real_song)))
+		return request
+
+	def generate(self, temperature=1.0, warm_len=10, meta_overrides=None, count=1, real_song='', timeout=REQUEST_TIMEOUT):
+		return self.submit(temperature, warm_len, meta_overrides, count, real_song).result(timeout)
+
+	def _next_batch(self):
+		batch = [self.queue.get()]
+		if batch[0] is None:
+			return None
+
+		deadline = time.time() + self.max_wait
+		while len(batch) < self.max_batch:
+			timeout = deadline - time.time()
+			if timeout <= 0:
+				break
+			try:
+				row = self.queue.get(timeout=timeout)
+			except Queue.Empty:
+				break
+			if row is None:
+				# finish this batch, then stop
+				self.queue.put(None)
+				break
+			batch.append(row)
+		return batch
+
+	def _run(self):
+		while True:
+			batch = self._next_batch()
+			if batch is None:
+				return
+
+			try:
+				tunes = self.generator.generate_rows([row for _, _, row in batch])
+			except Exception as e:
+				for request, _, _ in batch:
+					request.fail(e)
+				continue
+
+			for (request, index, _), tune in zip(batch, tunes):
+				request.set_tune(index, tune)
+
+	def close(self):
+		self.queue.put(None)
+		self.worker.join()
+		self.generator.close()
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+
+class SongRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""
+	GET /models lists the loaded models.
+	POST /generate takes a JSON request, e.g.
+		{"model": "char", "temperature": 1.0, "warm_len": 10, "meta": {"R": "reel"}, "count": 2}
+	and answers {"model": "char", "tunes": [...]}.
+	"""
+
+	def send_json(self, code, content):
+		body = json.dumps(content)
+		self.send_response(code)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_GET(self):
+		if self.path == '/models':
+			self.send_json(200, {'models': sorted(self.server.schedulers.keys())})
+		else:
+			self.send_json(404, {'error': 'Unknown path {0}'.format(self.path)})
+
+	def do_POST(self):
+		if self.path != '/generate':
+			self.send_json(404, {'error': 'Unknown path {0}'.format(self.path)})
+			return
+
+		try:
+			request = json.loads(self.rfile.read(int(self.headers.getheader('Content-Length', 0))))
+			name = request.get('model', self.server.default_model)
+			if name not in self.server.schedulers:
+				raise ValueError("Model {0} is not loaded".format(name))
+			pending = self.server.schedulers[name].submit(temperature=float(request.get('temperature', 1.0)),
+														  warm_len=int(request.get('warm_len', 10)),
+														  meta_overrides=request.get('meta', {}),
+														  count=int(request.get('count', 1)),
+														  real_song=request.get('real_song', ''))
+		except (ValueError, KeyError, TypeError, AttributeError) as e:
+			self.send_json(400, {'error': str(e)})
+			return
+
+		try:
+			tunes = pending.result(self.server.request_timeout)
+		except GenerationTimeout as e:
+			self.send_json(503, {'error': str(e)})
+			return
+		except Exception as e:
+			self.send_json(500, {'error': str(e)})
+			return
+
+		self.send_json(200, {'model': name, 'tunes': tunes})
+
+
+def serve(generators, port, host='localhost', max_batch=32, max_wait=0.01, timeout=REQUEST_TIMEOUT):
+	"""
+	Serves the loaded @generators ({name: SongGenerator}) over HTTP until interrupted,
+	concurrent requests to the same model are micro-batched (see GenerationScheduler)
+	@timeout - seconds a request waits for its tunes before a 503
+	"""
+	server = ThreadingHTTPServer((host, port), SongRequestHandler)
+	server.schedulers = dict((name, GenerationScheduler(generator, max_batch, max_wait))
+							 for name, generator in generators.iteritems())
+	server.default_model = sorted(generators.keys())[0]
+	server.request_timeout = timeout
+	print "Serving {0} on http://{1}:{2}".format(', '.join(sorted(generators.keys())), host, port)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		for scheduler in server.schedulers.values():
+			scheduler.close()
+
+
+def generateSong(args):
 	sys.stdout = open(os.devnull, "w")
+	generator = SongGenerator(args.model[0], ckpt_num=args.ckpt_num)
 
-	if len(args.real_song) != 0:
-		args_fake.warmupData = '/data/full_dataset/handmade/' + args.real_song
-
-	ckpt_modifier = '' if args.ckpt_num==-1 else ('model.ckpt-'+str(args.ckpt_num))
-	
-	if args.model=='seq2seq':
-		args_fake.model = 'seq2seq'
-		args_fake.ckpt_dir = '/data/another/seq2seq_25_2/'+ckpt_modifier
-
-		paramDict = {'meta_embed':160, 'embedding_dims':100, 'keep_prob':0.8,
-					 'attention_option':'bahnadau', 'bidirectional':False}
-		with open(args_fake.set_config,'wb') as f:
-			pickle.dump(paramDict, f)
-
-		generated = run_model(args_fake)
-
-	elif args.model=='char':
-		args_fake.model = 'char'
-		args_fake.ckpt_dir = '/data/another/char_50_2/'+ckpt_modifier
-
-		paramDict = {'meta_embed':160, 'embedding_dims':20, 'keep_prob':0.8}
-		with open(args_fake.set_config,'wb') as f:
-			pickle.dump(paramDict, f)
-		
-		generated = run_model(args_fake)
-
-	elif args.model=='cbow':
-		args_fake.model = 'cbow'
-		args_fake.ckpt_dir = '/data/another/cbow_ckpt/model.ckpt-8'
-
-		paramDict = {'meta_embed':100, 'embedding_dims':60, 'keep_prob':0.8}
-		with open(args_fake.set_config,'wb') as f:
-			pickle.dump(paramDict, f)
-		
-		generated = run_model(args_fake)
-
-	elif args.model=='duet':
-		args_fake.model = 'seq2seq'
-		args_fake.ckpt_dir = '/data/another/seq2seq_duet/'+ckpt_modifier
-		args_fake.meta_map = 'full_dataset/duet_processed/vocab_map_meta.p'
-		args_fake.music_map = 'full_dataset/duet_processed/vocab_map_music.p'
-		args_fake.warmupData = '/data/full_dataset/duet_processed/checked'
-
-		paramDict = {'meta_embed':160, 'embedding_dims':100, 'keep_prob':0.8,
-					 'attention_option':'bahnadau', 'bidirectional':False}
-		with open(args_fake.set_config,'wb') as f:
-			pickle.dump(paramDict, f)
-		
-		generated = run_model(args_fake).replace('%','\n')
-
-	generated = generated.replace('<start>','').replace('<end>','')
-
-	long_num = re.findall('[0-9][0-9]+', generated)
-	for longint in long_num:
-		generated = generated.replace(longint, longint[0])
+	tunes = generator.generate(temperature=args.temperature, warm_len=args.warm_len,
+							   count=args.count, real_song=args.real_song)
+	generator.close()
 
 	sys.stdout = sys.__stdout__
-	print '-'*50
-	print generated
+	for generated in tunes:
+		print '-'*50
+		print generated
 
 def parseCommandLineSong():
 	desc = u'{0} [Args] [Options]\nDetailed options -h or --help'.format(__file__)
@@ -94,17 +452,27 @@ def parseCommandLineSong():
 
 	print("Parsing Command Line Arguments...")
 	requiredModel = parser.add_argument_group('Required Model arguments')
-	requiredModel.add_argument('-m', choices = ["seq2seq", "char", "cbow", "duet"], type = str,
-						dest = 'model', required = True, help = 'Type of model to run')
+	requiredModel.add_argument('-m', choices = ["seq2seq", "char", "cbow", "duet"], type = str, nargs = '+',
+						dest = 'model', required = True, help = 'Type of model to run (several can be served)')
 
-	parser.add_argument('-r', dest='real_song', default='', 
+	parser.add_argument('-r', dest='real_song', default='',
 						type=str, help='Sample from a real song')
-	parser.add_argument('-t', dest='temperature', default=1.0, 
+	parser.add_argument('-t', dest='temperature', default=1.0,
 						type=float, help='Temperature')
-	parser.add_argument('-w', dest='warm_len', default=10, 
+	parser.add_argument('-w', dest='warm_len', default=10,
 						type=int, help='Warm start length')
-	parser.add_argument('-n', dest='ckpt_num', default=-1, 
+	parser.add_argument('-n', dest='ckpt_num', default=-1,
 						type=int, help='Checkpoint Number')
+	parser.add_argument('-count', dest='count', default=1,
+						type=int, help='Number of songs to generate')
+	parser.add_argument('-s', dest='port', default=0,
+						type=int, help='Keep the models loaded and serve requests on this port')
+	parser.add_argument('-max_batch', dest='max_batch', default=32,
+						type=int, help='Most songs sampled together when serving')
+	parser.add_argument('-max_wait', dest='max_wait', default=10,
+						type=int, help='Milliseconds to wait for more requests before sampling a batch when serving')
+	parser.add_argument('-timeout', dest='timeout', default=REQUEST_TIMEOUT,
+						type=int, help='Seconds a served request waits for its tunes before a 503')
 
 	args = parser.parse_args()
 	return args
@@ -112,4 +480,8 @@ def parseCommandLineSong():
 if __name__ == "__main__":
 	args = parseCommandLineSong()
 
-	generateSong(args)
\ No newline at end of file
+	if args.port:
+		generators = dict((name, SongGenerator(name, ckpt_num=args.ckpt_num, batch_size=args.max_batch)) for name in args.model)
+		serve(generators, args.port, max_batch=args.max_batch, max_wait=args.max_wait/1000.0, timeout=args.timeout)
+	else:
+		generateSong(args)
@@ -1,79 +1,140 @@
 import re
 import os
-import pickle
 import datetime
 
-from utils_hyperparam import OUTPUT_FILE
+import numpy as np
+import tensorflow as tf
 
-TMP_HYPER_PICKLE = 'tmp_hyperparam.p'
+import run
+import reader
+import utils_runtime
 
 #-----------CHANGE THESE PARAMETERS--------------------------
 TRAIN = '/data/full_dataset/char_rnn_dataset/nn_input_train_stride_25_window_10_nnType_char_rnn_shuffled'
 CKPT_DIR = '/data/another/char_10/'
 MODEL_TYPE = 'char'
+HYPERPARAM = '' # hyperparameter pickle the checkpoints were trained with, '' for the defaults
 #------------------------------------------------------------
 
 TEST = TRAIN.replace('train', 'test')
 DEV = TRAIN.replace('train', 'dev')
 
-def runTests(ckptList, dataset):
-	for ckptPath in ckptList:
-		cmd = 'python run.py -p dev -ckpt %s -m %s -c %s -data %s' \
-							%(ckptPath, MODEL_TYPE, TMP_HYPER_PICKLE, dataset)
+# Checkpoints whose weights are held in memory at once, every split is read once per group
+CKPTS_PER_PASS = 10
 
-		os.system(cmd)
 
-def getTestTrainAccuracies():
-	if os.path.exists(OUTPUT_FILE):
-		os.remove(OUTPUT_FILE)
+class EvalArgs(object):
+	"""
+	The fields of the run.py command line used to feed the model
+	"""
+	def __init__(self, model):
+		self.model = model
+		self.train = 'dev'
 
-	# first scrape the model names
+
+def listCheckpoints(ckptDir):
+	"""
+	Returns the paths of the checkpoints under @ckptDir, sorted by epoch
+	"""
 	ckptSet = set()
-	for filename in os.listdir(CKPT_DIR):
+	for filename in os.listdir(ckptDir):
 		modelName = re.findall('model.ckpt-[0-9]+', filename)
 		if len(modelName)==0:
 			continue
 		ckptSet.add(modelName[0])
 
-	ckptList = []
-	for i in range(len(ckptSet)):
-		for j,cName in enumerate(ckptSet):
-			if str(i) in cName:
-				break
-
-		ckptList.append(cName)
-
-	ckptList = [os.path.join(CKPT_DIR, ckptName) for ckptName in ckptList]
-
-	# dump a fake pickle file to trick run.py to think that we are doing
-	# hyperparameter tuning
-	emptyDict = {}
-	pickle.dump(emptyDict, open(TMP_HYPER_PICKLE, 'wb'))
-
-	with open(OUTPUT_FILE, 'a') as f:
-		f.write('Train Dataset:\n')
-	runTests(ckptList, TRAIN)
-
-	with open(OUTPUT_FILE, 'a') as f:
-		f.write('\nTest Dataset:\n')
-	runTests(ckptList, TEST)
-
-	with open(OUTPUT_FILE, 'a') as f:
-		f.write('\nDev Dataset:\n')
-	runTests(ckptList, DEV)
-
-	# rename the result file with a timestamp
+	ckptList = sorted(ckptSet, key=lambda ckptName: int(ckptName.split('-')[-1]))
+	return [os.path.join(ckptDir, ckptName) for ckptName in ckptList]
+
+
+class CheckpointSwapper(object):
+	"""
+	Keeps the weights of several checkpoints in memory, and loads any of them into the
+	variables of the model with assign ops built once.
+	"""
+	def __init__(self, variables):
+		self.variables = variables
+		self.placeholders = [tf.placeholder(var.dtype.base_dtype, shape=var.get_shape()) for var in variables]
+		self.assign_op = tf.group(*[var.assign(ph) for var, ph in zip(variables, self.placeholders)])
+		self.weights = []
+
+	def read(self, ckptList):
+		self.weights = []
+		for ckptPath in ckptList:
+			ckptReader = tf.train.NewCheckpointReader(ckptPath)
+			self.weights.append(dict((ph, ckptReader.get_tensor(var.op.name))
+								for var, ph in zip(self.variables, self.placeholders)))
+
+	def load(self, session, idx):
+		session.run(self.assign_op, feed_dict=self.weights[idx])
+
+
+def evaluateCheckpoints(session, args, curModel, swapper, numCkpts, dataset, window_spec):
+	"""
+	Reads @dataset once, and returns the mean batch accuracy of each of the @numCkpts
+	checkpoints held by @swapper
+	"""
+	batch_accuracies = [[] for idx in xrange(numCkpts)]
+
+	data_batches = reader.dataset_batches(dataset, run.BATCH_SIZE, shuffle=False, window_spec=window_spec)
+	feed_batches = utils_runtime.prefetch(data_batches,
+						lambda data_batch: utils_runtime.batch_feed_values(args, curModel, run.meta_map, data_batch))
+	for feed_values in feed_batches:
+		feed_dict = curModel._feed_dict(feed_values)
+		for idx in xrange(numCkpts):
+			swapper.load(session, idx)
+			batch_accuracies[idx].append(session.run(curModel.accuracy_op, feed_dict=feed_dict))
+
+	return [np.mean(accuracies) for accuracies in batch_accuracies]
+
+
+def getTestTrainAccuracies(ckptDir=CKPT_DIR, train=TRAIN, modelType=MODEL_TYPE, hyperparamPath=HYPERPARAM):
+	"""
+	Writes the train, test and dev accuracies of every checkpoint under @ckptDir to
+	one table, building the model once for all of them
+	"""
+	datasets = [('Train', train), ('Test', train.replace('train', 'test')), ('Dev', train.replace('train', 'dev'))]
+	ckptList = listCheckpoints(ckptDir)
+
+	args = EvalArgs(modelType)
+	config = run.Config(hyperparamPath)
+	window_spec = (config.stride_sz, config.window_sz, run.NN_TYPES[modelType], config.output_sz)
+	window_sz, label_sz = reader.dataset_dims(train, window_spec)
+
+	vocabulary = run.build_vocabulary(run.music_map, modelType)
+	curModel = run.build_model(modelType, window_sz, label_sz, run.BATCH_SIZE, len(vocabulary), config.cell_type,
+							   hyperparamPath, vocabulary["<start>"], vocabulary["<end>"], is_train=False)
+	swapper = CheckpointSwapper(tf.global_variables())
+
+	accuracies = dict((ckptPath, {}) for ckptPath in ckptList)
+	with tf.Session(config=run.GPU_CONFIG) as session:
+		session.graph.finalize()
+
+		for start in xrange(0, len(ckptList), CKPTS_PER_PASS):
+			ckptGroup = ckptList[start:start+CKPTS_PER_PASS]
+			swapper.read(ckptGroup)
+
+			for splitName, dataset in datasets:
+				print 'Evaluating %d checkpoints on %s' %(len(ckptGroup), dataset)
+				splitAccuracies = evaluateCheckpoints(session, args, curModel, swapper, len(ckptGroup),
+													  dataset, window_spec)
+				for ckptPath, accuracy in zip(ckptGroup, splitAccuracies):
+					accuracies[ckptPath][splitName] = accuracy
+
+	# write the table with a timestamp
 	now = datetime.datetime.now()
-	resultName = '%s_%s_%s.txt' %(TRAIN[(TRAIN.rfind('/')+1):], MODEL_TYPE, 
+	resultName = '%s_%s_%s.txt' %(train[(train.rfind('/')+1):], modelType,
 							   now.strftime("%B_%d_%H_%M_%S"))
 
-	with open(OUTPUT_FILE, 'r') as f, open(resultName, 'w') as g:
-		txt = f.read()
-		g.write(txt.replace('Dev set accuracy: ',''))
+	with open(resultName, 'w') as f:
+		f.write('\t'.join(['Checkpoint'] + [splitName for splitName, dataset in datasets]) + '\n')
+		for ckptPath in ckptList:
+			f.write('\t'.join([os.path.basename(ckptPath)] +
+					['%0.5f' %accuracies[ckptPath][splitName] for splitName, dataset in datasets]) + '\n')
 
-	os.remove(OUTPUT_FILE)
+	print 'Accuracies written to %s' %resultName
 
 
 
 if __name__ == "__main__":
-	getTestTrainAccuracies()
\ No newline at end of file
+	getTestTrainAccuracies()
@@ -5,6 +5,8 @@ import re
 import pickle
 import random
 
+from fractions import Fraction
+
 
 import tensorflow as tf
 
@@ -117,24 +119,132 @@ def datasetSplit(folderName, setRatio):
 def findNumMeasures(music):
 	return music.replace('||','|').replace('|||','|').count('|')
 
+# Pure python transposition, the counterpart of abc2abc -t
+#------------------------------------
+ABC_PITCH_RE = re.compile(r"(\^{1,2}|_{1,2}|=)?([A-Ga-g])([,']*)")
+ABC_ACCIDENTALS = {'^^':2, '^':1, '=':0, '_':-1, '__':-2}
+NOTE_LETTERS = 'CDEFGAB'
+NOTE_SEMITONES = (0, 2, 4, 5, 7, 9, 11)
+
+def _transposeKey(keyStr, shift):
+	"""
+	Returns the key field @keyStr (ex. 'Dmix') transposed by @shift semitones,
+	and the number of letters its tonic moves by
+	"""
+	num_flats, mode = keySigDecomposer(keyStr)
+	# 7 sharps more for every semitone up, spelled with 6 sharps at most and 5 flats at most
+	num_sharps = (-int(num_flats) + 7*shift + 5) % 12 - 5
+	newKey = keySigComposer(-num_sharps, mode)
+
+	oldTonic = NOTE_LETTERS.index(keySigComposer(num_flats, mode)[2])
+	newTonic = NOTE_LETTERS.index(newKey[2])
+	letterShifts = [(newTonic-oldTonic) % 7, (newTonic-oldTonic) % 7 - 7]
+	letterShift = min(letterShifts, key=lambda d: abs(_letterSemitones(oldTonic+d) - _letterSemitones(oldTonic) - shift))
+	return newKey[2:-1], letterShift
+
+def _letterSemitones(step):
+	"""
+	Returns the semitones of the natural note @step letters above the C below middle C
+	"""
+	return NOTE_SEMITONES[step % 7] + 12*(step // 7)
+
+def _transposeNote(accidental, letter, octave, shift, letterShift):
+	"""
+	Moves the note by @letterShift letters, and respells its explicit @accidental so that
+	it moves by @shift semitones. Notes without accidentals follow the new key.
+	"""
+	step = NOTE_LETTERS.index(letter.upper()) + (7 if letter.islower() else 0) \
+				+ 7*(octave.count("'") - octave.count(','))
+	newStep = step + letterShift
+
+	newAccidental = ''
+	if accidental:
+		alteration = ABC_ACCIDENTALS[accidental] + shift - (_letterSemitones(newStep) - _letterSemitones(step))
+		alteration = max(-2, min(2, alteration))
+		newAccidental = [acc for acc, alt in ABC_ACCIDENTALS.iteritems() if alt == alteration][0]
+
+	newOctave = newStep // 7
+	if newOctave >= 1:
+		return newAccidental + NOTE_LETTERS[newStep % 7].lower() + "'"*(newOctave-1)
+	return newAccidental + NOTE_LETTERS[newStep % 7] + ','*(-newOctave)
+
+def transposeABCStr(fileStr, shifts):
+	"""
+	Transposes the cleaned .abc string @fileStr by every shift in @shifts (semitones).
+	The string is parsed once for all the shifts.
+	Returns the list of transposed strings, or None if the key cannot be read.
+	"""
+	# parse into text, key and note tokens once
+	tokens = []
+	for line in fileStr.split('\n'):
+		if line[:2] == 'K:':
+			tokens.append(('key', 'K:', line[2:], ''))
+		elif re.match('[A-Za-z]:', line):
+			tokens.append(('text', line))
+		else:
+			i = 0
+			while i < len(line):
+				ch = line[i]
+				if ch in '!+"':
+					# decorations and chord symbols are copied as they are
+					end = line.find(ch, i+1)
+					end = len(line) if end < 0 else end+1
+					tokens.append(('text', line[i:end]))
+					i = end
+				elif ch == '[' and re.match(r'\[[A-Za-z]:', line[i:i+3]):
+					end = line.find(']', i)
+					end = len(line) if end < 0 else end
+					if line[i+1] == 'K':
+						tokens.append(('key', '[K:', line[i+3:end], ']'))
+					else:
+						tokens.append(('text', line[i:end+1]))
+					i = end+1
+				else:
+					match = ABC_PITCH_RE.match(line, i)
+					if match is None:
+						tokens.append(('text', ch))
+						i += 1
+					else:
+						tokens.append(('note',) + match.groups())
+						i = match.end()
+		tokens.append(('text', '\n'))
+	tokens.pop()
+
+	transposed = []
+	for shift in shifts:
+		shift = int(shift)
+		outList = []
+		letterShift = 0
+		for token in tokens:
+			if token[0] == 'text':
+				outList.append(token[1])
+			elif token[0] == 'key':
+				try:
+					newKey, letterShift = _transposeKey(token[2], shift)
+				except (ValueError, KeyError, IndexError):
+					return None
+				outList.append(token[1] + newKey + token[3])
+			else:
+				outList.append(_transposeNote(token[1], token[2], token[3], shift, letterShift))
+		transposed.append(''.join(outList))
+
+	return transposed
+
 def transposeABC(fromFile, toFile, shiftLvl):
 	"""
 	Transposes the .abc file in @fromFile by @shiftLvl and saves it to @toFile
-
-	abc2abc.exe taken from http://ifdo.ca/~seymour/runabc/top.html
 	"""
+	with open(fromFile, 'r') as f:
+		fileStr = f.read()
 
-	# am I being ran on a Windows machine ('nt'), or a linux machine('posix')?
-	if os.name=='posix':
-		exe_cmd = 'abc2abc'
-	elif os.name=='nt':
-		exe_cmd = 'abcmidi_win32\\abc2abc.exe'
+	transposed = transposeABCStr(fileStr, [shiftLvl])
+	if transposed is None:
+		print 'Key signature decomposition failed for file: ' + fromFile
+		return
 
-	cmd = '%s "%s" -t %d -e > "%s"' \
-			%(exe_cmd,fromFile,shiftLvl,toFile)
 	print toFile
-
-	os.system(cmd)
+	with open(toFile, 'w') as f:
+		f.write(transposed[0])
 
 MODE_MAJ = 0
 MODE_MIN = 1
@@ -290,6 +400,236 @@ def passesABC2ABC(fromFile):
 
 	return errorCnt==0
 
+# Pure python bar checking, used instead of passesABC2ABC
+#------------------------------------
+ABC_NOTE_RE = re.compile(r"(\^{1,2}|_{1,2}|=)?([A-Ga-gzxyZX])([,']*)([0-9]*)(/*)([0-9]*)")
+ABC_LENGTH_RE = re.compile(r"([0-9]*)(/*)([0-9]*)")
+ABC_BAR_RE = re.compile(r"(::|:*\[?\|+\]?:*|:+)([0-9](?:[,-][0-9])*)?")
+ABC_TUPLET_RE = re.compile(r"\(([0-9])(?::([0-9]?))?(?::([0-9]?))?")
+ABC_DECORATIONS = '.~HLMOPSTuv-)\\'
+
+def _abcLength(num, slashes, den):
+	"""
+	Returns the length multiplier of a note from its (@num, @slashes, @den) suffix, ex. 3/2
+	"""
+	num = int(num) if num else 1
+	if not slashes:
+		return Fraction(num)
+	if den:
+		return Fraction(num, int(den))
+	return Fraction(num, 2**len(slashes))
+
+def _abcFraction(fieldStr):
+	"""
+	Returns the M or L field @fieldStr as a Fraction, None if there is no meter
+	"""
+	fieldStr = fieldStr.strip()
+	if fieldStr == 'C':
+		return Fraction(4, 4)
+	if fieldStr == 'C|':
+		return Fraction(2, 2)
+	match = re.match('([0-9]+)/([0-9]+)$', fieldStr)
+	if match is None:
+		return None
+	return Fraction(int(match.group(1)), int(match.group(2)))
+
+def abcBars(music, meter, unitLength):
+	"""
+	Splits the .abc @music string into bars.
+	Returns a list of (duration, expected duration, bar line closing the bar), durations in
+	multiples of @unitLength, or None if @music contains something that does not parse.
+
+	@meter		- Fraction of the M field, None for no meter
+	@unitLength	- Fraction of the L field
+	"""
+	bars = []
+	duration = Fraction(0)
+	lastNote = None
+	broken = None
+	tupletFactor, tupletLeft = Fraction(1), 0
+
+	i = 0
+	while i < len(music):
+		ch = music[i]
+
+		# bar lines, ex. | || |] [| :| |: :: |1 :|2
+		match = ABC_BAR_RE.match(music, i)
+		if match is not None and (ch != '[' or music[i+1:i+2] == '|'):
+			expected = meter/unitLength if meter is not None else None
+			if duration > 0:
+				bars.append((duration, expected, match.group(0)))
+			duration, lastNote, broken = Fraction(0), None, None
+			i = match.end()
+			continue
+
+		if ch == '[' and re.match(r'\[[A-Za-z]:', music[i:i+3]):
+			# inline field, only the meter and unit length change the bar durations
+			end = music.find(']', i)
+			if end < 0:
+				return None
+			field, value = music[i+1], music[i+3:end]
+			if field == 'M':
+				meter = _abcFraction(value)
+			elif field == 'L':
+				unitLength = _abcFraction(value)
+				if unitLength is None:
+					return None
+			i = end + 1
+			continue
+
+		if ch == '[' and music[i+1:i+2].isdigit():
+			# repeat ending after a bar line, ex. [2
+			match = re.compile('\[[0-9](?:[,-][0-9])*').match(music, i)
+			i = match.end()
+			continue
+
+		if ch in '!+"{':
+			# decorations, chord symbols and grace notes take no time
+			end = music.find({'!':'!', '+':'+', '"':'"', '{':'}'}[ch], i+1)
+			if end < 0:
+				return None
+			i = end + 1
+			continue
+
+		if ch == '(':
+			match = ABC_TUPLET_RE.match(music, i)
+			if match is None:
+				# slur
+				i += 1
+				continue
+			p = int(match.group(1))
+			compound = meter is not None and meter.numerator % 3 == 0 and meter.numerator > 3
+			q = int(match.group(2)) if match.group(2) else {2:3, 3:2, 4:3, 6:2, 8:3}.get(p, 3 if compound else 2)
+			tupletFactor = Fraction(q, p)
+			tupletLeft = int(match.group(3)) if match.group(3) else p
+			i = match.end()
+			continue
+
+		if ch in '<>':
+			# broken rhythm, ex. A>B lengthens A by half and shortens B as much
+			end = i
+			while end < len(music) and music[end] == ch:
+				end += 1
+			if lastNote is None:
+				return None
+			shift = 1 - Fraction(1, 2**(end-i))
+			if ch == '>':
+				duration += lastNote*shift
+				broken = 1 - shift
+			else:
+				duration -= lastNote*shift
+				broken = 1 + shift
+			i = end
+			continue
+
+		if ch in ABC_DECORATIONS:
+			i += 1
+			continue
+
+		if ch == '[':
+			# chord, as long as its first note
+			end = music.find(']', i)
+			if end < 0:
+				return None
+			notes = ABC_NOTE_RE.findall(music[i+1:end])
+			if len(notes) == 0:
+				return None
+			accidental, pitch, octave, num, slashes, den = notes[0]
+			length = _abcLength(num, slashes, den)
+			match = ABC_LENGTH_RE.match(music, end+1)
+			length *= _abcLength(*match.groups())
+			i = match.end()
+		else:
+			match = ABC_NOTE_RE.match(music, i)
+			if match is None:
+				return None
+			accidental, pitch, octave, num, slashes, den = match.groups()
+			i = match.end()
+
+			if pitch == 'y':
+				continue
+			if pitch in 'ZX':
+				# multi measure rest, counted as whole bars
+				numBars = int(num) if num else 1
+				expected = meter/unitLength if meter is not None else None
+				bars.extend([(expected, expected, '|')]*(numBars-1))
+				duration += expected if expected is not None else 0
+				continue
+			length = _abcLength(num, slashes, den)
+
+		if tupletLeft > 0:
+			length *= tupletFactor
+			tupletLeft -= 1
+		if broken is not None:
+			length *= broken
+			broken = None
+		duration += length
+		lastNote = length
+
+	if duration > 0:
+		bars.append((duration, meter/unitLength if meter is not None else None, ''))
+	return bars
+
+def abcBarErrors(bars):
+	"""
+	Returns the (1-indexed) bars of @bars, as returned by abcBars, whose duration does not match the meter.
+	Bars split in two by a repeat or a section line, ex. G2:||:fg, are fine if the halves add up,
+	and so are bars closing a section that make up for the pickup bar.
+	"""
+	pickup = bars[0][0] if len(bars) > 0 and bars[0][1] is not None and bars[0][0] < bars[0][1] else 0
+
+	errors = []
+	i = 0
+	while i < len(bars):
+		duration, expected, barLine = bars[i]
+		if expected is None or duration == expected:
+			i += 1
+			continue
+
+		isSection = (barLine != '|')
+		if isSection and i+1 < len(bars) and duration + bars[i+1][0] == expected:
+			i += 2
+			continue
+		if isSection and i > 0 and duration + pickup == expected:
+			i += 1
+			continue
+
+		errors.append(i+1)
+		i += 1
+	return errors
+
+def passesBarCheck(fileStr):
+	"""
+	Returns true if the music of the cleaned .abc string @fileStr is well formed, and its bars
+	match the M and L fields. Same rule as passesABC2ABC: only the pickup bar at the start and
+	one of the last bars may be off.
+	"""
+	meter, unitLength, music = None, Fraction(1, 8), []
+	for line in fileStr.split('\n'):
+		if re.match('[A-Za-z]:', line):
+			if line[0] == 'M':
+				meter = _abcFraction(line[2:])
+			elif line[0] == 'L':
+				unitLength = _abcFraction(line[2:])
+		elif line.strip() != '':
+			music.append(line.strip())
+	if unitLength is None:
+		return False
+
+	bars = abcBars(''.join(music), meter, unitLength)
+	if bars is None:
+		return False
+
+	errors = abcBarErrors(bars)
+	if len(errors) > 2:
+		return False
+	if len(errors) > 0 and errors[0] == 1:
+		errors = errors[1:]
+	if len(errors) > 0 and abs(len(bars)-errors[-1]) < 3:
+		errors = errors[:-1]
+
+	return len(errors)==0
+
 def encoding2ABC(metaList, musicList, meta_map, music_map, outputname=None, 
 				 vocab_dir=os.path.join(DIR_MODIFIER, 'the_session_processed')):
 	"""
@@ -1,7 +1,13 @@
 import itertools
 import pickle
 import os
+import sys
+import json
+import hashlib
 import datetime
+import math
+import subprocess
+import multiprocessing
 import re
 import ast
 import tensorflow as tf
@@ -24,6 +30,15 @@ else:
 
 DEV_CKPT_DIR = DIR_MODIFIER + '/dev_ckpt'
 
+# Every trial of runHyperparam gets its own directory under TRIALS_DIR,
+# and the finished ones are recorded one JSON per line in TRIALS_FILE
+TRIALS_DIR = DIR_MODIFIER + '/dev_trials'
+TRIALS_FILE = 'trials.jsonl'
+RUN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run.py')
+
+# Limit the math libraries as well as TensorFlow (run.py -threads) when trials share the cores
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS')
+
 def parseHyperTxt(paramTxtF):
 	nameList = []
 	paramList = []
@@ -67,15 +82,110 @@ def parseHyperTxt(paramTxtF):
 
 	return modelType,num_epochs,nameList,paramList
 
-def runHyperparam(paramTxtF, dataset):
+def trialName(modelType, num_epochs, dataset, params):
 	"""
-	Runs the gridsearch for hyperparameter tuning search.
-	The grids are as defined in @paramTxtF
+	Name of the directory of a trial, the same every time for the same run
 	"""
+	paramStr = ','.join('{}: {}'.format(name, par) for name, par in params)
+	trialStr = '%s,%d,%s,%s' %(modelType, num_epochs, dataset, paramStr)
+	return 'trial_' + hashlib.md5(trialStr).hexdigest()[:12]
 
-	if os.path.exists(OUTPUT_FILE):
-		os.remove(OUTPUT_FILE)
-	
+
+def readDevAccuracy(devFilename):
+	"""
+	Returns the last dev set accuracy written by run.py to @devFilename, None if there is none
+	"""
+	if not os.path.exists(devFilename):
+		return None
+
+	accuracy = None
+	with open(devFilename, 'r') as f:
+		for line in f:
+			if 'Dev set accuracy' in line:
+				accuracy = float(line.split(':')[-1])
+	return accuracy
+
+
+def runTrialCommand(trial, phase, num_epochs=None, override=False):
+	"""
+	Runs run.py for the @phase ('train' or 'dev') of @trial, logging to its directory.
+	Returns the exit status.
+	"""
+	cmd = [sys.executable, RUN_SCRIPT, '-p', phase, '-ckpt', trial['ckpt_dir'], '-m', trial['model'],
+		   '-c', trial['config'], '-threads', str(trial['threads'])]
+	if num_epochs is not None:
+		cmd += ['-e', str(num_epochs)]
+	if override:
+		cmd += ['-o']
+	dataset = trial['train'] if phase == 'train' else trial['dev']
+	if dataset != '':
+		cmd += ['-data', dataset]
+
+	env = dict(os.environ)
+	if trial['threads'] > 0:
+		for var in THREAD_ENV_VARS:
+			env[var] = str(trial['threads'])
+
+	with open(os.path.join(trial['dir'], 'run.log'), 'a') as log:
+		log.write(' '.join(cmd) + '\n')
+		log.flush()
+		# run from the trial directory, so that the plots of concurrent trials do not collide
+		return subprocess.call(cmd, cwd=trial['dir'], stdout=log, stderr=subprocess.STDOUT, env=env)
+
+
+def prepareTrial(trial):
+	"""
+	Creates the directory of @trial with its own hyperparameter pickle, whose
+	dev_filename points to the trial directory
+	"""
+	if not os.path.exists(trial['dir']):
+		os.makedirs(trial['dir'])
+
+	paramDict = dict(trial['params'])
+	paramDict['dev_filename'] = trial['dev_file']
+	pickle.dump(paramDict, open(trial['config'], 'wb'))
+
+
+def runTrial(trial):
+	"""
+	Trains @trial up to trial['epochs'] epochs, from scratch or from its last checkpoint
+	if trial['resume'], and evaluates it on the dev set (run by the workers of runTrials)
+	"""
+	prepareTrial(trial)
+	if os.path.exists(trial['dev_file']):
+		os.remove(trial['dev_file'])
+
+	print 'Testing model with param: %s (%d epochs)' %(trial['param_str'], trial['epochs'])
+	status = runTrialCommand(trial, 'train', num_epochs=trial['epochs'], override=not trial['resume'])
+	if status == 0:
+		status = runTrialCommand(trial, 'dev')
+
+	accuracy = readDevAccuracy(trial['dev_file'])
+	print 'Dev set accuracy %s for param: %s (%d epochs)' %(accuracy, trial['param_str'], trial['epochs'])
+	return {'name': trial['name'], 'params': trial['params'], 'epochs': trial['epochs'],
+			'accuracy': accuracy, 'status': 'done' if accuracy is not None else 'failed'}
+
+
+def runTrials(trials, num_workers, trialsDir, results):
+	"""
+	Runs @trials with up to @num_workers of them side by side, recording every result
+	in @trialsDir and the finished ones in @results
+	"""
+	pool = multiprocessing.Pool(num_workers) if num_workers > 1 else None
+	trialResults = pool.imap_unordered(runTrial, trials) if pool else itertools.imap(runTrial, trials)
+	for result in trialResults:
+		recordTrialResult(trialsDir, result)
+		if result['status'] == 'done':
+			results[(result['name'], result['epochs'])] = result
+	if pool:
+		pool.close()
+		pool.join()
+
+
+def createTrials(paramTxtF, dataset, threads_per_trial=0, trialsDir=TRIALS_DIR):
+	"""
+	Returns one trial per hyperparameter combination of @paramTxtF, and the number of epochs
+	"""
 	# parse the paramTxtF
 	modelType, num_epochs, nameList, paramList = parseHyperTxt(paramTxtF)
 
@@ -87,55 +197,139 @@ def runHyperparam(paramTxtF, dataset):
 	dataset_train = dataset
 	dataset_dev = dataset.replace('train','dev')
 
-	count = 0
+	trials = []
 	for param in param_all_combos:
-		# create the param list and pickle it to TMP_HYPER_PICKLE
-		paramDict = {}
-		paramStrList = []
-		for name,par in zip(nameList,param):
-			paramDict[name] = par
-			
-			paramStrList.append('{}: {}'.format(name, par))
-
-		paramStr = ','.join(paramStrList) + '\n'
-
-		pickle.dump(paramDict, open(TMP_HYPER_PICKLE, 'wb'))
-
-		with open(OUTPUT_FILE, 'a') as f:
-			f.write(paramStr)
-
-		# run the model
-		print '='*80
-		print 'Testing model with param: %s' % str(paramDict)
-		print '='*80
-
-		# train the model using the new hyperparameters
-		print '-'*30 + 'TRAINING' + '-'*30
-		if dataset=='':
-			cmd = 'python run.py -p train -o -ckpt %s -m %s -e %d -c %s' \
-								%(DEV_CKPT_DIR, modelType, num_epochs, TMP_HYPER_PICKLE)
-		else:
-			cmd = 'python run.py -p train -o -ckpt %s -m %s -e %d -c %s -data %s' \
-								%(DEV_CKPT_DIR, modelType, num_epochs, TMP_HYPER_PICKLE, dataset_train)
-		os.system(cmd)
-
-		# test the model on the dev set
-		print '-'*30 + 'TESTING DEV' + '-'*30
-		if dataset=='':
-			cmd = 'python run.py -p dev -ckpt %s -m %s -c %s' \
-								%(DEV_CKPT_DIR, modelType, TMP_HYPER_PICKLE)
-		else:
-			cmd = 'python run.py -p dev -ckpt %s -m %s -c %s -data %s' \
-								%(DEV_CKPT_DIR, modelType, TMP_HYPER_PICKLE, dataset_dev)
-		os.system(cmd)
-
-	os.remove(TMP_HYPER_PICKLE)
+		params = zip(nameList, param)
+		name = trialName(modelType, num_epochs, dataset, params)
+		trialDir = os.path.join(trialsDir, name)
+		trials.append({'name': name, 'dir': trialDir, 'model': modelType, 'epochs': num_epochs, 'resume': False,
+					   'params': params, 'param_str': ','.join('{}: {}'.format(n, par) for n, par in params),
+					   'ckpt_dir': os.path.join(trialDir, 'ckpt'), 'config': os.path.join(trialDir, 'hyperparam.p'),
+					   'dev_file': os.path.join(trialDir, 'dev_result.txt'),
+					   'train': dataset_train, 'dev': dataset_dev, 'threads': threads_per_trial})
+	return trials, num_epochs
+
+
+def loadTrialResults(trialsDir):
+	"""
+	Returns {(trial name, epochs): result} of the finished trials recorded in @trialsDir
+	"""
+	results = {}
+	resultsFile = os.path.join(trialsDir, TRIALS_FILE)
+	if os.path.exists(resultsFile):
+		with open(resultsFile, 'r') as f:
+			for line in f:
+				try:
+					result = json.loads(line)
+				except ValueError:
+					# partially written line of a crashed run
+					continue
+				if result['status'] == 'done':
+					results[(result['name'], result['epochs'])] = result
+	return results
+
+
+def recordTrialResult(trialsDir, result):
+	if not os.path.exists(trialsDir):
+		os.makedirs(trialsDir)
+	with open(os.path.join(trialsDir, TRIALS_FILE), 'a') as f:
+		f.write(json.dumps(result) + '\n')
+		f.flush()
+		os.fsync(f.fileno())
+
+
+def writeGridSearchResult(trials, accuracies):
+	"""
+	Writes the {trial name: accuracy} @accuracies of the finished @trials to OUTPUT_FILE
+	in the format read by resultParser, renamed with a timestamp
+	"""
+	with open(OUTPUT_FILE, 'w') as f:
+		for trial in trials:
+			if trial['name'] in accuracies:
+				f.write(trial['param_str'] + '\n')
+				f.write('Dev set accuracy: {0}\n'.format(accuracies[trial['name']]))
 
 	# rename the result file with a timestamp
 	now = datetime.datetime.now()
 	resultName = '%s_%s.txt' %(OUTPUT_FILE.replace('.txt',''), 
 							   now.strftime("%B_%d_%H_%M_%S"))
 	os.rename(OUTPUT_FILE, resultName)
+	return resultName
+
+
+def runHyperparam(paramTxtF, dataset, num_workers=1, threads_per_trial=0, trialsDir=TRIALS_DIR):
+	"""
+	Runs the gridsearch for hyperparameter tuning search.
+	The grids are as defined in @paramTxtF
+
+	Up to @num_workers trials run side by side, each with @threads_per_trial threads
+	(0 for no limit) and its own checkpoint directory and hyperparameter file under @trialsDir.
+	Trials already recorded as finished in @trialsDir are not run again, so a crashed
+	search resumes where it stopped.
+	"""
+	trials, num_epochs = createTrials(paramTxtF, dataset, threads_per_trial, trialsDir)
+
+	results = loadTrialResults(trialsDir)
+	pending = [trial for trial in trials if (trial['name'], num_epochs) not in results]
+	print '[INFO] %d trials already finished, running %d trials with %d workers...' \
+										%(len(trials)-len(pending), len(pending), num_workers)
+
+	runTrials(pending, num_workers, trialsDir, results)
+
+	accuracies = dict((trial['name'], results[(trial['name'], num_epochs)]['accuracy'])
+						for trial in trials if (trial['name'], num_epochs) in results)
+	resultName = writeGridSearchResult(trials, accuracies)
+	print '[INFO] Results written to %s' % resultName
+
+
+def halvingRungs(num_epochs, min_epochs, eta):
+	"""
+	Returns the number of epochs the trials of runSuccessiveHalving are trained for before each cut
+	"""
+	if eta < 2 or min_epochs < 1:
+		raise ValueError('Successive halving needs eta >= 2 and min_epochs >= 1')
+
+	rungs = []
+	epochs = min_epochs
+	while epochs < num_epochs:
+		rungs.append(epochs)
+		epochs *= eta
+	return rungs + [num_epochs]
+
+
+def runSuccessiveHalving(paramTxtF, dataset, num_workers=1, threads_per_trial=0, trialsDir=TRIALS_DIR,
+						 eta=3, min_epochs=1):
+	"""
+	Runs the successive halving search over the grid defined in @paramTxtF.
+
+	Every combination is trained for @min_epochs epochs and evaluated on the dev set, then
+	only the best 1/@eta of them keep training from their checkpoints, for @eta times as many
+	epochs, up to the number of epochs of @paramTxtF. Trials run and resume as in runHyperparam.
+	"""
+	trials, num_epochs = createTrials(paramTxtF, dataset, threads_per_trial, trialsDir)
+	rungs = halvingRungs(num_epochs, min_epochs, eta)
+	print '[INFO] Successive halving over %s epochs...' % rungs
+
+	results = loadTrialResults(trialsDir)
+	accuracies = {}
+	survivors = trials
+	for rung, epochs in enumerate(rungs):
+		pending = [dict(trial, epochs=epochs, resume=(rung > 0))
+					for trial in survivors if (trial['name'], epochs) not in results]
+		print '[INFO] Rung %d: %d trials trained for %d epochs, %d already finished...' \
+									%(rung, len(survivors), epochs, len(survivors)-len(pending))
+
+		runTrials(pending, num_workers, trialsDir, results)
+
+		# trials failing to train drop out along with the worst ones
+		finished = [trial for trial in survivors if (trial['name'], epochs) in results]
+		for trial in finished:
+			accuracies[trial['name']] = results[(trial['name'], epochs)]['accuracy']
+		finished.sort(key=lambda trial: accuracies[trial['name']], reverse=True)
+		survivors = finished[:int(math.ceil(len(finished)/float(eta)))]
+
+	resultName = writeGridSearchResult(trials, accuracies)
+	print '[INFO] Results written to %s' % resultName
 
 
 def setHyperparam(config, hyperparam_path):
@@ -149,7 +343,9 @@ def setHyperparam(config, hyperparam_path):
 	for key,val in paramDict.iteritems():
 		setattr(config, key, val)
 
-	setattr(config, 'dev_filename', OUTPUT_FILE)
+	# trials of runHyperparam write to their own file
+	if 'dev_filename' not in paramDict:
+		setattr(config, 'dev_filename', OUTPUT_FILE)
 
 
 def resultParser(resultFname, top_N=3):
@@ -231,11 +427,27 @@ if __name__ == "__main__":
 						dest = 'top_N', help = 'Top N accuracies')
 	parser.add_argument('-ckpt', type = str, default='', dest = 'ckpt_dir', 
 						help = 'Checkpoint to run the train/test set accuracy test')
+	parser.add_argument('-hp', type = str, default='hparams_seq2seq.txt',
+						dest = 'param_file', help = 'Hyperparameter grid to tune')
+	parser.add_argument('-workers', type = int, default=1,
+						dest = 'num_workers', help = 'Number of trials run side by side')
+	parser.add_argument('-threads', type = int, default=0,
+						dest = 'threads', help = 'Number of threads of every trial (0 for no limit)')
+	parser.add_argument('-trials', type = str, default=TRIALS_DIR,
+						dest = 'trials_dir', help = 'Directory of the trials, a search in the same directory resumes')
+	parser.add_argument('-sched', choices = ['grid','halving'], type = str, default='grid',
+						dest = 'scheduler', help = 'Train every combination for all the epochs, or stop the worst ones early')
+	parser.add_argument('-eta', type = int, default=3,
+						dest = 'eta', help = 'Successive halving keeps the best 1/eta of the trials at every cut')
+	parser.add_argument('-min_e', type = int, default=1,
+						dest = 'min_epochs', help = 'Epochs trained by every trial before the first cut')
 
 	args = parser.parse_args()
 
-	if args.mode == 'tune':
-		hyperparamTxt = 'hparams_seq2seq.txt'
-		runHyperparam(hyperparamTxt, args.dataset)
+	if args.mode == 'tune' and args.scheduler == 'halving':
+		runSuccessiveHalving(args.param_file, args.dataset, args.num_workers, args.threads, args.trials_dir,
+							 args.eta, args.min_epochs)
+	elif args.mode == 'tune':
+		runHyperparam(args.param_file, args.dataset, args.num_workers, args.threads, args.trials_dir)
 	elif args.mode == 'results':
 		resultParser(args.filename, args.top_N)
\ No newline at end of file
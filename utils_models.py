@@ -1,3 +1,4 @@
+from tensorflow.contrib import layers
 from tensorflow.contrib.rnn.python.ops import core_rnn_cell_impl
 from tensorflow.python.framework import dtypes
 from tensorflow.python.framework import ops
@@ -5,6 +6,8 @@ from tensorflow.python.ops import array_ops
 from tensorflow.python.ops import control_flow_ops
 from tensorflow.python.ops import math_ops
 from tensorflow.python.ops import random_ops
+from tensorflow.python.ops import tensor_array_ops
+from tensorflow.python.ops import variable_scope
 from tensorflow.python.util import nest
 from tensorflow.python.ops import nn_ops
 
@@ -61,6 +64,8 @@ def attention_decoder_fn_sampled_inference(output_fn,
 
                 # init attention
                 attention = _init_attention(encoder_state)
+                # the context state records the sampled ids, the outputs are the logits
+                context_state = tensor_array_ops.TensorArray(dtype, size=0, dynamic_size=True)
             else:
                 # construct attention
                 attention = attention_construct_fn(cell_output, attention_keys,
@@ -69,15 +74,20 @@ def attention_decoder_fn_sampled_inference(output_fn,
 
                 # sampled decoder
                 cell_output = output_fn(cell_output)  # logits
-                if temperature:
-                    temperature_cell_output = math_ops.divide(cell_output, temperature)
-                    temperature_cell_output = nn_ops.softmax(temperature_cell_output)
-                    sampled_cell_output = random_ops.multinomial(cell_output, 1)
-                    sampled_cell_output = array_ops.reshape(sampled_cell_output, [-1])
+                if temperature is not None:
+                    # One temperature per row, rows at temperature <= 0 take the arg max
+                    row_temperature = array_ops.ones([batch_size,], dtype=dtypes.float32) * temperature
+                    greedy = math_ops.less_equal(row_temperature, 0)
+                    row_temperature = array_ops.where(greedy, array_ops.ones_like(row_temperature), row_temperature)
+                    sampled_cell_output = random_ops.multinomial(
+                        math_ops.divide(cell_output, array_ops.expand_dims(row_temperature, 1)), 1)
+                    sampled_cell_output = array_ops.where(greedy, math_ops.argmax(cell_output, 1),
+                                                          array_ops.reshape(sampled_cell_output, [-1]))
                 else:
                     sampled_cell_output = math_ops.argmax(cell_output, 1)
                 next_input_id = math_ops.cast(sampled_cell_output, dtype=dtype)
                 done = math_ops.equal(next_input_id, end_of_sequence_id)
+                context_state = context_state.write(time - 1, next_input_id)
                 cell_input = array_ops.gather(embeddings, next_input_id)
 
             # combine cell_input and attention
@@ -95,6 +105,71 @@ def attention_decoder_fn_sampled_inference(output_fn,
 
 
 
+def prepare_masked_attention(attention_states,
+                             attention_option,
+                             num_units,
+                             attention_length,
+                             reuse=False):
+    """
+    Same as seq2seq.prepare_attention, with the same variables, but the steps past the
+    @attention_length of every row (the padding of its encoder inputs) get no attention
+    """
+    with variable_scope.variable_scope("attention_keys", reuse=reuse) as scope:
+        attention_keys = layers.linear(
+            attention_states, num_units, biases_initializer=None, scope=scope)
+    attention_values = attention_states
+
+    attention_score_fn = _create_masked_attention_score_fn("attention_score", num_units,
+                                                           attention_option, attention_length, reuse)
+
+    with variable_scope.variable_scope("attention_construct", reuse=reuse) as scope:
+
+        def attention_construct_fn(attention_query, attention_keys, attention_values):
+            context = attention_score_fn(attention_query, attention_keys, attention_values)
+            concat_input = array_ops.concat([attention_query, context], 1)
+            attention = layers.linear(
+                concat_input, num_units, biases_initializer=None, scope=scope)
+            return attention
+
+    return (attention_keys, attention_values, attention_score_fn,
+            attention_construct_fn)
+
+
+def _create_masked_attention_score_fn(name,
+                                      num_units,
+                                      attention_option,
+                                      attention_length,
+                                      reuse,
+                                      dtype=dtypes.float32):
+    with variable_scope.variable_scope(name, reuse=reuse):
+        if attention_option == "bahdanau":
+            query_w = variable_scope.get_variable(
+                "attnW", [num_units, num_units], dtype=dtype)
+            score_v = variable_scope.get_variable("attnV", [num_units], dtype=dtype)
+
+        def attention_score_fn(query, keys, values):
+            # scores: [batch_size, length]
+            if attention_option == "bahdanau":
+                query = array_ops.reshape(math_ops.matmul(query, query_w), [-1, 1, num_units])
+                scores = math_ops.reduce_sum(score_v * math_ops.tanh(keys + query), [2])
+            elif attention_option == "luong":
+                query = array_ops.reshape(query, [-1, 1, num_units])
+                scores = math_ops.reduce_sum(keys * query, [2])
+            else:
+                raise ValueError("Unknown attention option %s!" % attention_option)
+
+            # the padding gets the lowest score, so no weight once normalized
+            mask = array_ops.sequence_mask(attention_length, array_ops.shape(scores)[1])
+            scores = array_ops.where(mask, scores, array_ops.ones_like(scores) * dtype.min)
+            alignments = array_ops.expand_dims(nn_ops.softmax(scores), 2)
+
+            context_vector = math_ops.reduce_sum(alignments * values, [1])
+            context_vector.set_shape([None, num_units])
+            return context_vector
+
+        return attention_score_fn
+
+
 def _init_attention(encoder_state):
     # Multi- vs single-layer
     if isinstance(encoder_state, tuple):
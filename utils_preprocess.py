@@ -1,7 +1,10 @@
 import matplotlib.pyplot as plt
 import os
 import re
+import json
 import pickle
+import random
+import hashlib
 import shutil
 
 import numpy as np
@@ -10,6 +13,7 @@ from collections import Counter
 from multiprocessing import Pool
 
 from utils import *
+import reader
 
 FORMAT_DIR = 'formatted'
 CHECK_DIR = 'checked'
@@ -19,6 +23,9 @@ ENCODE_DEV_DIR = 'dev_encoded'
 NN_INPUT_TEST_DIR = 'nn_input_test'
 NN_INPUT_TRAIN_DIR = 'nn_input_train'
 NN_INPUT_DEV_DIR = 'nn_input_dev'
+SONG_TEST_DIR = 'songs_test'
+SONG_TRAIN_DIR = 'songs_train'
+SONG_DEV_DIR = 'songs_dev'
 
 def eraseUnreadable(folderN):
 	iterf = 0
@@ -111,8 +118,16 @@ def formatABCtxt(folderName, outputFolder, isDuet):
 
 MIN_MEASURES = 10
 NUM_TRANSPOSITIONS = 4
+# files handed to a checking worker at a time
+CHECK_CHUNKSIZE = 64
+def reseedWorker():
+	"""
+	Pool initializer, so that the forked workers do not all draw the same random numbers
+	"""
+	np.random.seed()
+
 def checkABCtxtWorker(dataPack):
-	filename,outputname,isDuet = dataPack
+	filename,outputname,isDuet,useABC2ABC = dataPack
 
 	print filename
 	header = True
@@ -148,66 +163,85 @@ def checkABCtxtWorker(dataPack):
 		#-----------------------------
 		fileStr = 'X:1\n' + fileStr
 
+		# check in process that the song is a correctly formed .abc file
+		if (not isDuet) and (not useABC2ABC) and (not passesBarCheck(fileStr)):
+			print "Doesn't pass the bar check: " + filename
+			return
+
+		shift_cands = np.linspace(-5, 6, 12)
+		shift_cands = np.delete(shift_cands, 5)
+		shifts = np.random.choice(shift_cands, NUM_TRANSPOSITIONS, replace=False)
+
+		# all the transpositions in process, in one pass over the song,
+		# before anything is written so that a song that cannot be transposed leaves no file
+		transposed = transposeABCStr(fileStr, shifts)
+		if transposed is None:
+			print filename+': Could not transpose the key'
+			return
+
 		# save the non-augmented song
 		with open(outputname,'w') as outfile:
 			outfile.write(fileStr)
 
 		# check if the file just saved was correctly formed .abc file
-		if (not isDuet) and (not passesABC2ABC(outputname)):
+		if (not isDuet) and useABC2ABC and (not passesABC2ABC(outputname)):
 			print "Doesn't pass abc2abc: " + outputname
 			os.remove(outputname)
 			return
 
-		shift_cands = np.linspace(-5, 6, 12)
-		shift_cands = np.delete(shift_cands, 5)
-		for shift in np.random.choice(shift_cands, NUM_TRANSPOSITIONS, replace=False):
-			transposeABC(outputname, outputname.replace('.abc','_%d.abc'%shift), shift)
+		outputnames = [outputname]
+		for shift,transposedStr in zip(shifts, transposed):
+			outputnames.append(outputname.replace('.abc','_%d.abc'%shift))
+			with open(outputnames[-1],'w') as outfile:
+				outfile.write(transposedStr)
+
+		return outputnames
 
-def checkABCtxt(outputFolder, isDuet):
+def checkABCtxt(outputFolder, isDuet, numWorkers=8, useABC2ABC=False):
 	"""
 	Checks if the file under @outputFolder meets requirements
 	Also augments the file by transposing to 4 random keys
+
+	@numWorkers	- number of processes checking the files
+	@useABC2ABC	- check the files with abc2abc instead of passesBarCheck
 	"""
 	folderName = os.path.join(outputFolder, FORMAT_DIR)
 	outputFolder = os.path.join(outputFolder, CHECK_DIR)
 	makedir(outputFolder)
 
-	# p = Pool(8)
-	mapList = [(os.path.join(folderName,fname), os.path.join(outputFolder,fname), isDuet)
+	p = Pool(numWorkers, initializer=reseedWorker)
+	mapList = [(os.path.join(folderName,fname), os.path.join(outputFolder,fname), isDuet, useABC2ABC)
 										for fname in os.listdir(folderName)]
 
-	map(checkABCtxtWorker, mapList)
+	for _ in p.imap_unordered(checkABCtxtWorker, mapList, chunksize=CHECK_CHUNKSIZE):
+		pass
+	p.close()
+	p.join()
+
+def convertNewLines2PercentFile(pathname):
+	with open(pathname, 'r+') as f:
+		fileArr = f.read().split('\n')
+		fileStr = '\n'.join(fileArr[0:7])+ '\n' + '%'.join(fileArr[7:])
+		f.seek(0)
+		f.truncate()
+		f.write(fileStr + '\n')
 
 def convertNewLines2Percent(folderName):
 	folderName = os.path.join(folderName, CHECK_DIR)
 	for fname in os.listdir(folderName):
-		pathname = os.path.join(folderName, fname)
+		convertNewLines2PercentFile(os.path.join(folderName, fname))
 
-		with open(pathname, 'r+') as f:
-			fileArr = f.read().split('\n')
-			fileStr = '\n'.join(fileArr[0:7])+ '\n' + '%'.join(fileArr[7:])
-			f.seek(0)
-			f.truncate()
-			f.write(fileStr + '\n')
+# metadata stored in the vocabulary, and files counted by a worker at a time
+VOCAB_META_HEADERS = ('R', 'M', 'L', 'K_key', 'K_mode')
+VOCAB_CHUNKSIZE = 256
 
-def generateVocab(foldername):
+def countVocabWorker(filenames):
 	"""
-	Creates the vocabulary under the @foldername
+	Returns the (metadata Counters, music Counter) of the songs in @filenames, counting every song once
 	"""
-	# tally up the metadata
-	metaCount = {}
-	headerTup = ('T', 'R', 'M', 'L', 'K_key', 'K_mode', 'Q', 'len', 'complexity')
-	for header in headerTup:
-		metaCount[header] = {}
-
-	musicDict = {}
-
-	inputFolderName = os.path.join(foldername, CHECK_DIR)
-	filenames = [os.path.join(inputFolderName,filename) for filename in os.listdir(inputFolderName)]
-	for i,filename in enumerate(filenames):
-		if i%1000==0:
-			print i
-
+	metaCount = dict((header, Counter()) for header in VOCAB_META_HEADERS)
+	musicCount = Counter()
+	for filename in filenames:
 		try:
 			meta,music = loadCleanABC(filename)
 			if len(music.replace('%','').strip()) == 0:
@@ -216,114 +250,290 @@ def generateVocab(foldername):
 			print filename
 			continue
 
-		if '\xc5' in music:
-			print filename
-			exit(0)
+		for header in VOCAB_META_HEADERS:
+			if header in meta:
+				metaCount[header][str(meta[header])] += 1
+		musicCount.update(Counter(music))
+
+	return metaCount,musicCount
 
-		for header in headerTup:
-			try:
-				newMeta = str(meta[header])
-			except:
-				break
-			if newMeta not in metaCount[header]:
-				metaCount[header][newMeta] = 0
-
-			musicChars = Counter(music)
-			for c in musicChars:
-				if c not in musicDict:
-					musicDict[c] = 0
-				musicDict[c] += musicChars[c]
-
-			metaCount[header][newMeta] += 1
-
-	meta2Store = {'R':{}, 'M':{}, 'L':{}, 'K_key':{}, 'K_mode':{}}
-	for header in meta2Store:
-		for i,key in enumerate(metaCount[header]):
-			meta2Store[header][key] = i
-
-		# uncomment to print out the result
-		# print header
-		# print len(meta2Store[header])
-		# print meta2Store[header]
-		# print metaCount[header]
-		# print '-'*40
-
-	music2Store = {}
-	for i,letter in enumerate(musicDict):
-		music2Store[letter] = i
+def countVocab(filenames, numWorkers=8):
+	"""
+	Counts the metadata values and music characters of the songs in @filenames across a pool of
+	@numWorkers processes, and returns the summed (metadata Counters, music Counter)
+	"""
+	metaCount = dict((header, Counter()) for header in VOCAB_META_HEADERS)
+	musicCount = Counter()
+
+	p = Pool(numWorkers)
+	chunks = [filenames[i:i+VOCAB_CHUNKSIZE] for i in xrange(0, len(filenames), VOCAB_CHUNKSIZE)]
+	for chunkMeta,chunkMusic in p.imap_unordered(countVocabWorker, chunks):
+		for header in VOCAB_META_HEADERS:
+			metaCount[header].update(chunkMeta[header])
+		musicCount.update(chunkMusic)
+	p.close()
+	p.join()
+
+	return metaCount,musicCount
+
+def vocabIds(counter, vocab=None):
+	"""
+	Returns @vocab extended with the keys of @counter it does not have. The new keys get the ids
+	after the existing ones, most frequent first and ties by key, so the ids are stable.
+	"""
+	vocab = dict(vocab or {})
+	nextId = max(vocab.values())+1 if len(vocab)>0 else 0
+	for key in sorted((key for key in counter if key not in vocab), key=lambda key: (-counter[key], key)):
+		vocab[key] = nextId
+		nextId += 1
+	return vocab
+
+def generateVocab(foldername, numWorkers=8):
+	"""
+	Creates the vocabulary under the @foldername
+	"""
+	inputFolderName = os.path.join(foldername, CHECK_DIR)
+	filenames = [os.path.join(inputFolderName,filename) for filename in os.listdir(inputFolderName)]
+	metaCount,musicCount = countVocab(filenames, numWorkers)
+
+	meta2Store = dict((header, vocabIds(metaCount[header])) for header in VOCAB_META_HEADERS)
+	music2Store = vocabIds(musicCount)
 
 	# write out to a file
 	pickle.dump(meta2Store, open(os.path.join(foldername, 'vocab_map_meta.p'),'wb'))
 	pickle.dump(music2Store, open(os.path.join(foldername, 'vocab_map_music.p'),'wb'))
 
-def encodeABCWorker(dataPack):
+def updateGlobalVocab(foldername, metaMapFile='/data/global_map_meta.p', musicMapFile='/data/global_map_music.p',
+					  numWorkers=8):
+	"""
+	Adds the metadata values and music characters of the songs under @foldername that are missing
+	from the global maps, keeping the ids already given. The BEGIN/END ids follow the size of the
+	music map, so the songs encoded with the previous maps have to be encoded again.
+	"""
+	inputFolderName = os.path.join(foldername, CHECK_DIR)
+	filenames = [os.path.join(inputFolderName,filename) for filename in os.listdir(inputFolderName)]
+	metaCount,musicCount = countVocab(filenames, numWorkers)
+
+	meta_map = pickle.load(open(metaMapFile,'rb')) if os.path.isfile(metaMapFile) else {}
+	music_map = pickle.load(open(musicMapFile,'rb')) if os.path.isfile(musicMapFile) else {}
+
+	newMeta = dict((header, vocabIds(metaCount[header], meta_map.get(header))) for header in VOCAB_META_HEADERS)
+	newMusic = vocabIds(musicCount, music_map)
+	for header in VOCAB_META_HEADERS:
+		print '%s: %d new values' % (header, len(newMeta[header])-len(meta_map.get(header, {})))
+	print 'music: %d new characters' % (len(newMusic)-len(music_map))
+
+	pickle.dump(newMeta, open(metaMapFile,'wb'))
+	pickle.dump(newMusic, open(musicMapFile,'wb'))
+
+# vocabulary of an encoding worker, set once per worker by initEncodeWorker
+encodeMetaMap = None
+encodeLUT = None
+encodeMusicSize = 0
+# songs handed to an encoding worker at a time
+ENCODE_CHUNKSIZE = 64
+
+def initEncodeWorker(meta_map, music_map):
+	"""
+	Pool initializer of the encoding workers. Keeps @meta_map, and turns @music_map into a
+	lookup table from character code to music id, -1 for the characters not in the vocabulary.
+	"""
+	global encodeMetaMap, encodeLUT, encodeMusicSize
+	encodeMetaMap = meta_map
+	encodeLUT = np.full(256, -1, dtype=np.int16)
+	for c,idx in music_map.iteritems():
+		encodeLUT[ord(c)] = idx
+	encodeMusicSize = len(music_map)
+
+def encodeSong(meta, music):
+	"""
+	Returns the encoded song: the 7 metadata integers, BEGIN, the music ids and END.
+	Raises a KeyError for a metadata value or a character that is not in the vocabulary.
+	"""
 	oneHotHeaders = ('R', 'M', 'L', 'K_key', 'K_mode')
 	otherHeaders = ('len', 'complexity')
 
-	filename,outputname,meta_map,music_map = dataPack
+	metaList = [encodeMetaMap[header][meta[header]] for header in oneHotHeaders]
+	metaList += [meta[header] for header in otherHeaders]
+
+	musicIds = encodeLUT[np.frombuffer(music, dtype=np.uint8)] if len(music)>0 else np.zeros(0, dtype=np.int16)
+	if (musicIds<0).any():
+		raise KeyError(music[np.argmax(musicIds<0)])
+
+	# BEGIN and END tokens around the music
+	return np.concatenate([np.asarray(metaList + [encodeMusicSize], dtype=np.int64), musicIds,
+						   np.asarray([encodeMusicSize+1], dtype=np.int64)])
+
+def encodeABCWorker(dataPack):
+	filename,outputname = dataPack
 	print filename
 	try:
 		meta,music = loadCleanABC(filename)
 	except:
 		return
 
-	encodeList = []
-	# encode the metadata info
-	for header in oneHotHeaders:
-		encodeList.append(meta_map[header][meta[header]])
-	for header in otherHeaders:
-		encodeList.append(meta[header])
+	try:
+		encoded = encodeSong(meta, music)
+	except KeyError as e:
+		print filename+': %r is not in the vocabulary' % e.args[0]
+		return
 
-	# add the BEGIN token
-	encodeList.append(len(music_map))
+	np.save(outputname,encoded)
+	return outputname
 
-	# encode music data
-	for c in music:
-		encodeList.append(music_map[c])
+def encodeABCSongWorker(filename):
+	"""
+	Returns the encoded song in @filename, None if it cannot be read or encoded
+	"""
+	try:
+		meta,music = loadCleanABC(filename)
+		return encodeSong(meta, music)
+	except KeyError as e:
+		print filename+': %r is not in the vocabulary' % e.args[0]
+	except:
+		print filename
+	return None
 
-	# add the END token
-	encodeList.append(len(music_map)+1)
+def splitSongFiles(outputFolder):
+	"""
+	Returns the checked songs under @outputFolder by split, {'test':[...], 'train':[...], 'dev':[...]}
+	"""
+	folderName = os.path.join(outputFolder, CHECK_DIR)
+	songSplit = {}
+	for splitName in ('dev', 'train', 'test'):
+		for basename in pickle.load(open(os.path.join(outputFolder, '%s_songs.p' % splitName),'rb')):
+			songSplit[basename] = splitName
 
-	np.save(outputname,np.asarray(encodeList))
+	splitFiles = {'test':[], 'train':[], 'dev':[]}
+	for filename in sorted(os.listdir(folderName)):
+		song_basename = find_basename(filename)
+		if song_basename in songSplit:
+			splitFiles[songSplit[song_basename]].append(filename)
+		else:
+			print filename+': not in any split'
 
+	return splitFiles
 
-def encodeABC(outputFolder):
+def encodeABC(outputFolder, metaMapFile='/data/global_map_meta.p', musicMapFile='/data/global_map_music.p',
+			  numWorkers=8):
 	folderName = os.path.join(outputFolder, CHECK_DIR)
 
-	meta_map = pickle.load(open('/data/global_map_meta.p','rb'))
-	music_map = pickle.load(open('/data/global_map_music.p','rb'))
+	meta_map = pickle.load(open(metaMapFile,'rb'))
+	music_map = pickle.load(open(musicMapFile,'rb'))
 
 	# meta_map = pickle.load(open(os.path.join(outputFolder, 'vocab_map_meta.p'),'rb'))
 	# music_map = pickle.load(open(os.path.join(outputFolder, 'vocab_map_music.p'),'rb'))
 
-	outputFolder_test = os.path.join(outputFolder, ENCODE_TEST_DIR)
-	makedir(outputFolder_test)
-	outputFolder_train = os.path.join(outputFolder, ENCODE_TRAIN_DIR)
-	makedir(outputFolder_train)
-	outputFolder_dev = os.path.join(outputFolder, ENCODE_DEV_DIR)
-	makedir(outputFolder_dev)
-
-	p = Pool(8)
-	testSongs = pickle.load(open(os.path.join(outputFolder, 'test_songs.p'),'rb'))
-	trainSongs = pickle.load(open(os.path.join(outputFolder, 'train_songs.p'),'rb'))
-	devSongs = pickle.load(open(os.path.join(outputFolder, 'dev_songs.p'),'rb'))
+	outFolders = {'test':os.path.join(outputFolder, ENCODE_TEST_DIR),
+				  'train':os.path.join(outputFolder, ENCODE_TRAIN_DIR),
+				  'dev':os.path.join(outputFolder, ENCODE_DEV_DIR)}
 	mapList = []
+	for splitName,filenames in splitSongFiles(outputFolder).iteritems():
+		makedir(outFolders[splitName])
+		for filename in filenames:
+			mapList.append((os.path.join(folderName,filename),
+							os.path.join(outFolders[splitName],filename.replace('.abc','.npy'))))
+
+	p = Pool(numWorkers, initializer=initEncodeWorker, initargs=(meta_map, music_map))
+	p.map(encodeABCWorker, mapList, chunksize=ENCODE_CHUNKSIZE)
+	p.close()
+	p.join()
+
+def encodeABC2SongStore(outputFolder, metaMapFile='/data/global_map_meta.p', musicMapFile='/data/global_map_music.p',
+						numWorkers=8):
+	"""
+	Encodes the checked songs of every split straight into its song store (songs_train, ...),
+	without writing a .npy file per song like encodeABC followed by npy2SongStore
+	"""
+	folderName = os.path.join(outputFolder, CHECK_DIR)
 
-	for filename in os.listdir(folderName):
-		fromName = os.path.join(folderName,filename)
-		song_basename = find_basename(filename)
+	meta_map = pickle.load(open(metaMapFile,'rb'))
+	music_map = pickle.load(open(musicMapFile,'rb'))
+
+	storeDirs = {'test':SONG_TEST_DIR, 'train':SONG_TRAIN_DIR, 'dev':SONG_DEV_DIR}
+	p = Pool(numWorkers, initializer=initEncodeWorker, initargs=(meta_map, music_map))
+	for splitName,filenames in sorted(splitSongFiles(outputFolder).iteritems()):
+		songs = p.imap(encodeABCSongWorker, [os.path.join(folderName,filename) for filename in filenames],
+					   chunksize=ENCODE_CHUNKSIZE)
+		writeSongStore(os.path.join(outputFolder, storeDirs[splitName]),
+					   (encoded for encoded in songs if encoded is not None))
+	p.close()
+	p.join()
 
-		if song_basename in testSongs:
-			outFolder = outputFolder_test
-		elif song_basename in trainSongs:
-			outFolder = outputFolder_train
-		elif song_basename in devSongs:
-			outFolder = outputFolder_dev
-		toName = os.path.join(outFolder,filename.replace('.abc','.npy'))
+def writeSongStore(folderName, songIter):
+	"""
+	Writes a song store under @folderName: the music of every song concatenated
+	into one token array, the per-song offsets into it, and the per-song metadata
 
-		mapList.append((fromName,toName,meta_map,music_map))
+	@songIter	- iterable of encoded songs (7 metadata integers followed by the music)
+	"""
+	makedir(folderName)
 
-	p.map(encodeABCWorker, mapList)
+	dtype = reader.WINDOW_STORE_DTYPE
+	offsets = [0]
+	with open(os.path.join(folderName, reader.SONG_STORE_TOKENS),'wb') as tokenF, \
+		 open(os.path.join(folderName, reader.SONG_STORE_META),'wb') as metaF:
+		for data in songIter:
+			np.ascontiguousarray(data[:reader.NUM_META], dtype=dtype).tofile(metaF)
+			np.ascontiguousarray(data[reader.NUM_META:], dtype=dtype).tofile(tokenF)
+			offsets.append(offsets[-1] + len(data) - reader.NUM_META)
+
+	np.asarray(offsets, dtype=np.int64).tofile(os.path.join(folderName, reader.SONG_STORE_OFFSETS))
+
+	header = {'num_songs':len(offsets)-1, 'num_tokens':offsets[-1],
+			  'num_meta':reader.NUM_META, 'dtype':np.dtype(dtype).name}
+	with open(os.path.join(folderName, reader.SONG_STORE_HEADER),'w') as f:
+		json.dump(header, f)
+
+	print 'Wrote %d songs to %s' % (header['num_songs'], folderName)
+
+def appendSongStore(folderName, songIter):
+	"""
+	Appends the encoded songs in @songIter to the song store under @folderName,
+	writing a new store if there is none yet
+	"""
+	if not reader.is_song_store(folderName):
+		writeSongStore(folderName, songIter)
+		return
+
+	with open(os.path.join(folderName, reader.SONG_STORE_HEADER),'r') as f:
+		header = json.load(f)
+	dtype = np.dtype(header['dtype'])
+
+	offsets = [header['num_tokens']]
+	with open(os.path.join(folderName, reader.SONG_STORE_TOKENS),'ab') as tokenF, \
+		 open(os.path.join(folderName, reader.SONG_STORE_META),'ab') as metaF:
+		for data in songIter:
+			np.ascontiguousarray(data[:reader.NUM_META], dtype=dtype).tofile(metaF)
+			np.ascontiguousarray(data[reader.NUM_META:], dtype=dtype).tofile(tokenF)
+			offsets.append(offsets[-1] + len(data) - reader.NUM_META)
+
+	with open(os.path.join(folderName, reader.SONG_STORE_OFFSETS),'ab') as f:
+		np.asarray(offsets[1:], dtype=np.int64).tofile(f)
+
+	# the header goes last, a store interrupted before it is rebuilt by updateDataset
+	header['num_songs'] += len(offsets)-1
+	header['num_tokens'] = offsets[-1]
+	with open(os.path.join(folderName, reader.SONG_STORE_HEADER),'w') as f:
+		json.dump(header, f)
+
+	print 'Appended %d songs to %s' % (len(offsets)-1, folderName)
+
+def npy2SongStore(outputFolder):
+	"""
+	Consolidates the encoded .npy songs of every split into a song store.
+	Any stride/window/nnType can then be read from it with reader.song_window_index,
+	instead of materializing every window with npy2nnInput.
+	"""
+	dir_list = [(SONG_TEST_DIR, ENCODE_TEST_DIR), 
+				(SONG_TRAIN_DIR, ENCODE_TRAIN_DIR), 
+				(SONG_DEV_DIR, ENCODE_DEV_DIR)]
+
+	for outDir,inDir in dir_list:
+		encodedDir = os.path.join(outputFolder, inDir)
+		filenames = sorted(os.listdir(encodedDir))
+		writeSongStore(os.path.join(outputFolder, outDir),
+					   (np.load(os.path.join(encodedDir, fname)) for fname in filenames))
 
 def npy2nnInputWorkerWorker(dataPack):
 	stride_sz, window_sz, nnType, output_sz, fname = dataPack
@@ -375,17 +585,80 @@ def npy2nnInputWorkerWorker(dataPack):
 
 	return tupList
 
+def windows2Arrays(windowList, window_sz, output_sz):
+	"""
+	Packs a list of (meta, input_window, output_window) tuples into the three
+	arrays of a window store. Windows with the wrong dimensions are dropped.
+	"""
+	windowList = [tup for tup in windowList
+					if len(tup[1])==window_sz and len(tup[2])==output_sz]
+
+	dtype = reader.WINDOW_STORE_DTYPE
+	if len(windowList)==0:
+		return (np.zeros((0,reader.NUM_META), dtype=dtype), np.zeros((0,window_sz), dtype=dtype),
+				np.zeros((0,output_sz), dtype=dtype))
+
+	metaList,inputList,outputList = zip(*windowList)
+	return (np.asarray(metaList, dtype=dtype), np.asarray(inputList, dtype=dtype),
+			np.asarray(outputList, dtype=dtype))
+
+def writeWindowStore(folderName, arrayIter, window_sz, output_sz):
+	"""
+	Writes a columnar window store under @folderName
+
+	@arrayIter	- iterable of (meta, inputs, labels) array chunks, appended in order
+	@window_sz	- int / width of the input windows
+	@output_sz	- int / width of the label windows
+	"""
+	makedir(folderName)
+
+	num_windows = 0
+	with open(os.path.join(folderName, reader.WINDOW_STORE_META),'wb') as metaF, \
+		 open(os.path.join(folderName, reader.WINDOW_STORE_INPUTS),'wb') as inputF, \
+		 open(os.path.join(folderName, reader.WINDOW_STORE_LABELS),'wb') as labelF:
+		for meta,inputs,labels in arrayIter:
+			np.ascontiguousarray(meta, dtype=reader.WINDOW_STORE_DTYPE).tofile(metaF)
+			np.ascontiguousarray(inputs, dtype=reader.WINDOW_STORE_DTYPE).tofile(inputF)
+			np.ascontiguousarray(labels, dtype=reader.WINDOW_STORE_DTYPE).tofile(labelF)
+			num_windows += len(meta)
+
+	header = {'num_windows':num_windows, 'window_sz':window_sz, 'output_sz':output_sz,
+			  'num_meta':reader.NUM_META, 'dtype':np.dtype(reader.WINDOW_STORE_DTYPE).name}
+	with open(os.path.join(folderName, reader.WINDOW_STORE_HEADER),'w') as f:
+		json.dump(header, f)
+
+	print 'Wrote %d windows to %s' % (num_windows, folderName)
+
+def appendWindowStore(folderName, meta, inputs, labels):
+	"""
+	Appends the (@meta, @inputs, @labels) window arrays to the window store under @folderName
+	"""
+	with open(os.path.join(folderName, reader.WINDOW_STORE_HEADER),'r') as f:
+		header = json.load(f)
+	dtype = np.dtype(header['dtype'])
+
+	for arr,filename in [(meta, reader.WINDOW_STORE_META), (inputs, reader.WINDOW_STORE_INPUTS),
+						 (labels, reader.WINDOW_STORE_LABELS)]:
+		with open(os.path.join(folderName, filename),'ab') as f:
+			np.ascontiguousarray(arr, dtype=dtype).tofile(f)
+
+	header['num_windows'] += len(meta)
+	with open(os.path.join(folderName, reader.WINDOW_STORE_HEADER),'w') as f:
+		json.dump(header, f)
+
+	print 'Appended %d windows to %s' % (len(meta), folderName)
+
 def npy2nnInputWorker(dataPack):
-	outfname,tupList = dataPack
+	window_sz,output_sz,tupList = dataPack
 	windowList = []
 	for tup in tupList:
 		windowList += npy2nnInputWorkerWorker(tup)
 
-	pickle.dump(windowList, open(outfname,'wb'))
+	return windows2Arrays(windowList, window_sz, output_sz)
 
 def npy2nnInput(outputFolder, stride_sz, window_sz, nnType, output_sz=0, num_buckets=8):
 	"""
-	Converts encoded npy to an array of tuples for NN input
+	Converts encoded npy to a window store for NN input
 
 	@outputFolder 	- string / filename of h5 file to read from
 	@stride_sz 		- int / stride size
@@ -393,7 +666,7 @@ def npy2nnInput(outputFolder, stride_sz, window_sz, nnType, output_sz=0, num_buc
 	@output_sz 		- int / window size of the output (only used for nnType='seq2seq')
 	@nnType 		- string / nn to feed the generated data to.
 			 		  'BOW' 'seq2seq' 'char_rnn'
-	@num_buckets	- int / number of files to generate
+	@num_buckets	- int / number of chunks to split the work into
 	"""
 
 	if output_sz==0 and nnType=='seq2seq':
@@ -405,60 +678,120 @@ def npy2nnInput(outputFolder, stride_sz, window_sz, nnType, output_sz=0, num_buc
 				(NN_INPUT_DEV_DIR, ENCODE_DEV_DIR)]
 
 	for outDir,inDir in dir_list:
-		inputList = []
 		outfName = outDir+'_stride_%d_window_%d_nnType_%s'%(stride_sz,window_sz,nnType)
 		if nnType=='seq2seq':
 			outfName += '_output_sz_%d' % output_sz
 
-		nnFolder = os.path.join(outputFolder, outfName)
-		makedir(nnFolder)
-
 		encodedDir = os.path.join(outputFolder, inDir)
-		for fname in os.listdir(encodedDir):
-			inputList.append((stride_sz, window_sz, nnType, output_sz, os.path.join(encodedDir, fname)))
+		buildWindowStore(os.path.join(outputFolder, outfName),
+						 [os.path.join(encodedDir, fname) for fname in os.listdir(encodedDir)],
+						 stride_sz, window_sz, nnType, output_sz, num_buckets)
 
-		mapList = []
-		for i in range(num_buckets):
-			mapList.append((os.path.join(nnFolder,'%d.p'%i), 
-							inputList[int(i*len(inputList)/num_buckets)
-										:int((i+1)*len(inputList)/num_buckets)]))
+def labelSize(nnType, window_sz, output_sz):
+	"""
+	Returns the width of the label windows of @nnType
+	"""
+	if nnType=='char_rnn':
+		return window_sz
+	elif nnType=='BOW':
+		return 1
+	return output_sz
 
-		p = Pool(8)
-		p.map(npy2nnInputWorker, mapList)
+def buildWindowStore(nnFolder, filenames, stride_sz, window_sz, nnType, output_sz, num_buckets=8):
+	"""
+	Windows the encoded .npy songs in @filenames into the shuffled window store @nnFolder+'_shuffled'
+	"""
+	label_sz = labelSize(nnType, window_sz, output_sz)
+	inputList = [(stride_sz, window_sz, nnType, output_sz, fname) for fname in filenames]
 
-		shuffleDataset(nnFolder)
-		shutil.rmtree(nnFolder)
+	mapList = []
+	for i in range(num_buckets):
+		mapList.append((window_sz, label_sz,
+						inputList[int(i*len(inputList)/num_buckets)
+									:int((i+1)*len(inputList)/num_buckets)]))
 
-def shuffleDataset(originalDir):
+	p = Pool(8)
+	writeWindowStore(nnFolder, p.imap(npy2nnInputWorker, mapList), window_sz, label_sz)
+	p.close()
+
+	shuffleDataset(nnFolder)
+	shutil.rmtree(nnFolder)
+
+# windows read, or shuffled, in memory at once by shuffleDataset
+SHUFFLE_CHUNK = 1<<18
+SHUFFLE_SEED = 0
+
+def shuffleDataset(originalDir, seed=SHUFFLE_SEED, chunkSize=SHUFFLE_CHUNK):
+	"""
+	Shuffles the window store under @originalDir into @originalDir+'_shuffled', holding about
+	@chunkSize windows in memory: the windows are scattered to temporary shards by a random key,
+	then every shard is shuffled in memory and appended to the output.
+	The order only depends on @seed.
+	"""
 	print 'Shuffling %s' % originalDir
 	outFolder = originalDir+'_shuffled'
-	makedir(outFolder)
-
-	input_list = []
-	filenames = os.listdir(originalDir)
-	num_buckets = len(filenames)
-	print 'Loading data'
-	for filename in filenames:
-		print filename
-		with open(os.path.join(originalDir,filename),'r') as f:
-			input_list += pickle.load(f)
+	shardFolder = outFolder+'_shards'
+	makedir(shardFolder)
+
+	with open(os.path.join(originalDir, reader.WINDOW_STORE_HEADER),'r') as f:
+		header = json.load(f)
+	num_windows = header['num_windows']
+	dtype = np.dtype(header['dtype'])
+	columns = [(reader.WINDOW_STORE_META, header['num_meta']), (reader.WINDOW_STORE_INPUTS, header['window_sz']),
+			   (reader.WINDOW_STORE_LABELS, header['output_sz'])]
+	widths = np.cumsum([width for _,width in columns])
+
+	rng = np.random.RandomState(seed)
+	numShards = max(1, int(np.ceil(num_windows/float(chunkSize))))
+	shardNames = [os.path.join(shardFolder, 'shard_%d.dat' % i) for i in xrange(numShards)]
+
+	# scatter the rows of every chunk, meta, inputs and labels side by side, to random shards
+	columnFiles = [open(os.path.join(originalDir, filename),'rb') for filename,_ in columns]
+	shardFiles = [open(shardName,'wb') for shardName in shardNames]
+	for start in xrange(0, num_windows, chunkSize):
+		count = min(chunkSize, num_windows-start)
+		rows = np.hstack([np.fromfile(f, dtype=dtype, count=count*width).reshape(count, width)
+						  for f,(_,width) in zip(columnFiles, columns)])
+		shardIds = rng.randint(numShards, size=len(rows))
+		order = np.argsort(shardIds, kind='mergesort')
+		bounds = np.searchsorted(shardIds[order], np.arange(numShards+1))
+		for i in xrange(numShards):
+			np.ascontiguousarray(rows[order[bounds[i]:bounds[i+1]]], dtype=dtype).tofile(shardFiles[i])
+	for f in shardFiles + columnFiles:
+		f.close()
+
+	def shuffledShards():
+		for shardName in shardNames:
+			rows = np.fromfile(shardName, dtype=dtype).reshape(-1, widths[-1])
+			rows = rows[rng.permutation(len(rows))]
+			yield rows[:,:widths[0]], rows[:,widths[0]:widths[1]], rows[:,widths[1]:]
+
+	print 'Done scattering, saving the shuffled data...'
+	writeWindowStore(outFolder, shuffledShards(), header['window_sz'], header['output_sz'])
+	shutil.rmtree(shardFolder)
+
+def convertPickleDataset(folderName):
+	"""
+	Converts a folder of pickled (meta, input_window, output_window) buckets, as
+	written by the previous version of npy2nnInput, into a window store under
+	@folderName+'_store'
+	"""
+	window_sz,output_sz = reader.dataset_dims(folderName)
 
-	random.shuffle(input_list)
+	def bucketArrays():
+		for filename in reader.abc_filenames(folderName):
+			print filename
+			yield windows2Arrays(reader.read_abc_pickle(filename), window_sz, output_sz)
 
-	print 'Done shuffling, saving the shuffled data...'
-	for i,filename in enumerate(filenames):
-		print filename
-		with open(os.path.join(outFolder,filename),'w') as f:
-			input_frac = input_list[int(i*len(input_list)/len(filenames))
-									:int((i+1)*len(input_list)/len(filenames))]
-			pickle.dump(input_frac, f)
+	writeWindowStore(folderName+'_store', bucketArrays(), window_sz, output_sz)
 
 def removeWrongDim(folderName):
 	for subfolder in os.listdir(folderName):
 		subfolderPath = os.path.join(folderName, subfolder)
 		print subfolderPath
 
-		if 'nn_input' in subfolderPath:
+		# window stores never contain malformed windows
+		if 'nn_input' in subfolderPath and not reader.is_window_store(subfolderPath):
 			inputSz = int(re.findall('[0-9]+', re.findall('window_[0-9]+', subfolderPath)[0])[0])
 
 			if 'output_sz_' in subfolderPath:
@@ -496,6 +829,249 @@ def removeWrongDim(folderName):
 				os.rename(cleanFilename, filename_abs)
 
 
+# Incremental pipeline
+#------------------------------------
+MANIFEST_FILE = 'manifest.json'
+# bump the version of a stage to redo it, and the stages after it, for every file
+PIPELINE_STAGES = ('format', 'check', 'encode')
+STAGE_VERSIONS = {'format':1, 'check':1, 'encode':1}
+SPLIT_DIRS = [('train', ENCODE_TRAIN_DIR, SONG_TRAIN_DIR, NN_INPUT_TRAIN_DIR),
+			  ('test', ENCODE_TEST_DIR, SONG_TEST_DIR, NN_INPUT_TEST_DIR),
+			  ('dev', ENCODE_DEV_DIR, SONG_DEV_DIR, NN_INPUT_DEV_DIR)]
+WINDOW_STORE_NAME_RE = re.compile(r'^(nn_input_[a-z]+)_stride_([0-9]+)_window_([0-9]+)_nnType_([a-zA-Z_0-9]+?)'
+								  r'(?:_output_sz_([0-9]+))?_shuffled$')
+
+def hashFile(filename):
+	with open(filename,'rb') as f:
+		return hashlib.sha1(f.read()).hexdigest()
+
+def loadManifest(processedDir):
+	"""
+	Returns the manifest of @processedDir: per input file its content hash, the stage
+	versions it went through and its outputs, and the size of every store built from them
+	"""
+	manifestName = os.path.join(processedDir, MANIFEST_FILE)
+	if not os.path.isfile(manifestName):
+		return {'vocab':None, 'stores':{}, 'files':{}}
+	with open(manifestName,'r') as f:
+		return json.load(f)
+
+def saveManifest(processedDir, manifest):
+	manifestName = os.path.join(processedDir, MANIFEST_FILE)
+	with open(manifestName+'.tmp','w') as f:
+		json.dump(manifest, f, indent=1, sort_keys=True)
+		f.flush()
+		os.fsync(f.fileno())
+	os.rename(manifestName+'.tmp', manifestName)
+
+def staleStage(entry, fileHash, vocabHash, manifestVocab):
+	"""
+	Returns the index in PIPELINE_STAGES of the first stage to redo for a file, None if it is up to date
+	"""
+	if entry is None or entry['hash']!=fileHash:
+		return 0
+	for i,stage in enumerate(PIPELINE_STAGES):
+		if entry['versions'].get(stage)!=STAGE_VERSIONS[stage]:
+			return i
+	if vocabHash!=manifestVocab:
+		return PIPELINE_STAGES.index('encode')
+	return None
+
+def storeSize(storeDir):
+	"""
+	Returns the number of songs (or windows) in the store under @storeDir, None if there is no store
+	"""
+	for headerName,key in [(reader.SONG_STORE_HEADER, 'num_songs'), (reader.WINDOW_STORE_HEADER, 'num_windows')]:
+		headerName = os.path.join(storeDir, headerName)
+		if os.path.isfile(headerName):
+			with open(headerName,'r') as f:
+				return json.load(f)[key]
+	return None
+
+def windowStores(processedDir, nnDir):
+	"""
+	Returns the (folder name, stride_sz, window_sz, nnType, output_sz) of the window stores of @nnDir
+	"""
+	stores = []
+	for fname in sorted(os.listdir(processedDir)):
+		match = WINDOW_STORE_NAME_RE.match(fname)
+		if match is None or match.group(1)!=nnDir or not reader.is_window_store(os.path.join(processedDir, fname)):
+			continue
+		stores.append((fname, int(match.group(2)), int(match.group(3)), match.group(4), int(match.group(5) or 0)))
+	return stores
+
+def updateDataset(originalDataDir, processedDir, isDuet, setRatio=(0.8,0.1,0.1), numWorkers=8,
+				  metaMapFile='/data/global_map_meta.p', musicMapFile='/data/global_map_music.p'):
+	"""
+	Brings @processedDir up to date with @originalDataDir. Only the new or changed files are
+	formatted, checked and encoded, and their songs and windows are appended to the song
+	stores and to the window stores already under @processedDir. A split whose songs changed
+	or were removed has its stores rebuilt from its encoded songs.
+
+	@setRatio	- (train, test, dev) ratio new songs are split with, existing songs keep their split
+	@numWorkers	- number of processes formatting, checking and encoding the files
+	"""
+	if abs(sum(setRatio)-1)>1e-6:
+		print '[ERROR] updateDataset(): %f+%f+%f does not equal 1...' %(setRatio[0],setRatio[1],setRatio[2])
+		exit(0)
+
+	formatDir = os.path.join(processedDir, FORMAT_DIR)
+	checkDir = os.path.join(processedDir, CHECK_DIR)
+	for dirName in [formatDir, checkDir] + [os.path.join(processedDir, inDir) for _,inDir,_,_ in SPLIT_DIRS]:
+		makedir(dirName)
+
+	manifest = loadManifest(processedDir)
+	files = manifest['files']
+	vocabHash = hashFile(metaMapFile) + hashFile(musicMapFile)
+	meta_map = pickle.load(open(metaMapFile,'rb'))
+	music_map = pickle.load(open(musicMapFile,'rb'))
+
+	# find out what each file needs
+	stale = {}
+	for fname in os.listdir(originalDataDir):
+		stage = staleStage(files.get(fname), hashFile(os.path.join(originalDataDir, fname)),
+						   vocabHash, manifest['vocab'])
+		if stage is not None:
+			stale[fname] = stage
+	removed = [fname for fname in files if not os.path.isfile(os.path.join(originalDataDir, fname))]
+	print '%d new or changed files, %d removed files' % (len(stale), len(removed))
+
+	# splits whose stores cannot be appended to, because songs left them
+	dirtySplits = set()
+	for splitName,_,songDir,nnDir in SPLIT_DIRS:
+		storeNames = [songDir] + [storeName for storeName,_,_,_,_ in windowStores(processedDir, nnDir)]
+		if any(storeSize(os.path.join(processedDir, storeName))!=manifest['stores'].get(storeName)
+			   for storeName in storeNames):
+			dirtySplits.add(splitName)
+
+	# remove the outputs that are redone or whose file is gone
+	for fname in removed + stale.keys():
+		entry = files.pop(fname, None)
+		if entry is None:
+			continue
+		redoCheck = fname in removed or stale[fname]<=PIPELINE_STAGES.index('check')
+		for splitName,encodedName in entry['encoded']:
+			encodedName = os.path.join(processedDir, encodedName)
+			if os.path.isfile(encodedName):
+				os.remove(encodedName)
+			dirtySplits.add(splitName)
+		if redoCheck:
+			for checkedName in entry['songs']:
+				checkedName = os.path.join(checkDir, checkedName)
+				if os.path.isfile(checkedName):
+					os.remove(checkedName)
+		else:
+			stale[fname] = (stale[fname], entry['songs'])
+
+	p = Pool(numWorkers, initializer=reseedWorker)
+
+	# formatting and checking stage
+	#-----------------------------
+	cleanNames = dict((fname, re.sub(r'[^\x00-\x7f]',r'',fname)) for fname in stale)
+	toFormat = [fname for fname in stale if stale[fname]==PIPELINE_STAGES.index('format')]
+	print '-'*20 + 'FORMATTING %d files' % len(toFormat) + '-'*20
+	for fname in toFormat:
+		formattedName = os.path.join(formatDir, cleanNames[fname])
+		if os.path.isfile(formattedName):
+			os.remove(formattedName)
+	p.map(formatABCtxtWorker, [(os.path.join(originalDataDir, fname), os.path.join(formatDir, cleanNames[fname]), isDuet)
+							   for fname in toFormat])
+
+	print '-'*20 + 'CHECKING' + '-'*20
+	toCheck = [fname for fname in stale if not isinstance(stale[fname], tuple)]
+	toCheck = [fname for fname in toCheck if os.path.isfile(os.path.join(formatDir, cleanNames[fname]))]
+	checked = p.map(checkABCtxtWorker, [(os.path.join(formatDir, cleanNames[fname]),
+										 os.path.join(checkDir, cleanNames[fname]), isDuet, False)
+										for fname in toCheck])
+	p.close()
+	p.join()
+	songs = dict((fname, []) for fname in stale)
+	songs.update((fname, [os.path.basename(name) for name in outputnames or []])
+				 for fname,outputnames in zip(toCheck, checked))
+	songs.update((fname, stage[1]) for fname,stage in stale.iteritems() if isinstance(stage, tuple))
+	if isDuet:
+		for fname in toCheck:
+			for checkedName in songs[fname]:
+				convertNewLines2PercentFile(os.path.join(checkDir, checkedName))
+
+	# splitting stage, existing songs keep their split
+	#-----------------------------
+	splitSongs = {}
+	for splitName,_,_,_ in SPLIT_DIRS:
+		splitName = os.path.join(processedDir, '%s_songs.p' % splitName)
+		splitSongs[splitName] = pickle.load(open(splitName,'rb')) if os.path.isfile(splitName) else []
+	songSplit = {}
+	for splitName,_,_,_ in SPLIT_DIRS:
+		for basename in splitSongs[os.path.join(processedDir, '%s_songs.p' % splitName)]:
+			songSplit[basename] = splitName
+
+	for fname in stale:
+		for checkedName in songs[fname]:
+			basename = find_basename(checkedName)
+			if basename not in songSplit:
+				draw = random.random()
+				splitName = 'train' if draw<setRatio[0] else ('test' if draw<setRatio[0]+setRatio[1] else 'dev')
+				songSplit[basename] = splitName
+				splitSongs[os.path.join(processedDir, '%s_songs.p' % splitName)].append(basename)
+	for splitName,songList in splitSongs.iteritems():
+		pickle.dump(songList, open(splitName,'wb'))
+
+	# encoding stage
+	#-----------------------------
+	print '-'*20 + 'ENCODING' + '-'*20
+	encodeDirs = dict((splitName, inDir) for splitName,inDir,_,_ in SPLIT_DIRS)
+	mapList = []
+	for fname in stale:
+		for checkedName in songs[fname]:
+			encodedName = os.path.join(encodeDirs[songSplit[find_basename(checkedName)]], checkedName.replace('.abc','.npy'))
+			mapList.append((os.path.join(checkDir, checkedName), os.path.join(processedDir, encodedName)))
+	p = Pool(numWorkers, initializer=initEncodeWorker, initargs=(meta_map, music_map))
+	encoded = p.map(encodeABCWorker, mapList, chunksize=ENCODE_CHUNKSIZE)
+	p.close()
+	p.join()
+
+	newEncoded = dict((splitName, []) for splitName,_,_,_ in SPLIT_DIRS)
+	encodedNames = set(name for name in encoded if name is not None)
+	for fname in stale:
+		files[fname] = {'hash':hashFile(os.path.join(originalDataDir, fname)), 'versions':dict(STAGE_VERSIONS),
+						'songs':songs[fname], 'encoded':[]}
+		for checkedName in songs[fname]:
+			splitName = songSplit[find_basename(checkedName)]
+			encodedName = os.path.join(encodeDirs[splitName], checkedName.replace('.abc','.npy'))
+			if os.path.join(processedDir, encodedName) in encodedNames:
+				files[fname]['encoded'].append((splitName, encodedName))
+				newEncoded[splitName].append(os.path.join(processedDir, encodedName))
+
+	# song and window stores
+	#-----------------------------
+	for splitName,inDir,songDir,nnDir in SPLIT_DIRS:
+		songStore = os.path.join(processedDir, songDir)
+		encodedDir = os.path.join(processedDir, inDir)
+
+		if splitName in dirtySplits:
+			print 'Rebuilding the stores of the %s split' % splitName
+			filenames = [os.path.join(encodedDir, fname) for fname in sorted(os.listdir(encodedDir))]
+			writeSongStore(songStore, (np.load(fname) for fname in filenames))
+		else:
+			filenames = sorted(newEncoded[splitName])
+			appendSongStore(songStore, (np.load(fname) for fname in filenames))
+		manifest['stores'][songDir] = storeSize(songStore)
+
+		for storeName,stride_sz,window_sz,nnType,output_sz in windowStores(processedDir, nnDir):
+			if splitName in dirtySplits:
+				buildWindowStore(os.path.join(processedDir, storeName[:-len('_shuffled')]), filenames,
+								 stride_sz, window_sz, nnType, output_sz)
+			elif len(filenames)>0:
+				label_sz = labelSize(nnType, window_sz, output_sz)
+				meta,inputs,labels = npy2nnInputWorker((window_sz, label_sz,
+									[(stride_sz, window_sz, nnType, output_sz, fname) for fname in filenames]))
+				appendWindowStore(os.path.join(processedDir, storeName), meta, inputs, labels)
+			manifest['stores'][storeName] = storeSize(os.path.join(processedDir, storeName))
+
+	manifest['vocab'] = vocabHash
+	saveManifest(processedDir, manifest)
+
+
 if __name__ == "__main__":
 # 	# preprocessing pipeline
 # 	#-----------------------------------
@@ -504,6 +1080,10 @@ if __name__ == "__main__":
 	processedDir = originalDataDir+'_processed'
 	isDuet = True
 
+	# incremental: only processes the files added or changed since the last run,
+	# and appends them to the song stores and window stores under processedDir
+	# updateDataset(originalDataDir, processedDir, isDuet, (0.8,0.1,0.1))
+
 # 	print '-'*20 + 'FORMATTING' + '-'*20
 # 	formatABCtxt(originalDataDir, processedDir, isDuet)
 # 	print '-'*20 + 'CHECKING' + '-'*20
@@ -516,8 +1096,14 @@ if __name__ == "__main__":
 # 	datasetSplit(processedDir, (0.8,0.1,0.1))
 	# print '-'*20 + 'GENERATING VOCAB' + '-'*20
 	# generateVocab(processedDir)
+	# or add the new symbols to the global maps
+	# updateGlobalVocab(processedDir)
 	# print '-'*20 + 'ENCODING' + '-'*20
 	# encodeABC(processedDir)
+	# print '-'*20 + 'FORMING SONG STORE' + '-'*20
+	# npy2SongStore(processedDir)
+	# or encode straight into the song stores, without the .npy files
+	# encodeABC2SongStore(processedDir)
 	# print '-'*20 + 'FORMING NNINPUTS' + '-'*20
 	# npy2nnInput(processedDir, 25, 10, 'seq2seq', output_sz=10)
 	# print '-'*20 + 'FORMING NNINPUTS' + '-'*20
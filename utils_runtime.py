@@ -1,9 +1,13 @@
 import pickle
 import os
 import random
+import threading
+import Queue
+import sys
 import numpy as np
 from argparse import ArgumentParser
 import reader
+from models import CELL_TYPES, LSTM_CELL_TYPES
 
 import tensorflow as tf
 from utils_preprocess import *
@@ -18,70 +22,138 @@ if SHERLOCK:
 else:
 	DIR_MODIFIER = '/data'
 
-def genWarmStartDataset(data_len, meta_map, music_map, 
-			dataFolder=os.path.join(DIR_MODIFIER, 'full_dataset/warmup_dataset/checked')):
+_warm_start_indexes = {}
+_warm_start_lock = threading.Lock()
+
+def buildWarmStartIndex(meta_map, music_map, dataFolder):
 	"""
-	Generates metadata and music data for the use in warm starting the RNN models
+	Parses every .abc file under @dataFolder (or the single file @dataFolder) once, and
+	keeps the songs whose metadata is in @meta_map, encoded with @meta_map and @music_map.
 
-	A file gets sampled from @dataFolder under ./checked file, and gets encoded using
-	the 'vocab_map_meta.p' and 'vocab_map_music.p' files under @vocab_dir.
+	The music of every song is encoded up to its first character missing from @music_map,
+	and the songs are sorted so that the ones usable for a warm start of any length come
+	first (see warmStartCandidates).
+	"""
+	if os.path.isfile(dataFolder):
+		abc_list = [dataFolder]
+	else:
+		abc_list = [os.path.join(dataFolder, abc_file) for abc_file in sorted(os.listdir(dataFolder))]
+
+	files, raw_meta, meta, songs, thresholds = [], [], [], [], []
+	for abc_file in abc_list:
+		try:
+			song_meta, music = loadCleanABC(abc_file)
+		except Exception:
+			continue
+		if any(song_meta[header] not in meta_map[header] for header in META_FIELDS):
+			continue
+
+		encoded = []
+		for c in music:
+			if c not in music_map:
+				break
+			encoded.append(music_map[c])
+
+		files.append(abc_file)
+		raw_meta.append(song_meta)
+		meta.append([meta_map[header][song_meta[header]] for header in META_FIELDS] + [song_meta['len'], song_meta['complexity']])
+		songs.append(encoded)
+		# longest warm start the song can give, any length if all of it is encoded
+		thresholds.append(sys.maxint if len(encoded) == len(music) else len(encoded))
+
+	order = np.argsort(-np.array(thresholds, dtype=np.int64), kind='mergesort')
+	lengths = np.array([len(songs[i]) for i in order], dtype=np.int64)
+
+	index = {}
+	index['files'] = [files[i] for i in order]
+	index['raw_meta'] = [raw_meta[i] for i in order]
+	index['meta'] = np.array([meta[i] for i in order], dtype=np.int64).reshape(-1, reader.NUM_META)
+	index['tokens'] = np.array([c for i in order for c in songs[i]], dtype=np.int32)
+	index['offsets'] = np.concatenate([[0], np.cumsum(lengths)])
+	index['thresholds'] = np.array([thresholds[i] for i in order], dtype=np.int64)
+	index['meta_map'] = meta_map
+	index['music_map'] = music_map
+	index['music_decode'] = dict(zip(music_map.values(), music_map.keys()))
+	index['groups'] = {}
+	return index
+
+
+def getWarmStartIndex(meta_map, music_map, dataFolder):
+	"""
+	Returns the warm-start index of @dataFolder for these maps, built on the first call
+	"""
+	key = (os.path.abspath(dataFolder), id(meta_map), id(music_map))
+	with _warm_start_lock:
+		index = _warm_start_indexes.get(key)
+		# the index keeps references to its maps, so that their ids cannot be reused by other ones
+		if index is None or index['meta_map'] is not meta_map or index['music_map'] is not music_map:
+			index = buildWarmStartIndex(meta_map, music_map, dataFolder)
+			_warm_start_indexes[key] = index
+	return index
 
-	The first @data_len characters in the music data is returned.
+
+def warmStartCandidates(index, meta_filter=None):
+	"""
+	Returns the songs of @index matching @meta_filter ({header: value}, e.g. {'R': 'reel'}),
+	and their negated thresholds (ascending). Cached per filter.
+	"""
+	meta_filter = meta_filter or {}
+	key = tuple(sorted(meta_filter.items()))
+	group = index['groups'].get(key)
+	if group is None:
+		mask = np.ones(len(index['files']), dtype=bool)
+		for header, value in meta_filter.iteritems():
+			value_id = index['meta_map'][header].get(str(value), -1)
+			mask &= (index['meta'][:, META_FIELDS.index(header)] == value_id)
+		songs = np.flatnonzero(mask)
+		group = (songs, -index['thresholds'][songs])
+		index['groups'][key] = group
+	return group
+
+
+def warmStartSongs(data_len, meta_map, music_map, dataFolder, meta_filter=None):
 	"""
+	Returns the warm-start index of @dataFolder and its songs that can warm-start
+	@data_len characters (-1 for whole songs) with the metadata of @meta_filter
+	"""
+	index = getWarmStartIndex(meta_map, music_map, dataFolder)
+	songs, negated_thresholds = warmStartCandidates(index, meta_filter)
 
-	oneHotHeaders = ('R', 'M', 'L', 'K_key', 'K_mode')
-	otherHeaders = ('len', 'complexity')
+	# songs are sorted by threshold, so the usable ones come first
+	needed = sys.maxint if data_len==-1 else data_len-1
+	return index, songs[:np.searchsorted(negated_thresholds, -needed, side='right')]
 
-	# while loop here, just in case that the file we choose contains characters that
-	# does not appear in the original dataset
-	while True:
-		# pick a random file in dataFolder
-		if os.path.isfile(dataFolder):
-			abc_file = dataFolder
-		else:
-			abc_list = os.listdir(dataFolder)
-			abc_file = os.path.join(dataFolder, random.choice(abc_list))
 
-		meta,music = loadCleanABC(abc_file)
-		if data_len==-1:
-			warm_str = music
-		else:
-			warm_str = music[:data_len-1]
+def genWarmStartDataset(data_len, meta_map, music_map, 
+			dataFolder=os.path.join(DIR_MODIFIER, 'full_dataset/warmup_dataset/checked'), meta_filter=None):
+	"""
+	Generates metadata and music data for the use in warm starting the RNN models
 
-		# start encoding
-		meta_enList = []
-		music_enList = []
-		encodeSuccess = True
+	A song gets sampled from the warm-start index of @dataFolder (see buildWarmStartIndex),
+	among the songs whose first @data_len characters are all in @music_map and whose
+	metadata matches @meta_filter ({header: value}, e.g. {'R': 'reel', 'K_key': '2'}).
 
-		# encode the metadata info
-		for header in oneHotHeaders:
-			if meta[header] not in meta_map[header]:
-				encodeSuccess = False
-				break
-			else:
-				meta_enList.append(meta_map[header][meta[header]])
+	The first @data_len characters in the music data is returned.
+	"""
+	index, songs = warmStartSongs(data_len, meta_map, music_map, dataFolder, meta_filter)
+	if len(songs) == 0:
+		raise ValueError('No song in %s can warm-start %d characters with metadata %s' % (dataFolder, data_len, meta_filter))
 
-		for header in otherHeaders:
-			meta_enList.append(meta[header])
+	needed = sys.maxint if data_len==-1 else data_len-1
+	song = songs[random.randrange(len(songs))]
+	start = index['offsets'][song]
+	end = index['offsets'][song+1] if data_len==-1 else min(index['offsets'][song+1], start+needed)
 
-		# encode music data
-		# add the BEGIN token
-		music_enList.append(music_map['<start>'])
-		for i in range(len(warm_str)):
-			c = music[i]
-			if c not in music_map:
-				encodeSuccess = False
-				break
-			else:
-				music_enList.append(music_map[c])
+	meta_enList = [int(m) for m in index['meta'][song]]
+	# add the BEGIN token
+	music_enList = [music_map['<start>']] + [int(c) for c in index['tokens'][start:end]]
 
-		if encodeSuccess:
-			break
+	warm_str = ''.join(index['music_decode'][c] for c in music_enList[1:])
 
 	print '-'*50
 	print 'Generating the warm-start sequence...'
-	print 'Chose %s to warm-start...' % abc_file
-	print 'Meta Data is: %s' % str(meta)
+	print 'Chose %s to warm-start...' % index['files'][song]
+	print 'Meta Data is: %s' % str(index['raw_meta'][song])
 	print 'The associated encoding is: %s' % str(meta_enList)
 	print 'Music to warm-start with is: %s' % warm_str
 	print 'The associated encoding is: %s' % str(music_enList)
@@ -92,6 +164,9 @@ def genWarmStartDataset(data_len, meta_map, music_map,
 
 def sample_with_temperature(logits, temperature):
 	flattened_logits = logits.flatten()
+	# No temperature, take the most likely character
+	if not temperature or temperature <= 0:
+		return np.argmax(flattened_logits)
 	unnormalized = np.exp((flattened_logits - np.max(flattened_logits)) / temperature)
 	probabilities = unnormalized / float(np.sum(unnormalized))
 	sample = np.random.choice(len(probabilities), p=probabilities)
@@ -134,27 +209,52 @@ def save_checkpoint(args, session, saver, i):
 	# saver.save(session, os.path.join(SUMMARY_DIR,'model.ckpt'), global_step=i)
 
 
+# Field order of the one-hot metadata, as written by utils_preprocess.encodeABCWorker.
+# Pinned explicitly because the key order of the meta map dict is not stable across Python versions.
+META_FIELDS = ('R', 'M', 'L', 'K_key', 'K_mode')
+_meta_offset_cache = {}
+
+def meta_offsets(meta_vocabulary):
+	"""
+	Returns the [7] offset vector that moves every one-hot metadata field into its
+	own range of the shared metadata embedding. The numerical fields get 0.
+	Computed once per meta map.
+	"""
+	cached = _meta_offset_cache.get(id(meta_vocabulary))
+	if cached is not None and cached[0] is meta_vocabulary:
+		return cached[1]
+
+	vocab_lengths = [len(meta_vocabulary[field]) for field in META_FIELDS]
+	offsets = np.zeros(reader.NUM_META, dtype=np.int64)
+	offsets[1:len(META_FIELDS)] = np.cumsum(vocab_lengths[:-1])
+
+	# keep a reference to the map so that its id cannot be reused by another one
+	_meta_offset_cache[id(meta_vocabulary)] = (meta_vocabulary, offsets)
+	return offsets
+
+
 def encode_meta_batch(meta_vocabulary, meta_batch):
-	new_meta_batch = []
-	vocab_lengths = [0] + [len(small_vocab) for small_vocab in meta_vocabulary.values()]
-	num_values = len(meta_vocabulary.values())
+	"""
+	Encodes a [B,7] batch of per-field metadata ids into the shared id space
+	of the metadata embedding.
+	"""
+	return np.asarray(meta_batch, dtype=np.int64) + meta_offsets(meta_vocabulary)
+
 
-	for meta_data in meta_batch:
-		new_meta_data = [meta_data[i] + sum(vocab_lengths[:i+1]) for i in xrange(num_values)]
-		new_meta_data = np.append(new_meta_data, meta_data[5:])
-		new_meta_batch.append(new_meta_data)
-	return new_meta_batch
+def create_noise_meta_batch(meta_vocabulary, batch_size):
+	vocab_lengths = [len(meta_vocabulary[field]) for field in META_FIELDS]
+	noise_meta_batch = [np.random.randint(upper_bound, size=batch_size) for upper_bound in vocab_lengths]
+	noise_meta_batch += [np.random.randint(10, high=41, size=batch_size), np.random.randint(50, high=400, size=batch_size)]
+	return np.stack(noise_meta_batch, axis=1)
 
 
 def create_noise_meta(meta_vocabulary):
-	vocab_lengths = [len(small_vocab) for small_vocab in meta_vocabulary.values()]
-	noise_meta_batch = [np.random.randint(upper_bound) for upper_bound in vocab_lengths]
-	noise_meta_batch += [np.random.randint(10, high=41), np.random.randint(50, high=400)]
-	return np.array(noise_meta_batch)
+	return create_noise_meta_batch(meta_vocabulary, 1)[0]
 
 
 def pack_feed_values(args, input_batch, label_batch, meta_batch,
-							initial_state_batch, use_meta_batch, num_encode, num_decode):
+							initial_state_batch, use_meta_batch, num_encode, num_decode, initial_hidden_batch=None,
+							reset_batch=None):
 	# if (args.train != "sample"):
 	#     for i, input_b in enumerate(input_batch):
 	#         if input_b.shape[0] != 50:
@@ -175,7 +275,7 @@ def pack_feed_values(args, input_batch, label_batch, meta_batch,
 		packed += [input_batch.T, label_batch.T, meta_batch, initial_state_batch, use_meta_batch, num_encode, num_decode]
 		# + attention?
 	elif args.model == 'char':
-		packed += [input_batch, label_batch, meta_batch, initial_state_batch, use_meta_batch]
+		packed += [input_batch, label_batch, meta_batch, initial_state_batch, use_meta_batch, initial_hidden_batch, num_encode, reset_batch]
 	elif args.model == 'cbow':
 		new_label_batch = [d[-1] for d in label_batch]
 		packed += [input_batch, new_label_batch]
@@ -185,6 +285,138 @@ def pack_feed_values(args, input_batch, label_batch, meta_batch,
 	return packed
 
 
+def zero_state_batch(curModel, batch_size):
+	"""
+	Returns the zero Initial_State of @curModel: one [batch, hidden] state per layer for
+	the LSTM cells, a single one for the others, None for the models without a cell (CBOW)
+	"""
+	if not hasattr(curModel, 'cell_type'):
+		return None
+	if curModel.cell_type in LSTM_CELL_TYPES:
+		return np.zeros((curModel.config.num_layers, batch_size, curModel.config.hidden_size))
+	return np.zeros((batch_size, curModel.config.hidden_size))
+
+
+def batch_feed_values(args, curModel, meta_vocabulary, data_batch):
+	"""
+	Turns a (meta, inputs, labels) batch from reader.dataset_batches into the
+	feed values of @curModel, starting every window from its metadata.
+	"""
+	meta_batch, input_window_batch, output_window_batch = data_batch
+	batch_size, window_sz = input_window_batch.shape
+	new_meta_batch = encode_meta_batch(meta_vocabulary, meta_batch)
+
+	initial_state_batch = zero_state_batch(curModel, batch_size)
+	num_encode = [window_sz] * batch_size
+	num_decode = num_encode[:]
+
+	return pack_feed_values(args, input_window_batch, output_window_batch, new_meta_batch,
+							initial_state_batch, True, num_encode, num_decode)
+
+
+def segment_feed_values(args, curModel, meta_vocabulary, segment_batch):
+	"""
+	Turns a (meta, inputs, labels, input_lengths, label_lengths) batch from
+	reader.segment_batches into the feed values of @curModel, starting every
+	segment from its metadata. Only the real characters of every row are used.
+	"""
+	meta_batch, input_batch, label_batch, input_lengths, label_lengths = segment_batch
+	batch_size = len(input_batch)
+	new_meta_batch = encode_meta_batch(meta_vocabulary, meta_batch)
+
+	initial_state_batch = zero_state_batch(curModel, batch_size)
+
+	return pack_feed_values(args, input_batch, label_batch, new_meta_batch,
+							initial_state_batch, True, list(input_lengths), list(label_lengths))
+
+
+def lane_feed_values(args, curModel, meta_vocabulary, lane_batch):
+	"""
+	Turns a (meta, inputs, labels, input_lengths, label_lengths, reset) batch
+	from reader.lane_batches into the feed values of the char model. The initial
+	state is left at zeros, carry_state fills in the final state of the previous
+	batch, and only the rows of @reset start from their metadata.
+	"""
+	meta_batch, input_batch, label_batch, input_lengths, label_lengths, reset = lane_batch
+	batch_size = len(input_batch)
+	new_meta_batch = encode_meta_batch(meta_vocabulary, meta_batch)
+
+	return pack_feed_values(args, input_batch, label_batch, new_meta_batch, zero_state_batch(curModel, batch_size), False,
+							list(input_lengths), list(label_lengths), initial_hidden_batch=zero_state_batch(curModel, batch_size),
+							reset_batch=reset)
+
+
+def carry_state(feed_values, state):
+	"""
+	Feeds the final LSTM @state of the previous batch (curModel.final_state, one
+	(c, h) tuple per layer) as the initial state of @feed_values, from lane_feed_values
+	"""
+	if state is None:
+		return feed_values
+	feed_values = list(feed_values)
+	feed_values[3] = np.stack([layer_state[0] for layer_state in state])
+	feed_values[5] = np.stack([layer_state[1] for layer_state in state])
+	return feed_values
+
+
+def pad_batch(data_batch, batch_size):
+	"""
+	Pads a (meta, inputs, labels) batch to @batch_size rows by repeating its rows, for
+	graphs built for a fixed batch size. Returns the padded batch and its number of real rows.
+	"""
+	num_rows = len(data_batch[1])
+	rows = np.arange(batch_size) % num_rows
+	return tuple(np.asarray(data)[rows] for data in data_batch), num_rows
+
+
+def _prefetch_worker(iterator, iterator_lock, map_fn, queue):
+	try:
+		while True:
+			with iterator_lock:
+				try:
+					item = next(iterator)
+				except StopIteration:
+					break
+			queue.put((True, map_fn(item)))
+	except:
+		queue.put((False, sys.exc_info()))
+	queue.put(None)
+
+
+def prefetch(iterator, map_fn, depth=2, num_threads=1):
+	"""
+	Applies @map_fn to every item of @iterator in background threads, so the next
+	batches are assembled while the current session.run step executes.
+
+	@depth			- int / number of prepared items to buffer, 0 runs everything inline
+	@num_threads	- int / number of worker threads; with more than one thread the
+					  items are no longer yielded in the order of @iterator
+	"""
+	if depth <= 0:
+		for item in iterator:
+			yield map_fn(item)
+		return
+
+	queue = Queue.Queue(maxsize=depth)
+	iterator = iter(iterator)
+	iterator_lock = threading.Lock()
+	for i in xrange(num_threads):
+		worker = threading.Thread(target=_prefetch_worker, args=(iterator, iterator_lock, map_fn, queue))
+		worker.daemon = True
+		worker.start()
+
+	num_running = num_threads
+	while num_running > 0:
+		result = queue.get()
+		if result is None:
+			num_running -= 1
+		elif result[0]:
+			yield result[1]
+		else:
+			exc_type, exc_value, exc_traceback = result[1]
+			raise exc_type, exc_value, exc_traceback
+
+
 def parseCommandLine():
 	desc = u'{0} [Args] [Options]\nDetailed options -h or --help'.format(__file__)
 	parser = ArgumentParser(description=desc)
@@ -194,7 +426,7 @@ def parseCommandLine():
 	requiredModel.add_argument('-m', choices = ["seq2seq", "char", "cbow"], type = str,
 						dest = 'model', required = True, help = 'Type of model to run')
 	requiredTrain = parser.add_argument_group('Required Train/Test arguments')
-	requiredTrain.add_argument('-p', choices = ["train", "test", "sample", "dev"], type = str,
+	requiredTrain.add_argument('-p', choices = ["train", "test", "sample", "dev", "eval"], type = str,
 						dest = 'train', required = True, help = 'Training or Testing phase to be run')
 
 	requiredTrain.add_argument('-c', type = str, dest = 'set_config',
@@ -204,6 +436,24 @@ def parseCommandLine():
 	parser.add_argument('-e', dest='num_epochs', default=50, type=int, help='Set the number of Epochs')
 	parser.add_argument('-ckpt', dest='ckpt_dir', default=DIR_MODIFIER + '/temp_ckpt/', type=str, help='Set the checkpoint directory')
 	parser.add_argument('-data', dest='data_dir', default='', type=str, help='Set the data directory')
+	parser.add_argument('-prefetch', dest='prefetch', default=2, type=int,
+						help='Number of batches to prepare ahead of the training step (0 to disable)')
+	parser.add_argument('-prefetch_threads', dest='prefetch_threads', default=1, type=int,
+						help='Number of threads preparing the batches (always 1 with -stateful, which needs them in order)')
+	parser.add_argument('-threads', dest='threads', default=0, type=int,
+						help='Number of threads used by TensorFlow (0 for all the cores)')
+	parser.add_argument('-splits', dest='splits', nargs='+', default=['dev', 'test'], choices=['train', 'dev', 'test'],
+						help='Splits scored by -p eval, read from the -data path with its split replaced')
+	parser.add_argument('-eval_batch', dest='eval_batch', default=500, type=int,
+						help='Batch size of -p dev/test/eval')
+	parser.add_argument('-segment', dest='segment', default=0, type=int,
+						help='Train on whole songs of a song store, cut in segments of at most this many characters '
+							 'and batched by length (0 for the fixed windows of the hyperparameters)')
+	parser.add_argument('-cell', dest='cell_type', default=None, choices=CELL_TYPES,
+						help='Recurrent cell backend, the cell_type of the hyperparameters (lstm by default) if not set')
+	parser.add_argument('-stateful', dest='stateful', action='store_true',
+						help='Train the char model on whole songs of a song store, every batch row walking its songs in '
+							 'consecutive windows of window_sz characters and starting from the final state of its previous window')
 
 	args = parser.parse_args()
 	return args